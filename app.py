@@ -3,14 +3,44 @@
 GitHub × Streamlit で動作する競馬予想システム
 """
 
+from __future__ import annotations
+
+import time
+
+_SCRIPT_STARTED = time.perf_counter()  # 起動時間の計測用（import 時間も含める）
+
 import streamlit as st
 import pandas as pd
-from openai import OpenAI
+import numpy as np
 import os
+import re
 import html
-import time
-from typing import Any, Dict, List
+import json
+import hashlib
+import io
+import itertools
+import math
+import pickle
+import random
+import shutil
+import sqlite3
+import threading
+import unicodedata
+import uuid
+import multiprocessing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Tuple
 from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from queue import Empty
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# openai / openpyxl / pyarrow は import が重いので、使う関数の中で初めて読み込む
+# （スナップショットから復元できる間は openpyxl を、Feather が無ければ pyarrow を読まない）
 
 JST = timezone(timedelta(hours=9))
 
@@ -28,7 +58,7 @@ st.set_page_config(
 # セッション状態（タブ切替でも結果を保持）
 # ============================================
 if "comp_results" not in st.session_state:
-    st.session_state["comp_results"] = {"step1": None, "step2": None, "step3": None}
+    st.session_state["comp_results"] = {"step1": None, "step2": None, "step2_data": None, "step3": None}
 if "eval_results" not in st.session_state:
     st.session_state["eval_results"] = {}
 if "sign_results" not in st.session_state:
@@ -39,6 +69,12 @@ if "search_date_jst" not in st.session_state:
     st.session_state["search_date_jst"] = None
 if "search_error" not in st.session_state:
     st.session_state["search_error"] = None
+if "search_fetched_at" not in st.session_state:
+    st.session_state["search_fetched_at"] = None
+if "search_stale" not in st.session_state:
+    st.session_state["search_stale"] = False
+if "search_topics" not in st.session_state:
+    st.session_state["search_topics"] = []
 
 # ============================================
 # 表示ヘルパー（白文字問題の根本対策）
@@ -66,9 +102,20 @@ def render_box(title: str, body_text: str, box_class: str = "result-box") -> str
 
 
 def render_sidebar_search(sb_debug, sb_body):
-    sb_debug.caption(f"date={st.session_state.get('search_date_jst')}")
-    sb_debug.caption(f"has_results={bool(st.session_state.get('search_results'))}")
-    sb_debug.caption(f"error={st.session_state.get('search_error')}")
+    fetched_at = st.session_state.get("search_fetched_at")
+    age = f"{int((time.time() - fetched_at) // 60)}分前" if fetched_at else "-"
+    with sb_debug.container():
+        st.caption(f"date={st.session_state.get('search_date_jst')}")
+        st.caption(f"has_results={bool(st.session_state.get('search_results'))}")
+        st.caption(f"age={age} stale={bool(st.session_state.get('search_stale'))}")
+        for topic in st.session_state.get("search_topics") or []:
+            topic_age = int((time.time() - topic["fetched_at"]) // 60)
+            note = "（更新中）" if topic["stale"] else ""
+            if topic.get("refresh_error"):
+                failed_age = int((time.time() - topic["refresh_failed_at"]) // 60)
+                note = f"（再検索失敗 {failed_age}分前: {topic['refresh_error']}）"
+            st.caption(f"・{topic['title']}: {topic_age}分前{note}")
+        st.caption(f"error={st.session_state.get('search_error')}")
 
     if st.session_state.get("search_results"):
         sb_body.markdown(
@@ -247,35 +294,678 @@ label[data-testid="stWidgetLabel"] {
 
 # ============================================
 # OpenAI クライアント
+# - クライアント（HTTP接続プール）はプロセス内で1つを使い回し、keep-alive を長めに取る
+# - SDK 側の自動リトライは切り、openai_call で再試行とサーキットブレーカーを一括管理する
 # ============================================
+OPENAI_CONNECT_TIMEOUT_SEC = 5.0
+OPENAI_KEEPALIVE_SEC = 120.0
+LLM_CALL_TIMEOUT_SEC = float(os.environ.get("LLM_CALL_TIMEOUT_SEC", "180"))
+SEARCH_CALL_TIMEOUT_SEC = float(os.environ.get("SEARCH_CALL_TIMEOUT_SEC", "120"))
+
+
+def _openai_api_key() -> str:
+    return st.secrets.get("OPENAI_API_KEY", os.environ.get("OPENAI_API_KEY"))
+
+
+@st.cache_resource(show_spinner=False)
+def _openai_client(api_key: str) -> OpenAI:
+    import openai
+
+    limits = type(openai.DEFAULT_CONNECTION_LIMITS)(
+        max_connections=64, max_keepalive_connections=32, keepalive_expiry=OPENAI_KEEPALIVE_SEC
+    )
+    timeout = openai.Timeout(LLM_CALL_TIMEOUT_SEC, connect=OPENAI_CONNECT_TIMEOUT_SEC)
+    return openai.OpenAI(
+        api_key=api_key,
+        max_retries=0,
+        timeout=timeout,
+        http_client=openai.DefaultHttpxClient(limits=limits, timeout=timeout),
+    )
+
+
 def get_openai_client():
-    api_key = st.secrets.get("OPENAI_API_KEY", os.environ.get("OPENAI_API_KEY"))
+    api_key = _openai_api_key()
     if not api_key:
         st.error("⚠️ OpenAI API キーが設定されていません")
         return None
-    return OpenAI(api_key=api_key)
+    return _openai_client(api_key)
+
 
 # ============================================
-# データ読み込み
+# 再試行とサーキットブレーカー（全セッション共有）
+# - 429 / 408 / 409 / 5xx / 接続エラー・タイムアウトは指数バックオフ（フルジッター）で再試行
+# - Retry-After（retry-after-ms）ヘッダがあればその時間以上待つ（RETRY_AFTER_MAX_SEC より長ければ待たずにエラー）
+# - 連続失敗が閾値を超えたら一定時間は呼び出さずに即エラーにし、その後1件だけ試して復帰を判断
 # ============================================
-@st.cache_data
-def load_race_data(uploaded_file=None):
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY_SEC = 0.5
+RETRY_MAX_DELAY_SEC = 20.0
+RETRY_AFTER_MAX_SEC = 120.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SEC = 30.0
+
+
+class UpstreamUnavailableError(RuntimeError):
+    """OpenAI API を呼べない状態（ブレーカー作動中、または再試行の上限に到達）。"""
+
+
+@st.cache_resource
+def get_circuit_breaker() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "state": "closed", "failures": 0, "opened_at": 0.0, "probing": False}
+
+
+def _breaker_acquire() -> None:
+    breaker = get_circuit_breaker()
+    with breaker["lock"]:
+        if breaker["state"] == "open":
+            remaining = BREAKER_COOLDOWN_SEC - (time.time() - breaker["opened_at"])
+            if remaining > 0:
+                raise UpstreamUnavailableError(
+                    f"OpenAI API が不安定なため呼び出しを一時停止しています（約{math.ceil(remaining)}秒後に再開）"
+                )
+            breaker["state"] = "half_open"
+        if breaker["state"] == "half_open":
+            if breaker["probing"]:
+                raise UpstreamUnavailableError("OpenAI API の復旧を確認中です。しばらくしてから再実行してください")
+            breaker["probing"] = True
+
+
+def _breaker_record(ok: bool) -> None:
+    breaker = get_circuit_breaker()
+    with breaker["lock"]:
+        breaker["probing"] = False
+        if ok:
+            breaker["state"] = "closed"
+            breaker["failures"] = 0
+            return
+        breaker["failures"] += 1
+        if breaker["state"] == "half_open" or breaker["failures"] >= BREAKER_FAILURE_THRESHOLD:
+            breaker["state"] = "open"
+            breaker["opened_at"] = time.time()
+
+
+def breaker_status() -> str:
+    breaker = get_circuit_breaker()
+    with breaker["lock"]:
+        return f"{breaker['state']}（連続失敗 {breaker['failures']}）"
+
+
+def _is_retryable(error: Exception) -> bool:
+    import openai
+
+    if isinstance(error, openai.APIConnectionError):  # タイムアウトを含む
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def _retry_after_sec(error: Exception) -> float:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
     try:
-        if uploaded_file is not None:
-            xlsx = pd.ExcelFile(uploaded_file)
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return 0.0
+        if value.strip().isdigit():
+            return float(value)
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    # 上限はジッター付きバックオフだけに掛ける。Retry-After より早く再送すると 429 が続きブレーカーが開く
+    backoff = random.uniform(0, min(RETRY_MAX_DELAY_SEC, RETRY_BASE_DELAY_SEC * 2**attempt))
+    return max(_retry_after_sec(error), backoff)
+
+
+def openai_call(
+    create: Callable[[], Any],
+    model: str = None,
+    est_tokens: int = 0,
+    on_wait: Callable[[str], None] = None,
+) -> Any:
+    """create() を再試行・ブレーカー付きで呼ぶ。使えない時は UpstreamUnavailableError。
+
+    model を渡すと、各試行の前にレート制御（rate_limit_acquire）の順番待ちをする。
+    """
+    last_error = None
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        # 順番待ちを先に済ませる。半開状態の試験呼び出しを取ったまま待ち行列で時間切れになると、
+        # 結果が記録されずブレーカーが「確認中」のまま戻らなくなる
+        if model is not None:
+            rate_limit_acquire(model, est_tokens, on_wait)
+        # 送らなかった・受け付けられなかった試行の見積もりトークンは戻す（戻さないと回復後に全員が待たされる）
+        refund = (lambda: rate_limit_settle(model, est_tokens, 0)) if model is not None else (lambda: None)
+        try:
+            _breaker_acquire()
+        except UpstreamUnavailableError:
+            refund()
+            raise
+        try:
+            result = create()
+        except Exception as e:
+            refund()
+            if not _is_retryable(e):
+                _breaker_record(True)  # 4xx などは上流の障害ではない
+                raise
+            _breaker_record(False)
+            last_error = e
         else:
-            xlsx = pd.ExcelFile("arima_data.xlsx")
-        data = {}
-        for sheet in xlsx.sheet_names:
-            data[sheet] = pd.read_excel(xlsx, sheet_name=sheet)
-        return data
-    except Exception:
+            _breaker_record(True)
+            return result
+        if attempt + 1 < RETRY_MAX_ATTEMPTS:
+            delay = _retry_delay(attempt, last_error)
+            if delay > RETRY_AFTER_MAX_SEC:
+                raise UpstreamUnavailableError(
+                    f"OpenAI API から待機を指示されました。約{math.ceil(delay)}秒後に再実行してください"
+                ) from last_error
+            time.sleep(delay)
+    raise UpstreamUnavailableError(
+        f"OpenAI API の呼び出しに {RETRY_MAX_ATTEMPTS} 回失敗しました（{type(last_error).__name__}）"
+    ) from last_error
+
+
+# ============================================
+# レート制御（RPM / TPM のトークンバケット・全セッション共有）
+# - モデルごとに「リクエスト数」「トークン数」の2つのバケットを持ち、1分で上限まで回復する
+# - 1リクエストの消費トークンは 入力の概算 + max_output_tokens で見積もり、完了後に実績で精算する
+# - 待ち行列はセッション単位のラウンドロビンで、1人が大量に投げても他のユーザーを追い越さない
+# - LLM応答キャッシュに当たった呼び出しはここを通らない
+# ============================================
+RATE_LIMITS = {
+    "gpt-5-mini": (
+        int(os.environ.get("GPT5MINI_RPM", "500")),
+        int(os.environ.get("GPT5MINI_TPM", "200000")),
+    ),
+    "gpt-4.1": (
+        int(os.environ.get("GPT41_RPM", "500")),
+        int(os.environ.get("GPT41_TPM", "30000")),
+    ),
+}
+RATE_QUEUE_TIMEOUT_SEC = float(os.environ.get("RATE_QUEUE_TIMEOUT_SEC", "300"))
+
+
+@st.cache_resource
+def get_rate_governor() -> Dict[str, Any]:
+    return {"cond": threading.Condition(), "models": {}}
+
+
+def _rate_state(governor: Dict[str, Any], model: str) -> Dict[str, Any]:
+    state = governor["models"].get(model)
+    if state is None:
+        rpm, tpm = RATE_LIMITS.get(model, RATE_LIMITS["gpt-5-mini"])
+        state = {
+            "rpm": rpm,
+            "tpm": tpm,
+            "requests": float(rpm),
+            "tokens": float(tpm),
+            "updated": time.monotonic(),
+            "queues": {},  # session_id -> deque[ticket]
+            "ring": deque(),  # 次に順番が回ってくるセッションの並び
+        }
+        governor["models"][model] = state
+    return state
+
+
+def _refill(state: Dict[str, Any]) -> None:
+    now = time.monotonic()
+    elapsed = now - state["updated"]
+    state["updated"] = now
+    state["requests"] = min(state["rpm"], state["requests"] + elapsed * state["rpm"] / 60)
+    state["tokens"] = min(state["tpm"], state["tokens"] + elapsed * state["tpm"] / 60)
+
+
+def _ticket_index(queue: deque, ticket: Dict[str, Any]) -> int:
+    # 券は中身が同じ dict になり得るので、== ではなく同一オブジェクトで探す
+    return next(i for i, t in enumerate(queue) if t is ticket)
+
+
+def _queue_position(state: Dict[str, Any], session_id: str, ticket: Dict[str, Any]) -> int:
+    # ラウンドロビンで配った場合に、自分より先に処理されるリクエスト数
+    mine = _ticket_index(state["queues"][session_id], ticket)
+    ahead = mine
+    for i, sid in enumerate(state["ring"]):
+        if sid == session_id:
+            continue
+        before_me = i < state["ring"].index(session_id)
+        ahead += min(len(state["queues"][sid]), mine + (1 if before_me else 0))
+    return ahead
+
+
+_job_local = threading.local()  # バックグラウンドジョブのスレッドが持つ登録元セッション
+
+
+def _current_session_id() -> str:
+    # バックグラウンドジョブのスレッドでは、ジョブを登録したセッションとして数える
+    owner = getattr(_job_local, "owner", None)
+    if owner is not None:
+        return owner
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "background"
+
+
+def rate_limit_acquire(model: str, est_tokens: int, on_wait: Callable[[str], None] = None) -> None:
+    governor = get_rate_governor()
+    session_id = _current_session_id()
+    deadline = time.monotonic() + RATE_QUEUE_TIMEOUT_SEC
+    with governor["cond"]:
+        state = _rate_state(governor, model)
+        ticket = {"tokens": min(float(est_tokens), state["tpm"])}
+        queue = state["queues"].setdefault(session_id, deque())
+        if not queue:
+            state["ring"].append(session_id)
+        queue.append(ticket)
+    shown = None
+    try:
+        while True:
+            message = None
+            with governor["cond"]:
+                _refill(state)
+                head_session = state["ring"][0]
+                is_head = head_session == session_id and state["queues"][session_id][0] is ticket
+                if is_head and state["requests"] >= 1 and state["tokens"] >= ticket["tokens"]:
+                    state["requests"] -= 1
+                    state["tokens"] -= ticket["tokens"]
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise UpstreamUnavailableError("混雑のため API 呼び出しの順番待ちが時間切れになりました。時間をおいて再実行してください")
+                if on_wait is not None:
+                    message = f"⏳ 混雑中のため順番待ちです（前に {_queue_position(state, session_id, ticket)} 件）"
+            # 表示の更新（ジョブでは SQLite への書き込み）はロックを離してから行う
+            if message is not None and message != shown:
+                on_wait(message)
+                shown = message
+            with governor["cond"]:
+                governor["cond"].wait(timeout=min(remaining, 0.5))
+    finally:
+        with governor["cond"]:
+            # 許可・タイムアウトどちらでも自分の券を外す。許可された時は次のセッションへ順番を回す
+            was_head = state["ring"][0] == session_id and queue[0] is ticket
+            del queue[_ticket_index(queue, ticket)]
+            if not queue:
+                state["ring"].remove(session_id)
+                del state["queues"][session_id]
+            elif was_head:
+                state["ring"].rotate(-1)
+            governor["cond"].notify_all()
+
+
+def rate_limit_settle(model: str, est_tokens: int, actual_tokens: int) -> None:
+    # 見積もりと実績の差を戻す（max_output_tokens まで使わなかった分を次の人に回す）
+    if actual_tokens is None:
+        return
+    governor = get_rate_governor()
+    with governor["cond"]:
+        state = _rate_state(governor, model)
+        state["tokens"] = min(state["tpm"], state["tokens"] + min(float(est_tokens), state["tpm"]) - actual_tokens)
+        governor["cond"].notify_all()
+
+
+def rate_limit_status() -> str:
+    governor = get_rate_governor()
+    with governor["cond"]:
+        parts = []
+        for model, state in governor["models"].items():
+            _refill(state)
+            waiting = sum(len(q) for q in state["queues"].values())
+            parts.append(f"{model}: 待ち{waiting}件 / 残TPM {int(state['tokens'])}")
+    return "、".join(parts) or "待ちなし"
+
+
+def _usage_total_tokens(usage: Any):
+    if usage is None:
+        return None
+    total = getattr(usage, "total_tokens", None)
+    if total is None:
+        total = (getattr(usage, "input_tokens", 0) or 0) + (getattr(usage, "output_tokens", 0) or 0)
+    return total
+
+
+# ============================================
+# 起動時間の計測とプリウォーム
+# - プロセス最初の実行の import 時間・初回描画時間を記録し、サイドバーに表示する
+# - 最初の実行の冒頭で別スレッドを起こし、クライアント生成・ワークブック復元・
+#   プロンプト用ブロックの生成を画面描画と並行して済ませる
+# ============================================
+@st.cache_resource
+def get_startup_report() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "process_started": time.time(), "first_run": None, "last_run": None, "prewarm": {}}
+
+
+def record_run_timing(import_sec: float, render_sec: float) -> None:
+    report = get_startup_report()
+    timing = {"import_sec": import_sec, "render_sec": render_sec}
+    with report["lock"]:
+        if report["first_run"] is None:
+            report["first_run"] = timing
+        report["last_run"] = timing
+
+
+def _prewarm_step(name: str, step: Callable[[], Any]) -> Any:
+    report = get_startup_report()
+    started = time.perf_counter()
+    try:
+        result = step()
+        status = f"{time.perf_counter() - started:.3f}s"
+    except Exception as e:
+        result = None
+        status = f"失敗（{type(e).__name__}）"
+    with report["lock"]:
+        report["prewarm"][name] = status
+    return result
+
+
+@st.cache_resource(show_spinner=False)
+def start_prewarm() -> threading.Thread:
+    api_key = _openai_api_key()
+
+    def run() -> None:
+        if api_key:
+            _prewarm_step("OpenAI クライアント", lambda: _openai_client(api_key))
+        data, _ = _prewarm_step("ワークブック", load_race_data) or (None, None)
+        if data is None:
+            return
+        _prewarm_step("データ表ブロック", lambda: format_data_for_prompt(data))
+        _prewarm_step("指標スコア", lambda: format_scores_for_prompt(compute_indicator_scores(data)))
+        _prewarm_step("過去データ索引", lambda: get_sheet_index(data))
+
+    thread = threading.Thread(target=run, name="prewarm", daemon=True)
+    add_script_run_ctx(thread)
+    thread.start()
+    return thread
+
+
+def startup_report_frame() -> pd.DataFrame:
+    report = get_startup_report()
+    with report["lock"]:
+        first, last, prewarm = report["first_run"], report["last_run"], dict(report["prewarm"])
+    rows = []
+    if first:
+        rows += [("初回 import", f"{first['import_sec']:.3f}s"), ("初回 描画完了", f"{first['render_sec']:.3f}s")]
+    if last:
+        rows += [("今回 import", f"{last['import_sec']:.3f}s"), ("今回 描画完了", f"{last['render_sec']:.3f}s")]
+    rows += [(f"プリウォーム: {name}", status) for name, status in prewarm.items()]
+    return pd.DataFrame(rows, columns=["項目", "時間"])
+
+# ============================================
+# LLM応答キャッシュ（SQLite・全セッション共有）
+# - (model, system_prompt, user_prompt, max_output_tokens) のハッシュをキーにする
+# - TTL切れは読み出し時に削除、件数上限を超えたら最終参照が古い順に削除（LRU）
+# - プロセス内の全セッションで共有し、再起動後もファイルから復元される
+# ============================================
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.join(".cache", "llm_cache.sqlite3"))
+LLM_CACHE_TTL_SEC = int(os.environ.get("LLM_CACHE_TTL_SEC", str(6 * 60 * 60)))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "2000"))
+
+
+@st.cache_resource
+def get_llm_cache() -> Dict[str, Any]:
+    os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)")
+    return {"conn": conn, "lock": threading.Lock(), "hits": 0, "misses": 0}
+
+
+def llm_cache_key(**request: Any) -> str:
+    payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def llm_cache_get(key: str):
+    cache = get_llm_cache()
+    now = time.time()
+    with cache["lock"]:
+        row = cache["conn"].execute(
+            "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or now - row[1] > LLM_CACHE_TTL_SEC:
+            if row is not None:
+                cache["conn"].execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            cache["misses"] += 1
+            return None
+        cache["conn"].execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+        cache["hits"] += 1
+        return row[0]
+
+
+def llm_cache_put(key: str, response: str) -> None:
+    cache = get_llm_cache()
+    now = time.time()
+    with cache["lock"]:
+        conn = cache["conn"]
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, response, now, now),
+        )
+        conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL_SEC,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if count > LLM_CACHE_MAX_ENTRIES:
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                (count - LLM_CACHE_MAX_ENTRIES,),
+            )
+
+
+def llm_cache_stats() -> Dict[str, int]:
+    cache = get_llm_cache()
+    with cache["lock"]:
+        (count,) = cache["conn"].execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        return {"hits": cache["hits"], "misses": cache["misses"], "entries": count}
+
+# ============================================
+# データ読み込み
+# - ワークブックのバイト列の SHA-256 をキーに、解析済みシートを .cache/snapshots に保存
+# - pyarrow があればシートごとに Feather（メモリマップで読み込み）、なければ pickle
+# - 同じ内容のワークブックなら新しいプロセスでも openpyxl を通さずに復元する
+# - 解析は openpyxl の read_only モードで、1つのハンドルからシートを順に行単位で読む
+#   （openpyxl は純 Python なのでスレッドに分けても GIL で速くならず、スレッドごとにブックを開くと
+#   zip と共有文字列を何度も読み込んでメモリを食う）
+# - 期待値シートは必須列を検証し、失敗したシートだけを errors に入れて他は読み込む
+# ============================================
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(".cache", "snapshots"))
+SNAPSHOT_FORMAT = "2"
+INGEST_CHUNK_ROWS = 5000
+
+STAT_SHEETS = ["年齢", "枠順", "騎手", "血統", "前走クラス", "前走レース別", "馬体重増減"]
+EXCEL_ERROR_CODES = ["#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A"]
+STAT_SHEET_COLUMNS = ["1着数", "2着数", "3着数", "着外数", "勝率", "連帯率", "複勝率", "期待値ポイント"]
+SHEET_PLACE_COLUMNS = STAT_SHEET_COLUMNS[:4]
+
+
+def _read_workbook_bytes(uploaded_file=None) -> bytes:
+    if uploaded_file is not None:
+        return uploaded_file.getvalue() if hasattr(uploaded_file, "getvalue") else uploaded_file.read()
+    with open("arima_data.xlsx", "rb") as f:
+        return f.read()
+
+
+def _header_names(header: Tuple[Any, ...]) -> List[str]:
+    # pd.read_excel と同じ列名規則（空欄は "Unnamed: i"、重複は ".1" 付き）
+    names, seen = [], {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _read_sheet_streaming(ws) -> pd.DataFrame:
+    rows = ws.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    columns = _header_names(header)
+    width = len(columns)
+    chunks: List[pd.DataFrame] = []
+    buffer: List[Tuple[Any, ...]] = []
+    for row in rows:
+        if all(v is None for v in row):
+            continue
+        buffer.append(tuple(row[:width]) + (None,) * (width - len(row)))
+        if len(buffer) >= INGEST_CHUNK_ROWS:
+            chunks.append(pd.DataFrame(buffer, columns=columns))
+            buffer = []
+    if buffer or not chunks:
+        chunks.append(pd.DataFrame(buffer, columns=columns))
+    df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    # #DIV/0! などのエラー値は pd.read_excel と同様に欠損として扱う
+    obj_cols = df.columns[df.dtypes == object]
+    if len(obj_cols):
+        df[obj_cols] = df[obj_cols].mask(df[obj_cols].isin(EXCEL_ERROR_CODES)).infer_objects()
+    return df
+
+
+def _validate_sheet(sheet: str, df: pd.DataFrame) -> None:
+    if sheet not in STAT_SHEETS:
+        return
+    missing = [c for c in STAT_SHEET_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"必須列がありません: {', '.join(missing)}")
+    if not str(df.columns[1]).startswith("出走数"):
+        raise ValueError(f"2列目は出走数である必要があります（実際: {df.columns[1]}）")
+
+
+def _parse_workbook(raw: bytes) -> Tuple[Dict[str, pd.DataFrame], Dict[str, str]]:
+    import openpyxl
+
+    wb = openpyxl.load_workbook(io.BytesIO(raw), read_only=True, data_only=True)
+    data, errors = {}, {}
+    try:
+        sheet_names = list(wb.sheetnames)
+        for sheet in sheet_names:
+            try:
+                df = _read_sheet_streaming(wb[sheet])
+                _validate_sheet(sheet, df)
+                data[sheet] = df
+            except Exception as e:
+                errors[sheet] = f"{type(e).__name__}: {e}"
+    finally:
+        wb.close()
+    for sheet in STAT_SHEETS:
+        if sheet not in sheet_names:
+            errors[sheet] = "シートがありません"
+    return data, errors
+
+
+def _feather():
+    try:
+        import pyarrow.feather as feather
+    except ImportError:  # pyarrow が無い環境では pickle スナップショットを使う
         return None
+    return feather
+
+
+def _load_snapshot(key: str):
+    pa_feather = _feather()
+    feather_dir = os.path.join(SNAPSHOT_DIR, key)
+    manifest_path = os.path.join(feather_dir, "manifest.json")
+    if pa_feather is not None and os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        data = {
+            sheet: pa_feather.read_table(os.path.join(feather_dir, f"{i}.feather"), memory_map=True).to_pandas()
+            for i, sheet in enumerate(manifest["sheets"])
+        }
+        return data, manifest["errors"]
+    pickle_path = os.path.join(SNAPSHOT_DIR, f"{key}.pkl")
+    if os.path.exists(pickle_path):
+        with open(pickle_path, "rb") as f:
+            return pickle.load(f)
+    return None
+
+
+def _save_snapshot(key: str, data: Dict[str, pd.DataFrame], errors: Dict[str, str]) -> None:
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    if _feather() is not None:
+        # 一時ディレクトリに書いてから rename し、書き込み途中のスナップショットを読ませない
+        tmp_dir = os.path.join(SNAPSHOT_DIR, f"{key}.tmp{os.getpid()}")
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            for i, df in enumerate(data.values()):
+                df.to_feather(os.path.join(tmp_dir, f"{i}.feather"))
+            with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+                json.dump({"sheets": list(data.keys()), "errors": errors}, f, ensure_ascii=False)
+            os.replace(tmp_dir, os.path.join(SNAPSHOT_DIR, key))
+            return
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if os.path.isdir(os.path.join(SNAPSHOT_DIR, key)):
+                return  # 別プロセスが先に同じスナップショットを書き終えた
+            # 列名や型が Arrow に載らないシートがあれば pickle に切り替える
+    tmp_path = os.path.join(SNAPSHOT_DIR, f"{key}.pkl.tmp{os.getpid()}")
+    with open(tmp_path, "wb") as f:
+        pickle.dump((data, errors), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, os.path.join(SNAPSHOT_DIR, f"{key}.pkl"))
+
+
+@st.cache_data(show_spinner=False)
+def _cached_workbook(key: str, _raw: bytes):
+    try:
+        snapshot = _load_snapshot(key)
+        if snapshot is not None:
+            return snapshot
+    except Exception:
+        pass  # 壊れたスナップショットは作り直す
+    data, errors = _parse_workbook(_raw)
+    try:
+        _save_snapshot(key, data, errors)
+    except OSError:
+        pass  # 書き込めない環境でも読み込み自体は続行
+    return data, errors
+
+
+class WorkbookData(dict):
+    """シート名→DataFrame の dict に、ワークブックの内容ハッシュ（key）を持たせたもの。"""
+
+    def __init__(self, sheets: Dict[str, pd.DataFrame], key: str):
+        super().__init__(sheets)
+        self.key = key
+
+
+def load_race_data(uploaded_file=None) -> Tuple[Any, Dict[str, str]]:
+    """(シート名→DataFrame, シート名→エラー内容) を返す。ブック自体が開けなければ data は None。
+
+    data は WorkbookData で、data.key にバイト列の SHA-256 を持つ（キャッシュのキーに使う）。
+    """
+    try:
+        raw = _read_workbook_bytes(uploaded_file)
+        key = hashlib.sha256(SNAPSHOT_FORMAT.encode() + raw).hexdigest()
+        data, errors = _cached_workbook(key, raw)
+        # st.cache_data は毎回コピーを返すので、内容ハッシュは読み込み時に付けておく
+        return WorkbookData(data, key), errors
+    except Exception as e:
+        return None, {"ワークブック": f"{type(e).__name__}: {e}"}
 
 
 def format_data_for_prompt(data):
     if data is None:
         return "データなし"
+    # 描画済みの表はワークブック内容ハッシュ単位で使い回す
+    return memoize_prompt_block(("data_tables", workbook_fingerprint(data)), lambda: _render_data_tables(data))
+
+
+def _render_data_tables(data):
     formatted = ""
     sheets = ["年齢", "枠順", "騎手", "血統", "前走クラス", "前走レース別", "馬体重増減"]
     titles = [
@@ -387,56 +1077,1397 @@ EVENTS_2025_STR = """【2025年の主な出来事】
    - 関連数字: 64 (第64作), 1 (1月放送開始)
 """
 
-search_query = """
+# ============================================
+# サイン数字の抽出（ルールベース）
+# - EVENTS_2025_STR の「関連数字」を正規表現で読み取り、出来事ごとの数字リストにする
+# - 数字 → 馬番・枠番の逆引き索引を作る
+#   直接（1〜16 / 1〜8）、各桁の和、16・8 で割った余り（0 は 16・8 扱い）、桁の分割（1桁・2桁の部分列）
+# - 馬番ごとに、指している出来事の数と規則の重みでサインスコアを付ける
+# ============================================
+SIGN_RULE_WEIGHTS = {"直接": 3, "桁の和": 2, "桁の分割": 1, "余り": 1}
+SIGN_NUMBER_PATTERN = re.compile(r"(\d+)\s*[（(]([^）)]*)[）)]")
+
+
+def parse_sign_events(text: str) -> List[Dict[str, Any]]:
+    events, category, current = [], None, None
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("■"):
+            category = stripped.lstrip("■ ").strip()
+        elif line.startswith("- "):
+            current = {"分類": category, "出来事": stripped[2:].strip(), "内容": "", "数字": []}
+            events.append(current)
+        elif current is not None and stripped.startswith("- 内容:"):
+            current["内容"] = stripped.split(":", 1)[1].strip()
+        elif current is not None and stripped.startswith("- 関連数字:"):
+            body = stripped.split(":", 1)[1]
+            current["数字"] = [(int(n), note.strip()) for n, note in SIGN_NUMBER_PATTERN.findall(body)]
+    return events
+
+
+def _wrap(n: int, size: int) -> int:
+    return (n - 1) % size + 1
+
+
+def sign_number_targets(n: int, size: int) -> List[Tuple[int, str]]:
+    """数字 n が指す番号（1〜size）と、その規則のリスト。"""
+    targets = []
+    if 1 <= n <= size:
+        targets.append((n, "直接"))
+        return targets
+    digits = str(n)
+    digit_sum = sum(int(d) for d in digits)
+    while digit_sum > size and digit_sum >= 10:
+        digit_sum = sum(int(d) for d in str(digit_sum))
+    digit_sum = _wrap(digit_sum, size)
+    targets.append((digit_sum, "桁の和"))
+    targets.append((_wrap(n, size), "余り"))
+    parts = {int(d) for d in digits if d != "0" and int(d) <= size}
+    parts |= {int(digits[i:i + 2]) for i in range(len(digits) - 1) if digits[i] != "0" and int(digits[i:i + 2]) <= size}
+    targets.extend((p, "桁の分割") for p in sorted(parts))
+    # 同じ番号を複数の規則が指す場合は重い方だけ残す
+    best: Dict[int, str] = {}
+    for target, rule in targets:
+        if target not in best or SIGN_RULE_WEIGHTS[rule] > SIGN_RULE_WEIGHTS[best[target]]:
+            best[target] = rule
+    return sorted(best.items())
+
+
+@st.cache_data(show_spinner=False)
+def sign_number_index(events_text: str) -> Dict[str, Any]:
+    """出来事テキストから {events, horses: 馬番→根拠, gates: 枠番→根拠, scores: 表} を作る。"""
+    events = parse_sign_events(events_text)
+    horses: Dict[int, List[Dict[str, Any]]] = {n: [] for n in HORSE_LIST_2025}
+    gates: Dict[int, List[Dict[str, Any]]] = {g: [] for g in sorted({h["枠番"] for h in HORSE_LIST_2025.values()})}
+    for event in events:
+        for number, note in event["数字"]:
+            for index, size in ((horses, len(HORSE_LIST_2025)), (gates, len(gates))):
+                for target, rule in sign_number_targets(number, size):
+                    index[target].append({"出来事": event["出来事"], "数字": number, "由来": note, "規則": rule})
+
+    rows = []
+    for number, info in HORSE_LIST_2025.items():
+        hits = horses[number] + gates[info["枠番"]]
+        # 同じ出来事からの重複は最も強い規則1つだけ数える
+        per_event: Dict[str, int] = {}
+        for hit in hits:
+            per_event[hit["出来事"]] = max(per_event.get(hit["出来事"], 0), SIGN_RULE_WEIGHTS[hit["規則"]])
+        rows.append({
+            "馬番": number,
+            "枠番": info["枠番"],
+            "馬名": info["馬名"],
+            "サインスコア": sum(per_event.values()),
+            "出来事数": len(per_event),
+            "直接一致": sum(1 for h in horses[number] if h["規則"] == "直接"),
+        })
+    rows.sort(key=lambda r: (-r["サインスコア"], -r["直接一致"], r["馬番"]))
+    return {"events": events, "horses": horses, "gates": gates, "scores": rows}
+
+
+def render_sign_numbers(index: Dict[str, Any], top: int = 5) -> str:
+    counts: Dict[int, int] = {}
+    for event in index["events"]:
+        for number, _ in event["数字"]:
+            counts[number] = counts.get(number, 0) + 1
+    repeated = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))
+    lines = ["【結論】", "繰り返し現れる数字: " + "、".join(f"{n}（{c}件）" for n, c in repeated if c > 1)]
+    lines.append("サインが集まる馬番:")
+    for row in index["scores"][:top]:
+        lines.append(f"・{row['馬番']}番 {row['馬名']}（{row['枠番']}枠）スコア {row['サインスコア']}・出来事 {row['出来事数']}件")
+    lines.append("")
+    lines.append("【理由】")
+    for row in index["scores"][:top]:
+        direct = [h for h in index["horses"][row["馬番"]] if h["規則"] == "直接"]
+        others = [h for h in index["horses"][row["馬番"]] if h["規則"] != "直接"]
+        reasons = [f"{h['出来事']}の{h['数字']}（{h['由来']}）" for h in direct]
+        reasons += [f"{h['出来事']}の{h['数字']}→{h['規則']}" for h in others[:3]]
+        lines.append(f"・{row['馬番']}番: " + "、".join(reasons))
+    return "\n".join(lines)
+
+
+# ============================================
+# データ指標スコア（ローカル計算）
+# - predict_horses の6指標のうち、過去データ表の参照で決まるものを手元で計算する
+# - E: 年齢/枠順/騎手/血統/前走クラス/前走レース別 の期待値ポイントを突き合わせて点数化
+# - F: 当日の馬体重増減が与えられたときのみ計算（未確定なら NaN）
+# - A〜D はレース内容の解釈が必要なため LLM に任せる（NaN のまま）
+# - 期待値はシート全体の平均（出走数加重）を 2.5点、その2倍以上を 5点とする
+# ============================================
+INDICATOR_COLUMNS = ["A", "B", "C", "D", "E", "F"]
+INDICATOR_NAMES = {
+    "A": "コース適性",
+    "B": "距離適性",
+    "C": "展開適性",
+    "D": "近走内容",
+    "E": "過去データ適合",
+    "F": "当日要素",
+}
+E_FACTOR_SHEETS = ["年齢", "枠順", "騎手", "血統", "前走クラス", "前走レース別"]
+
+# 前走レース名 → (クラス, 距離, 馬場)
+PREV_RACE_META = {
+    "菊花賞": ("G1", 3000, "芝"),
+    "ジャパンカップ": ("G1", 2400, "芝"),
+    "天皇賞秋": ("G1", 2000, "芝"),
+    "エリザベス女王杯": ("G1", 2200, "芝"),
+    "マイルCS": ("G1", 1600, "芝"),
+    "チャンピオンズC": ("G1", 1800, "ダート"),
+    "京都大賞典": ("G2", 2400, "芝"),
+    "アルゼンチン共和国杯": ("G2", 2500, "芝"),
+    "福島記念": ("G3", 2000, "芝"),
+}
+PREV_RACE_ALIASES = {"ジャパンC": "ジャパンカップ"}
+
+
+def _normalize_name(name: Any) -> str:
+    return re.sub(r"[\s　]+", "", str(name))
+
+
+def _parse_prev_race(prev: str) -> Tuple[str, float]:
+    m = re.match(r"^(.*?)(\d+)着$", str(prev))
+    if not m:
+        return str(prev), np.nan
+    race = PREV_RACE_ALIASES.get(m.group(1), m.group(1))
+    return race, float(m.group(2))
+
+
+def _age_bucket(sex_age: str) -> str:
+    m = re.search(r"(\d+)歳", str(sex_age))
+    if not m:
+        return ""
+    age = int(m.group(1))
+    return "7歳以上" if age >= 7 else f"{age}歳"
+
+
+def _weight_bucket(diff: float) -> str:
+    if diff >= 10:
+        return "+10kg以上"
+    if diff >= 3:
+        return "+3kg~9kg"
+    if diff > -3:
+        return "+-2kg"
+    if diff > -10:
+        return "-3kg~9kg"
+    return "-10kg以下"
+
+
+def _sheet_key_columns(df: pd.DataFrame) -> Tuple[str, str]:
+    # 区分列（先頭列）と出走数列（「出走数(2015-2024)」のように期間付きのことがある）の列名
+    runs_col = next(c for c in df.columns if str(c).startswith("出走数"))
+    return df.columns[0], runs_col
+
+
+def _sheet_lookup(df: pd.DataFrame) -> Tuple[Dict[str, float], float]:
+    # 区分列をキー、出走数列と「期待値ポイント」を引ける形にする
+    key_col, runs_col = _sheet_key_columns(df)
+    keys = df[key_col].map(_normalize_name)
+    runs = pd.to_numeric(df[runs_col], errors="coerce")
+    ev = pd.to_numeric(df["期待値ポイント"], errors="coerce")
+    valid = runs.gt(0) & ev.notna()
+    baseline = float((ev[valid] * runs[valid]).sum() / runs[valid].sum()) if valid.any() else np.nan
+    return dict(zip(keys[valid], ev[valid])), baseline
+
+
+def _ev_to_score(ev: pd.Series, baseline: float) -> pd.Series:
+    if not baseline or np.isnan(baseline):
+        return pd.Series(np.nan, index=ev.index)
+    return (ev / baseline * 2.5).clip(0, 5)
+
+
+def _horse_keys(horses: Dict[int, Dict[str, Any]]) -> pd.DataFrame:
+    # 各出走馬を、期待値シートの行キー（先頭列の値）に揃える
+    frame = pd.DataFrame.from_dict(horses, orient="index").sort_index()
+    prev = frame["前走"].map(_parse_prev_race)
+    race = prev.map(lambda x: x[0])
+    return pd.DataFrame(
+        {
+            "年齢": frame["性齢"].map(_age_bucket),
+            "枠順": frame["枠番"].map(lambda w: f"{w}枠"),
+            "騎手": frame["騎手"].map(_normalize_name),
+            "血統": frame["血統"].map(_normalize_name),
+            "前走クラス": race.map(lambda r: PREV_RACE_META.get(r, ("その他",))[0]),
+            "前走レース別": race,
+        },
+        index=frame.index,
+    )
+
+
+# ============================================
+# 出走馬 × 期待値シート の特徴量行列
+# - HORSE_LIST_2025 の各馬を全シートの該当行に結合し、数値だけの 16×N 行列にする
+# - ワークブックの内容ハッシュ単位でキャッシュし、全タブで使い回す
+# ============================================
+def workbook_fingerprint(data: Dict[str, pd.DataFrame]) -> str:
+    # load_race_data の結果は読み込み時のバイト列ハッシュをそのまま使う（毎回シートを走査しない）
+    key = getattr(data, "key", None)
+    if key is not None:
+        return key
+    h = hashlib.sha256()
+    for sheet in sorted(data or {}):
+        h.update(sheet.encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(data[sheet].astype(str), index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def _build_horse_features(data: Dict[str, pd.DataFrame], horses: Dict[int, Dict[str, Any]]) -> pd.DataFrame:
+    frame = pd.DataFrame.from_dict(horses, orient="index").sort_index()
+    keys = _horse_keys(horses)
+    prev = frame["前走"].map(_parse_prev_race)
+    meta = keys["前走レース別"].map(lambda r: PREV_RACE_META.get(r, (None, np.nan, None)))
+    grade = {"G1": 1.0, "G2": 2.0, "G3": 3.0}
+
+    features = pd.DataFrame(
+        {
+            "枠番": frame["枠番"].astype("float64"),
+            "年齢": frame["性齢"].str.extract(r"(\d+)歳", expand=False).astype("float64"),
+            "牝馬": frame["性齢"].str.startswith("牝").astype("float64"),
+            "セン馬": frame["性齢"].str.startswith("セ").astype("float64"),
+            "前走着順": prev.map(lambda x: x[1]).astype("float64"),
+            "前走格": meta.map(lambda m: grade.get(m[0], np.nan)).astype("float64"),
+            "前走距離": meta.map(lambda m: m[1]).astype("float64"),
+            "前走芝": meta.map(lambda m: np.nan if m[2] is None else float(m[2] == "芝")),
+        },
+        index=frame.index,
+    )
+    for sheet in E_FACTOR_SHEETS:
+        if data is None or sheet not in data:
+            continue
+        df = data[sheet]
+        key_col, runs_col = _sheet_key_columns(df)
+        table = pd.DataFrame(
+            {
+                "出走数": pd.to_numeric(df[runs_col], errors="coerce").values,
+                "期待値": pd.to_numeric(df["期待値ポイント"], errors="coerce").values,
+            },
+            index=df[key_col].map(_normalize_name).values,
+        )
+        # 表に無い値は「その他」行へ寄せる
+        row_keys = keys[sheet].where(keys[sheet].isin(table.index), "その他")
+        joined = table.reindex(row_keys.values)
+        features[f"出走数_{sheet}"] = joined["出走数"].values
+        features[f"期待値_{sheet}"] = joined["期待値"].where(joined["出走数"].gt(0)).values
+    features.index.name = "馬番"
+    return features
+
+
+@st.cache_data(show_spinner=False)
+def _cached_horse_features(fingerprint: str, _data: Dict[str, pd.DataFrame], _horses: Dict[int, Dict[str, Any]]):
+    return _build_horse_features(_data, _horses)
+
+
+def get_horse_features(data: Dict[str, pd.DataFrame], horses: Dict[int, Dict[str, Any]] = None) -> pd.DataFrame:
+    horses = HORSE_LIST_2025 if horses is None else horses
+    horses_hash = hashlib.sha256(json.dumps(horses, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+    return _cached_horse_features(f"{workbook_fingerprint(data)}:{horses_hash}", data, horses)
+
+
+def compute_indicator_scores(
+    data: Dict[str, pd.DataFrame],
+    horses: Dict[int, Dict[str, Any]] = None,
+    weight_changes: Dict[int, float] = None,
+) -> pd.DataFrame:
+    """全出走馬の A〜F 指標スコア（0〜5, float）。LLM 判断が必要な指標は NaN。"""
+    horses = HORSE_LIST_2025 if horses is None else horses
+    features = get_horse_features(data, horses)
+    scores = pd.DataFrame(np.nan, index=features.index, columns=INDICATOR_COLUMNS, dtype="float64")
+
+    factor_scores = {}
+    for sheet in E_FACTOR_SHEETS:
+        if f"期待値_{sheet}" not in features:
+            continue
+        _, baseline = _sheet_lookup(data[sheet])
+        factor_scores[sheet] = _ev_to_score(features[f"期待値_{sheet}"], baseline)
+    if factor_scores:
+        factors = pd.DataFrame(factor_scores)
+        scores["E"] = factors.mean(axis=1, skipna=True).round(1)
+        for sheet in factors.columns:
+            scores[f"E_{sheet}"] = factors[sheet].round(1)
+
+    if weight_changes and data is not None and "馬体重増減" in data:
+        table, baseline = _sheet_lookup(data["馬体重増減"])
+        diffs = pd.Series(weight_changes, dtype="float64").reindex(scores.index)
+        ev = diffs.map(lambda d: np.nan if np.isnan(d) else table.get(_weight_bucket(d), np.nan))
+        scores["F"] = _ev_to_score(ev.astype("float64"), baseline).round(1)
+
+    scores.insert(0, "馬名", pd.Series({k: v["馬名"] for k, v in horses.items()}))
+    return scores
+
+
+def format_scores_for_prompt(scores: pd.DataFrame) -> str:
+    # LLM へ渡す用のコンパクトな表（NaN は「-」）
+    cols = ["馬名"] + [c for c in scores.columns if c != "馬名"]
+    return scores[cols].to_csv(sep="|", na_rep="-", float_format="%.1f")
+
+
+# ============================================
+# 馬ごとの関連データ抽出（プロンプト入力の絞り込み）
+# - 全シートを丸ごと渡す代わりに、選択馬に該当する行（年齢・枠・騎手・種牡馬・前走など）と
+#   シート全体の平均（出走数加重の基準値）だけを渡す
+# - シートはカテゴリ値で索引化し、ワークブックの内容ハッシュ単位でキャッシュする
+# - Web検索結果も「その馬・騎手に触れる行」と「どの出走馬にも触れない全体情報の行」に絞る
+# ============================================
+def _sheet_baseline(df: pd.DataFrame) -> Dict[str, float]:
+    _, runs_col = _sheet_key_columns(df)
+    counts = df[[runs_col] + SHEET_PLACE_COLUMNS].apply(pd.to_numeric, errors="coerce")
+    ev = pd.to_numeric(df["期待値ポイント"], errors="coerce")
+    valid = counts[runs_col].gt(0) & ev.notna()
+    totals = counts[valid].sum()
+    runs = float(totals[runs_col])
+    wins, seconds, thirds = totals["1着数"], totals["2着数"], totals["3着数"]
+    return {
+        "出走数": runs,
+        "勝率": wins / runs if runs else np.nan,
+        "連対率": (wins + seconds) / runs if runs else np.nan,
+        "複勝率": (wins + seconds + thirds) / runs if runs else np.nan,
+        "期待値": float((ev[valid] * counts[runs_col][valid]).sum() / runs) if runs else np.nan,
+    }
+
+
+@st.cache_data(show_spinner=False)
+def _cached_sheet_index(fingerprint: str, _data: Dict[str, pd.DataFrame]) -> Dict[str, Dict[str, Any]]:
+    index = {}
+    for sheet in E_FACTOR_SHEETS + ["馬体重増減"]:
+        if sheet not in _data:
+            continue
+        df = _data[sheet]
+        key_col, runs_col = _sheet_key_columns(df)
+        values = df[[runs_col] + STAT_SHEET_COLUMNS].apply(pd.to_numeric, errors="coerce")
+        rows = {}
+        for label, (_, row) in zip(df[key_col], values.iterrows()):
+            rows[_normalize_name(label)] = {
+                "区分": str(label),
+                "出走数": row[runs_col],
+                "着別": row[SHEET_PLACE_COLUMNS].tolist(),
+                "勝率": row["勝率"],
+                "連対率": row["連帯率"],
+                "複勝率": row["複勝率"],
+                "期待値": row["期待値ポイント"],
+            }
+        index[sheet] = {"rows": rows, "baseline": _sheet_baseline(df)}
+    return index
+
+
+def get_sheet_index(data: Dict[str, pd.DataFrame]) -> Dict[str, Dict[str, Any]]:
+    return _cached_sheet_index(workbook_fingerprint(data), data)
+
+
+def _fmt_rate(x: float) -> str:
+    return "-" if x is None or np.isnan(x) else f"{x:.1%}"
+
+
+def build_horse_context(
+    data: Dict[str, pd.DataFrame],
+    horse_info: Dict[str, Any],
+    sheets: List[str],
+    weight_change: float = None,
+) -> str:
+    if data is None:
+        return "データなし"
+    index = get_sheet_index(data)
+    keys = _horse_keys({horse_info["馬番"]: horse_info}).iloc[0].to_dict()
+    if weight_change is not None:
+        keys["馬体重増減"] = _weight_bucket(weight_change)
+
+    lines = []
+    for sheet in sheets:
+        if sheet not in index:
+            continue
+        rows, base = index[sheet]["rows"], index[sheet]["baseline"]
+        key = keys.get(sheet)
+        lines.append(f"【{sheet}】")
+        if key is None:
+            lines.append("該当: （当日未発表）")
+        else:
+            row = rows.get(key) or rows.get("その他")
+            if row is None:
+                lines.append(f"該当: {key}（データなし）")
+            else:
+                label = row["区分"] if key in rows else f"{key}→{row['区分']}"
+                ev = "-" if np.isnan(row["期待値"]) else f"{row['期待値']:.2f}"
+                lines.append(
+                    f"該当: {label} | 出走数{row['出走数']:.0f} | "
+                    f"1着{row['着別'][0]:.0f} 2着{row['着別'][1]:.0f} 3着{row['着別'][2]:.0f} | "
+                    f"勝率{_fmt_rate(row['勝率'])} 連対率{_fmt_rate(row['連対率'])} 複勝率{_fmt_rate(row['複勝率'])} | "
+                    f"期待値{ev}"
+                )
+        lines.append(
+            f"全体平均: 出走数{base['出走数']:.0f} | 勝率{_fmt_rate(base['勝率'])} "
+            f"連対率{_fmt_rate(base['連対率'])} 複勝率{_fmt_rate(base['複勝率'])} | 期待値{base['期待値']:.2f}"
+        )
+    return "\n".join(lines)
+
+
+def slice_search_for_horse(search_text: str, horse_info: Dict[str, Any]) -> str:
+    if not search_text:
+        return search_text
+    own = {horse_info["馬名"], _normalize_name(horse_info["騎手"])}
+    others = {h["馬名"] for h in HORSE_LIST_2025.values() if h["馬名"] != horse_info["馬名"]}
+    kept = []
+    for line in search_text.splitlines():
+        text = _normalize_name(line)
+        if line.startswith("【") or any(k in text for k in own) or not any(k in text for k in others):
+            kept.append(line)
+    return "\n".join(kept)
+
+
+# ============================================
+# 買い目エンジン（全組合せの列挙・的中確率・期待値）
+# - 単勝確率から 1〜3着の順序付き確率テンソル P3[i, j, k] を作り、全券種をそこから導く
+#   ・harville: 2着・3着も単勝確率を残り馬で正規化
+#   ・henery:   2着・3着は p^γ（γ=0.81, 0.65）で人気馬の寄与を割り引く Stern/Henery 型
+# - 馬連120・ワイド120・三連複560・三連単3360 通りを NumPy で一括計算する
+# - 単勝オッズ（市場確率）があれば控除率から推定オッズを出し、期待値順に並べる
+#   （オッズが無いときは期待値を出せないため的中確率順）
+# ============================================
+BET_TYPES = ["馬連", "ワイド", "三連複", "三連単"]
+BET_TAKEOUT = {"馬連": 0.225, "ワイド": 0.225, "三連複": 0.25, "三連単": 0.275}
+HENERY_GAMMAS = (0.81, 0.65)
+
+
+def _power_normalize(p: np.ndarray, gamma: float) -> np.ndarray:
+    w = np.power(p, gamma)
+    return w / w.sum()
+
+
+def finish_order_probabilities(win_probs: np.ndarray, model: str = "harville") -> np.ndarray:
+    p = np.asarray(win_probs, dtype="float64")
+    p = p / p.sum()
+    if model == "harville":
+        q = r = p
+    elif model == "henery":
+        q, r = (_power_normalize(p, g) for g in HENERY_GAMMAS)
+    else:
+        raise ValueError(f"unknown model: {model}")
+
+    n = len(p)
+    idx = np.arange(n)
+    distinct = (
+        (idx[:, None, None] != idx[None, :, None])
+        & (idx[:, None, None] != idx[None, None, :])
+        & (idx[None, :, None] != idx[None, None, :])
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        second = q[None, :, None] / (1.0 - q[:, None, None])
+        third = r[None, None, :] / (1.0 - r[:, None, None] - r[None, :, None])
+        p3 = p[:, None, None] * second * third
+    return np.where(distinct & np.isfinite(p3), p3, 0.0)
+
+
+def bet_probabilities(p3: np.ndarray) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """券種ごとに (組合せ[馬のindex], 的中確率) を返す。"""
+    n = p3.shape[0]
+    top2 = p3.sum(axis=2)
+    top3_set = sum(p3.transpose(perm) for perm in itertools.permutations(range(3)))
+    pairs = np.array(list(itertools.combinations(range(n), 2)))
+    triples = np.array(list(itertools.combinations(range(n), 3)))
+    ordered = np.array(list(itertools.permutations(range(n), 3)))
+    a, b = pairs.T
+    return {
+        "馬連": (pairs, top2[a, b] + top2[b, a]),
+        "ワイド": (pairs, top3_set.sum(axis=2)[a, b]),
+        "三連複": (triples, top3_set[tuple(triples.T)]),
+        "三連単": (ordered, p3[tuple(ordered.T)]),
+    }
+
+
+def rank_tickets(
+    win_probs: np.ndarray,
+    numbers: List[int] = None,
+    market_probs: np.ndarray = None,
+    model: str = "harville",
+) -> pd.DataFrame:
+    numbers = np.asarray(sorted(HORSE_LIST_2025) if numbers is None else numbers)
+    model_bets = bet_probabilities(finish_order_probabilities(win_probs, model))
+    market_bets = None
+    if market_probs is not None:
+        market_bets = bet_probabilities(finish_order_probabilities(market_probs, "harville"))
+
+    frames = []
+    for bet_type in BET_TYPES:
+        combos, prob = model_bets[bet_type]
+        horses = numbers[combos]
+        sep = "→" if bet_type == "三連単" else "-"
+        odds = np.full(len(prob), np.nan)
+        if market_bets is not None:
+            with np.errstate(divide="ignore"):
+                odds = (1.0 - BET_TAKEOUT[bet_type]) / market_bets[bet_type][1]
+        frames.append(
+            pd.DataFrame(
+                {
+                    "券種": bet_type,
+                    "組合せ": [sep.join(map(str, h)) for h in horses],
+                    "馬番": [tuple(int(x) for x in h) for h in horses],
+                    "的中確率": prob,
+                    "推定オッズ": odds,
+                    "期待値": prob * odds,
+                }
+            )
+        )
+    tickets = pd.concat(frames, ignore_index=True)
+    return tickets.sort_values(["券種", "期待値", "的中確率"], ascending=[True, False, False], na_position="last")
+
+
+def win_probabilities_from_scores(scores: pd.DataFrame, temperature: float = 1.0) -> np.ndarray:
+    # 計算済み指標の平均をそのまま強さとみなし、softmax で単勝確率にする
+    strength = scores[INDICATOR_COLUMNS].mean(axis=1, skipna=True).fillna(0.0).to_numpy()
+    z = (strength - strength.max()) / temperature
+    w = np.exp(z)
+    return w / w.sum()
+
+
+def parse_win_odds(text: str, numbers: List[int] = None) -> np.ndarray:
+    """「1:12.5, 2:30.1 ...」形式の単勝オッズを市場確率にする。全馬揃っていなければ None。"""
+    numbers = sorted(HORSE_LIST_2025) if numbers is None else numbers
+    odds = {int(k): float(v) for k, v in re.findall(r"(\d+)\s*[:：=]\s*(\d+(?:\.\d+)?)", text or "")}
+    if not odds or any(odds.get(n, 0) <= 0 for n in numbers):
+        return None
+    inv = np.array([1.0 / odds[n] for n in numbers])
+    return inv / inv.sum()
+
+
+def format_tickets_for_prompt(tickets: pd.DataFrame, top: int = 5) -> str:
+    lines = []
+    for bet_type in BET_TYPES:
+        for _, t in tickets[tickets["券種"] == bet_type].head(top).iterrows():
+            line = f"{bet_type} {t['組合せ']} 的中確率{t['的中確率']:.1%}"
+            if not np.isnan(t["期待値"]):
+                line += f" 推定オッズ{t['推定オッズ']:.1f}倍 期待値{t['期待値']:.2f}"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+# ============================================
+# 資金配分オプティマイザ（安全型 / バランス型 / 攻め型）
+# - 結果空間は 1〜3着の順序付き 3360 通り。各券は「どの結果で当たるか」の添字集合で表す
+# - 予算を ¥100 単位で1口ずつ、期待対数資産 E[log(W)] の増分が最大の券に積み増す（貪欲法）
+#   点数が max_tickets に達したら、以降は購入済みの券にだけ積み増す
+# - W = 手元資金 + 払戻。予算が資金全体に占める割合（kelly_fraction）が大きいほど
+#   全損を強く嫌って的中率重視に、小さいほど期待値重視になる（分数ケリー）
+# - オッズ未入力時は控除率込みの推定オッズ（モデル確率ベース）で配分する
+# - 安全型 → バランス型 → 攻め型 の順に的中確率が下がり、払戻の標準偏差が上がるように
+#   点数と kelly_fraction を決めている（推定オッズでは券種間の期待値が揃うため、的中率は主に点数で決まる）
+# ============================================
+RISK_PROFILES = {
+    "安全型": {"bet_types": ["ワイド", "馬連"], "kelly_fraction": 0.9, "max_tickets": 16},
+    "バランス型": {"bet_types": ["馬連", "ワイド", "三連複"], "kelly_fraction": 0.7, "max_tickets": 10},
+    "攻め型": {"bet_types": ["三連複", "三連単"], "kelly_fraction": 0.05, "max_tickets": 20},
+}
+
+
+def _combo_keys(combos: np.ndarray, n: int) -> np.ndarray:
+    keys = np.zeros(len(combos), dtype=np.int64)
+    for col in range(combos.shape[1]):
+        keys = keys * n + combos[:, col]
+    return keys
+
+
+def _group_hits(ticket_ids: np.ndarray, outcome_ids: np.ndarray, n_tickets: int) -> np.ndarray:
+    # 各券の的中結果数は券種ごとに一定なので、券の添字で並べて (券数, 的中結果数) に畳む
+    order = np.argsort(ticket_ids, kind="stable")
+    return outcome_ids[order].reshape(n_tickets, -1)
+
+
+def ticket_hit_index(n: int) -> Tuple[np.ndarray, Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """順序付き結果 (O×3) と、券種ごとの (組合せ, 的中結果の添字行列) を返す。"""
+    outcomes = np.array(list(itertools.permutations(range(n), 3)))
+    outcome_ids = np.arange(len(outcomes))
+    pairs = np.array(list(itertools.combinations(range(n), 2)))
+    triples = np.array(list(itertools.combinations(range(n), 3)))
+    pair_keys = _combo_keys(pairs, n)
+    triple_keys = _combo_keys(triples, n)
+
+    top2 = np.sort(outcomes[:, :2], axis=1)
+    umaren = np.searchsorted(pair_keys, _combo_keys(top2, n))
+    wide_pairs = np.concatenate([np.sort(outcomes[:, c], axis=1) for c in ([0, 1], [0, 2], [1, 2])])
+    wide = np.searchsorted(pair_keys, _combo_keys(wide_pairs, n))
+    sanrenpuku = np.searchsorted(triple_keys, _combo_keys(np.sort(outcomes, axis=1), n))
+
+    return outcomes, {
+        "馬連": (pairs, _group_hits(umaren, outcome_ids, len(pairs))),
+        "ワイド": (pairs, _group_hits(wide, np.tile(outcome_ids, 3), len(pairs))),
+        "三連複": (triples, _group_hits(sanrenpuku, outcome_ids, len(triples))),
+        "三連単": (outcomes, outcome_ids[:, None]),
+    }
+
+
+def optimize_budget(
+    win_probs: np.ndarray,
+    numbers: List[int] = None,
+    market_probs: np.ndarray = None,
+    model: str = "harville",
+    budget: int = 10000,
+    unit: int = 100,
+    profiles: Dict[str, Dict[str, Any]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    numbers = np.asarray(sorted(HORSE_LIST_2025) if numbers is None else numbers)
+    profiles = RISK_PROFILES if profiles is None else profiles
+    p3 = finish_order_probabilities(win_probs, model)
+    market_bets = bet_probabilities(
+        finish_order_probabilities(win_probs if market_probs is None else market_probs, "harville")
+    )
+    outcomes, hit_index = ticket_hit_index(len(numbers))
+    p_outcome = p3[tuple(outcomes.T)]
+
+    results = {}
+    for name, profile in profiles.items():
+        reserve = max(budget * (1.0 / profile["kelly_fraction"] - 1.0), unit)
+        wealth = np.full(len(outcomes), reserve)
+        blocks = []
+        for bet_type in profile["bet_types"]:
+            combos, hits = hit_index[bet_type]
+            with np.errstate(divide="ignore"):
+                payout = unit * (1.0 - BET_TAKEOUT[bet_type]) / market_bets[bet_type][1]
+            payout = np.where(np.isfinite(payout), payout, 0.0)
+            blocks.append((bet_type, combos, hits, p_outcome[hits], payout, np.zeros(len(combos))))
+
+        for _ in range(budget // unit):
+            full = sum(int(np.count_nonzero(block[5])) for block in blocks) >= profile["max_tickets"]
+            gains = [
+                np.where(
+                    full & (stakes == 0),
+                    -np.inf,
+                    (p_hit * (np.log(wealth[hits] + pay[:, None]) - np.log(wealth[hits]))).sum(axis=1),
+                )
+                for _, _, hits, p_hit, pay, stakes in blocks
+            ]
+            b = int(np.argmax([g.max() for g in gains]))
+            t = int(np.argmax(gains[b]))
+            _, _, hits, _, pay, stakes = blocks[b]
+            stakes[t] += unit
+            wealth[hits[t]] += pay[t]
+
+        rows = []
+        for bet_type, combos, _, _, pay, stakes in blocks:
+            sep = "→" if bet_type == "三連単" else "-"
+            for t in np.flatnonzero(stakes):
+                rows.append(
+                    {
+                        "券種": bet_type,
+                        "組合せ": sep.join(map(str, numbers[combos[t]])),
+                        "金額": int(stakes[t]),
+                        "推定オッズ": pay[t] / unit,
+                    }
+                )
+        returns = wealth - reserve
+        expected = float(p_outcome @ returns)
+        variance = float(p_outcome @ returns**2 - expected**2)
+        results[name] = {
+            "tickets": pd.DataFrame(rows, columns=["券種", "組合せ", "金額", "推定オッズ"]),
+            "hit_prob": float(p_outcome[returns > 0].sum()),
+            "expected_return": expected,
+            "variance": variance,
+            "std": variance**0.5,
+        }
+    return results
+
+
+def format_allocation_for_prompt(allocation: Dict[str, Dict[str, Any]], budget: int) -> str:
+    lines = []
+    for name, res in allocation.items():
+        lines.append(
+            f"{name}（予算{budget:,}円）: 的中確率{res['hit_prob']:.1%} "
+            f"期待払戻{res['expected_return']:,.0f}円 標準偏差{res['std']:,.0f}円"
+        )
+        for _, t in res["tickets"].iterrows():
+            lines.append(f"  {t['券種']} {t['組合せ']} {t['金額']:,}円")
+    return "\n".join(lines)
+
+
+# ============================================
+# 買い目カバレッジ（ビットセット）
+# - 1 枚の券を「1〜3着の順序付き 3360 通りのうち、どれで当たるか」のビット列（np.packbits で 420 バイト）で表す
+# - 文章の買い目（「三連複 5-9-13」「馬連 5-2,9,13」「ワイドBOX 2,5,9」など）を読み取り、
+#   戦略（安全型 / バランス型 / 攻め型）ごとに重複を除いて並べる
+# - 戦略のビット列は券の OR、戦略間の重なりは AND。カバー数・的中確率は
+#   (戦略数 × 3360) の行列と結果の確率ベクトルの積で一括計算する
+# ============================================
+TICKET_RULES = {
+    # 券種: (頭数, 何着以内, 着順どおりか)
+    "単勝": (1, 1, True),
+    "複勝": (1, 3, False),
+    "馬連": (2, 2, False),
+    "馬単": (2, 2, True),
+    "ワイド": (2, 3, False),
+    "三連複": (3, 3, False),
+    "三連単": (3, 3, True),
+}
+TICKET_COLUMNS = ["戦略", "券種", "組合せ", "馬番"]
+_TICKET_MARKER = re.compile("|".join(list(RISK_PROFILES) + list(TICKET_RULES) + ["3連複", "3連単", "枠連"]))
+_TICKET_NOISE = re.compile(r"[（(][^）)]*[）)]|\d[\d,]*(?:\.\d+)?\s*(?:円|%|倍|点|口|着|番人気|頭|年|月|日|歳|m)")
+_TICKET_RUN = re.compile(r"\d{1,2}(?:\s*[-=→>,・]\s*\d{1,2})*")
+# 着順・列ごとのフォーメーション（「1着:5 2着:9,13 3着:2,9,13」「1頭目:5 2頭目:...」）
+_TICKET_POSITION = re.compile(r"(\d)\s*(?:着|頭目|列目)\s*:?\s*(\d{1,2}(?:\s*[,・]\s*\d{1,2})*)")
+
+
+def outcome_space(n: int) -> np.ndarray:
+    # itertools.permutations の順 = ticket_hit_index / finish_order_probabilities と同じ並び
+    return np.array(list(itertools.permutations(range(n), 3)))
+
+
+def outcome_probabilities(win_probs: np.ndarray, model: str = "harville") -> np.ndarray:
+    p3 = finish_order_probabilities(win_probs, model)
+    return p3[tuple(outcome_space(len(win_probs)).T)]
+
+
+def _ticket_row(strategy: str, bet_type: str, horses) -> Dict[str, Any]:
+    horses = tuple(int(h) for h in horses)
+    if not TICKET_RULES[bet_type][2]:
+        horses = tuple(sorted(horses))
+    sep = "→" if TICKET_RULES[bet_type][2] else "-"
+    return {"戦略": strategy, "券種": bet_type, "組合せ": sep.join(map(str, horses)), "馬番": horses}
+
+
+def _expand_positions(positions: List[List[str]], size: int, ordered: bool) -> List[Tuple[int, ...]]:
+    if len(positions) == size:
+        # フォーメーション（各着の候補の直積。同じ馬を含む組合せは除く）
+        combos = [tuple(int(x) for x in c) for c in itertools.product(*positions)]
+        return [c for c in combos if len(set(c)) == size]
+    if 1 < len(positions) < size and all(len(p) == 1 for p in positions[:-1]):
+        # 軸流し（「5-2,9,13」= 5 を軸に相手 2・9・13 から残りを選ぶ。着順ありなら軸は先頭から順に固定）
+        axes = tuple(int(p[0]) for p in positions[:-1])
+        partners = [int(x) for x in dict.fromkeys(positions[-1]) if int(x) not in axes]
+        pick = itertools.permutations if ordered else itertools.combinations
+        return [axes + rest for rest in pick(partners, size - len(axes))]
+    return []
+
+
+def _expand_run(run: str, size: int, ordered: bool, box: bool) -> List[Tuple[int, ...]]:
+    if box:
+        horses = sorted({int(x) for x in re.findall(r"\d+", run)})
+        return list((itertools.permutations if ordered else itertools.combinations)(horses, size))
+    positions = [re.findall(r"\d+", part) for part in re.split(r"[-=→>]", run)]
+    if size == 1 and len(positions) == 1:
+        return [(int(x),) for x in positions[0]]
+    combos = _expand_positions(positions, size, ordered)
+    if combos or len(positions) == size:
+        return combos
+    # 「5-9, 5-13」のように読点・カンマで複数の券が並んでいる
+    parts = re.split(r"[,・]", run)
+    if len(parts) == 1:
+        return []
+    return [combo for part in parts for combo in _expand_run(part, size, ordered, False)]
+
+
+def parse_ticket_text(text: str, numbers: List[int] = None) -> Tuple[pd.DataFrame, List[str]]:
+    """買い目の文章を {戦略, 券種, 組合せ, 馬番} の表にする（同じ戦略内の重複は除く）。
+
+    2つ目の戻り値は、券種の後ろに馬番らしき数字があるのに券にできなかった部分（カバー率の過小評価に注意）。
+    """
+    valid = set(sorted(HORSE_LIST_2025) if numbers is None else numbers)
+    rows, unparsed, strategy = [], [], "その他"
+    for line in unicodedata.normalize("NFKC", text or "").splitlines():
+        line = re.sub(r"(\d)番(?!人気)", r"\1", line)
+        marks = list(_TICKET_MARKER.finditer(line))
+        for i, mark in enumerate(marks):
+            name = mark.group().replace("3連", "三連")
+            if name in RISK_PROFILES:
+                strategy = name
+                continue
+            end = marks[i + 1].start() if i + 1 < len(marks) else len(line)
+            segment = line[mark.end():end]
+            if name not in TICKET_RULES:
+                # 枠連は馬番の組合せに直せない。数字が続いていれば読み取れなかった券として返す
+                runs = _TICKET_RUN.findall(_TICKET_NOISE.sub(" ", segment))
+                unparsed += [f"{strategy} {name} {run.strip()}" for run in runs]
+                continue
+            size, _, ordered = TICKET_RULES[name]
+            groups = []
+            labelled = _TICKET_POSITION.findall(segment)
+            if len(labelled) >= 2:
+                positions = [re.findall(r"\d+", horses) for _, horses in sorted(labelled)]
+                groups.append((" ".join(f"{n}:{h}" for n, h in labelled), _expand_positions(positions, size, ordered)))
+                segment = _TICKET_POSITION.sub(" ", segment)
+            segment = _TICKET_NOISE.sub(" ", segment)
+            box = "BOX" in segment.upper() or "ボックス" in segment
+            groups += [(run, _expand_run(run, size, ordered, box)) for run in _TICKET_RUN.findall(segment)]
+            for run, combos in groups:
+                kept = [combo for combo in combos if set(combo) <= valid]
+                if not combos or len(kept) < len(combos):
+                    unparsed.append(f"{strategy} {name} {run.strip()}")
+                rows += [_ticket_row(strategy, name, combo) for combo in kept]
+    tickets = pd.DataFrame(rows, columns=TICKET_COLUMNS)
+    return tickets.drop_duplicates(["戦略", "券種", "組合せ"], ignore_index=True), unparsed
+
+
+def allocation_tickets(allocation: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+    """資金配分オプティマイザの結果を parse_ticket_text と同じ表にする。"""
+    rows = [
+        _ticket_row(name, t["券種"], re.split(r"[-→]", t["組合せ"]))
+        for name, res in allocation.items()
+        for _, t in res["tickets"].iterrows()
+    ]
+    return pd.DataFrame(rows, columns=TICKET_COLUMNS)
+
+
+def ticket_bitsets(tickets: pd.DataFrame, numbers: List[int] = None) -> np.ndarray:
+    """各券の的中結果を (券数, 420) の uint8 ビット列にする。"""
+    numbers = sorted(HORSE_LIST_2025) if numbers is None else list(numbers)
+    outcomes = outcome_space(len(numbers))
+    position = {h: i for i, h in enumerate(numbers)}
+    hits = np.zeros((len(tickets), len(outcomes)), dtype=bool)
+    for bet_type, group in tickets.groupby("券種", sort=False):
+        size, top, ordered = TICKET_RULES[bet_type]
+        h = np.array([[position[x] for x in combo] for combo in group["馬番"]])
+        if ordered:
+            match = (outcomes[None, :, :size] == h[:, None, :]).all(axis=2)
+        else:
+            match = (outcomes[None, :, None, :top] == h[:, None, :, None]).any(axis=3).all(axis=2)
+        hits[tickets.index.get_indexer(group.index)] = match
+    return np.packbits(hits, axis=1)
+
+
+def strategy_bitsets(tickets: pd.DataFrame, bits: np.ndarray) -> Tuple[List[str], np.ndarray]:
+    """戦略ごとに券のビット列を OR でまとめる。"""
+    names = list(dict.fromkeys(tickets["戦略"]))
+    if not names:
+        return names, np.zeros((0, bits.shape[1]), dtype=np.uint8)
+    codes = pd.Categorical(tickets["戦略"], categories=names).codes
+    order = np.argsort(codes, kind="stable")
+    starts = np.searchsorted(codes[order], np.arange(len(names)))
+    return names, np.bitwise_or.reduceat(bits[order], starts, axis=0)
+
+
+def coverage_stats(bits: np.ndarray, p_outcome: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(戦略数, 420) のビット列から、カバーする結果の数と的中確率を一括で返す。"""
+    covered = np.unpackbits(bits, axis=-1, count=len(p_outcome))
+    return covered.sum(axis=-1), covered @ p_outcome
+
+
+def coverage_report(tickets: pd.DataFrame, p_outcome: np.ndarray, numbers: List[int] = None) -> Dict[str, pd.DataFrame]:
+    """戦略ごとのカバー率・的中確率、戦略間で共有する的中確率、複数の戦略に重複する券を返す。"""
+    bits = ticket_bitsets(tickets, numbers)
+    names, strat = strategy_bitsets(tickets, bits)
+    union = np.bitwise_or.reduce(strat, axis=0, keepdims=True) if names else strat
+    counts, probs = coverage_stats(np.concatenate([strat, union]), p_outcome)
+
+    per_strategy = tickets.groupby("戦略", sort=False)["組合せ"].size().reindex(names)
+    summary = pd.DataFrame(
+        {
+            "戦略": names + ["合計（重複除く）"],
+            "点数": list(per_strategy) + [tickets[["券種", "組合せ"]].drop_duplicates().shape[0]],
+            "カバー結果数": counts,
+            "カバー率": counts / len(p_outcome),
+            "的中確率": probs,
+        }
+    )
+
+    covered = np.unpackbits(strat, axis=-1, count=len(p_outcome)).astype("float64")
+    overlap = pd.DataFrame(covered @ (covered * p_outcome).T, index=names, columns=names)
+
+    shared = tickets.groupby(["券種", "組合せ"], sort=False)["戦略"].agg(list)
+    duplicates = shared[shared.map(len) > 1].reset_index()
+    duplicates["戦略"] = duplicates["戦略"].map(" / ".join)
+    return {"summary": summary, "overlap": overlap, "duplicates": duplicates}
+
+
+def render_ticket_coverage(text: str, p_outcome: np.ndarray, compare: pd.DataFrame = None) -> None:
+    tickets, unparsed = parse_ticket_text(text)
+    if unparsed:
+        st.warning("読み取れなかった買い目があります（カバー率・的中確率には含まれていません）: " + " / ".join(unparsed))
+    if tickets.empty:
+        st.caption("買い目を読み取れませんでした")
+        return
+    report = coverage_report(tickets, p_outcome)
+    st.caption("戦略ごとのカバー率（3360通り中）と的中確率")
+    st.dataframe(report["summary"], use_container_width=True, hide_index=True)
+    st.caption("戦略間で共有する的中確率（対角は各戦略の的中確率）")
+    st.dataframe(report["overlap"], use_container_width=True)
+    if not report["duplicates"].empty:
+        st.caption("複数の戦略に重複している券")
+        st.dataframe(report["duplicates"], use_container_width=True, hide_index=True)
+    if compare is not None and not compare.empty:
+        st.caption("比較: 資金配分オプティマイザの買い目")
+        st.dataframe(coverage_report(compare, p_outcome)["summary"], use_container_width=True, hide_index=True)
+    st.caption("読み取った買い目")
+    st.dataframe(tickets.drop(columns=["馬番"]), use_container_width=True, hide_index=True)
+
+
+# ============================================
+# 画面用の計算結果（再描画ごとに作り直さない）
+# - 指標スコア → 単勝確率、買い目の順位付け、資金配分を st.cache_data に載せる
+# - キーはワークブック指紋・着順確率モデル・単勝オッズの入力・予算（DataFrame 自体はハッシュしない）
+# ============================================
+@st.cache_data(show_spinner=False, max_entries=8)
+def indicator_view(workbook_key: str, _data: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
+    scores = compute_indicator_scores(_data)
+    return {"scores": scores, "win_probs": win_probabilities_from_scores(scores)}
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def ticket_view(workbook_key: str, model: str, odds_text: str, _win_probs: np.ndarray) -> Dict[str, Any]:
+    market_probs = parse_win_odds(odds_text)
+    return {
+        "market_probs": market_probs,
+        "tickets": rank_tickets(_win_probs, market_probs=market_probs, model=model),
+        "p_outcome": outcome_probabilities(_win_probs, model),
+    }
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def allocation_view(
+    workbook_key: str, model: str, odds_text: str, budget: int, _win_probs: np.ndarray
+) -> Dict[str, Dict[str, Any]]:
+    return optimize_budget(_win_probs, market_probs=parse_win_odds(odds_text), model=model, budget=budget)
+
+
+# ============================================
+# レースシミュレータ（Plackett-Luce / Thurstone モンテカルロ）
+# - plackett_luce: log(単勝確率) + Gumbel ノイズの降順 = Plackett-Luce の着順（Gumbel-max）
+# - thurstone:     log(単勝確率) + 正規ノイズ（sd=noise_sd）の降順
+# - 1〜3着の順序付き組合せを bincount で数え、単勝・連対・複勝・ペア・トリオ確率を導く
+# - 大規模実行は spawn したプロセスに分割（SeedSequence で各プロセスの乱数列を分岐）
+#   seed・n_races・n_workers が同じなら結果は再現する
+# - 子プロセスは起動時にモジュールを読み直すため数秒かかる。races/sec は計算時間だけで出し、
+#   プロセス起動・結果の受け渡しにかかった時間は startup_sec として別に返す
+# ============================================
+SIM_MODELS = ["plackett_luce", "thurstone"]
+SIM_WORKER_TIMEOUT_SEC = float(os.environ.get("SIM_WORKER_TIMEOUT_SEC", "300"))
+
+
+def _simulate_chunk(
+    log_strength: np.ndarray, model: str, n_races: int, seed: Any, batch: int, noise_sd: float
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    n = len(log_strength)
+    counts = np.zeros(n**3, dtype=np.int64)
+    done = 0
+    while done < n_races:
+        m = min(batch, n_races - done)
+        if model == "plackett_luce":
+            perf = log_strength + rng.gumbel(size=(m, n))
+        elif model == "thurstone":
+            perf = log_strength + rng.standard_normal((m, n)) * noise_sd
+        else:
+            raise ValueError(f"unknown model: {model}")
+        top = np.argpartition(-perf, 3, axis=1)[:, :3]
+        order = np.take_along_axis(top, np.argsort(-np.take_along_axis(perf, top, axis=1), axis=1), axis=1)
+        counts += np.bincount(order[:, 0] * n * n + order[:, 1] * n + order[:, 2], minlength=n**3)
+        done += m
+    return counts
+
+
+def _simulate_worker(queue, index: int, args) -> None:
+    started = time.perf_counter()
+    counts = _simulate_chunk(*args)
+    queue.put((index, counts, time.perf_counter() - started))
+
+
+def _simulate_in_processes(jobs: List[Tuple[Any, ...]], timeout: float) -> Tuple[np.ndarray, float]:
+    """(着順の度数, 最も遅かった子プロセスの計算時間) を返す。"""
+    # spawn 方式（スレッドを持つ Streamlit サーバーから fork すると、子がロックを引き継いで固まることがある）
+    # 子プロセスはこのスクリプトを読み直してモジュール直下の _simulate_worker を呼ぶ
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=_simulate_worker, args=(queue, i, job), daemon=True) for i, job in enumerate(jobs)]
+    deadline = time.monotonic() + timeout
+    results: Dict[int, Tuple[np.ndarray, float]] = {}
+    try:
+        for proc in procs:
+            proc.start()
+        while len(results) < len(procs):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"シミュレーションの子プロセスが {timeout:.0f} 秒以内に終わりませんでした")
+            try:
+                index, counts, compute_sec = queue.get(timeout=min(remaining, 1.0))
+                results[index] = (counts, compute_sec)
+            except Empty:
+                failed = [p.exitcode for p in procs if p.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError(f"シミュレーションの子プロセスが異常終了しました（exit code {failed}）")
+        return sum(results[i][0] for i in range(len(procs))), max(sec for _, sec in results.values())
+    finally:
+        for proc in procs:
+            if proc.pid is None:
+                continue  # 起動前に失敗した分
+            if proc.is_alive():
+                proc.terminate()
+            proc.join(timeout=5)
+        queue.close()
+
+
+def simulate_race(
+    win_probs: np.ndarray,
+    n_races: int = 1_000_000,
+    model: str = "plackett_luce",
+    seed: int = 2025,
+    n_workers: int = 1,
+    batch: int = 100_000,
+    noise_sd: float = 1.0,
+) -> Dict[str, Any]:
+    p = np.asarray(win_probs, dtype="float64")
+    log_strength = np.log(np.clip(p / p.sum(), 1e-12, None))
+    n = len(p)
+    n_workers = max(1, min(n_workers, os.cpu_count() or 1))
+    shares = [n_races // n_workers + (1 if w < n_races % n_workers else 0) for w in range(n_workers)]
+    seeds = np.random.SeedSequence(seed).spawn(n_workers)
+    jobs = [(log_strength, model, share, sd, batch, noise_sd) for share, sd in zip(shares, seeds)]
+
+    wall_started = time.perf_counter()
+    counts, worker_error = None, None
+    if n_workers > 1:
+        try:
+            counts, elapsed = _simulate_in_processes(jobs, SIM_WORKER_TIMEOUT_SEC)
+        except Exception as e:
+            # 子プロセスが使えない・落ちた・時間切れの場合は、同じ乱数列のままこのプロセスで計算する
+            worker_error = f"{type(e).__name__}: {e}"
+            n_workers = 1
+    if counts is None:
+        started = time.perf_counter()
+        counts = sum(_simulate_chunk(*job) for job in jobs)
+        elapsed = time.perf_counter() - started
+    # 計算以外にかかった時間（子プロセスの起動・受け渡し、失敗した並列実行）
+    startup = time.perf_counter() - wall_started - elapsed
+
+    p3 = counts.reshape(n, n, n) / n_races
+    top3_set = sum(p3.transpose(perm) for perm in itertools.permutations(range(3)))
+    top2 = p3.sum(axis=2)
+    return {
+        "n_races": n_races,
+        "n_workers": n_workers,
+        "worker_error": worker_error,
+        "elapsed_sec": elapsed,
+        "startup_sec": max(startup, 0.0),
+        "races_per_sec": n_races / elapsed if elapsed > 0 else float("inf"),
+        "p3": p3,
+        "win": p3.sum(axis=(1, 2)),
+        "top2": top2.sum(axis=1) + top2.sum(axis=0),
+        "top3": top3_set.sum(axis=(1, 2)) / 2,
+        "pair_top2": top2 + top2.T,
+        "pair_top3": top3_set.sum(axis=2),
+        "triple_top3": top3_set,
+    }
+
+
+def simulation_summary(result: Dict[str, Any], numbers: List[int] = None) -> pd.DataFrame:
+    numbers = sorted(HORSE_LIST_2025) if numbers is None else numbers
+    return pd.DataFrame(
+        {
+            "馬名": [HORSE_LIST_2025[n]["馬名"] for n in numbers],
+            "勝率": result["win"],
+            "連対率": result["top2"],
+            "複勝率": result["top3"],
+        },
+        index=pd.Index(numbers, name="馬番"),
+    )
+
+
+# ============================================
+# Web検索クエリ（調査対象ごとに分割）
+# - 調査対象ごとに変化の速さが違うため、トピック単位で検索・キャッシュする
+# - ttl_sec を過ぎたトピックだけが再検索の対象になる
+#   （出走馬・枠順は数日不変、当日の馬体重・馬場・天候は当日朝に変わる）
+# ============================================
+SEARCH_QUERY_HEADER = """
 あなたは第70回有馬記念2025(2025年12月28日開催)の予想に資する情報を調査する専門家です。
 以下の調査対象について、WEB検索を行い、事実ベースで整理してください。
 必ず整理した内容を出力してください。
+"""
 
-【調査対象】
-1. 有馬記念の出走馬一覧・枠順・騎手・斤量
-2. 各馬の直近レース内容（最低1走）
-　- 距離 / 馬場 / 通過順 / 上がり / 着差
-3. 当日(2025年12月28日)の馬体重増減・馬場状態・天候
-4. 逃げ・先行馬の想定（ペース判断用）
-
+SEARCH_QUERY_REQUIREMENTS = """
 【出力要件】
 - JRA/主催者、公式出走表・公式結果、信頼できる出走データベース（事実情報）を最優先
 - 推測・予想・主観は含まない
 - 予想記事の印、回顧記事の主観評価、SNSの推測は使用禁止
-- 調査対象の項目ごとに箇条書きの文章で20個以上出力する(各項目5個以上)
+- 調査対象について箇条書きの文章で5個以上出力する
 - 調査結果において、予想に影響しそうな内容は可能な限り全て具体的に記述する
 - 出典の出力は不要
 - 上記調査にかかわる内容以外の出力は不要(はい等の応答文やネクストアクションの提案等は不要)
 """
 
+SEARCH_TOPICS = [
+    {
+        "key": "entries",
+        "title": "出走馬一覧・枠順・騎手・斤量",
+        "target": "有馬記念の出走馬一覧・枠順・騎手・斤量",
+        "ttl_sec": 3 * 24 * 60 * 60,
+    },
+    {
+        "key": "recent",
+        "title": "各馬の直近レース内容",
+        "target": "各馬の直近レース内容（最低1走）\n　- 距離 / 馬場 / 通過順 / 上がり / 着差",
+        "ttl_sec": 24 * 60 * 60,
+    },
+    {
+        "key": "raceday",
+        "title": "当日の馬体重増減・馬場状態・天候",
+        "target": "当日(2025年12月28日)の馬体重増減・馬場状態・天候",
+        "ttl_sec": 30 * 60,
+    },
+    {
+        "key": "pace",
+        "title": "逃げ・先行馬の想定",
+        "target": "逃げ・先行馬の想定（ペース判断用）",
+        "ttl_sec": 12 * 60 * 60,
+    },
+]
+
+
+def build_search_query(topic: Dict[str, Any]) -> str:
+    return f"{SEARCH_QUERY_HEADER}\n【調査対象】\n{topic['target']}\n{SEARCH_QUERY_REQUIREMENTS}"
+
+# ============================================
+# プロンプト組み立て（描画済みブロックのメモ化）
+# - 過去データ表・出走馬情報・Web検索結果などの大きな静的ブロックは
+#   (ワークブック内容ハッシュ, 検索結果ハッシュ) 単位で一度だけ描画し、全セッションで共有する
+# - 各関数の system_prompt も入力ブロックが同じ間は組み立て済みの文字列を再利用する
+# - ブロックごとのバイト数・推定トークン数を計測用に出せる
+# ============================================
+PROMPT_CACHE_MAX_ENTRIES = 256
+
+
+@st.cache_resource
+def get_prompt_cache() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "blocks": {}}
+
+
+def memoize_prompt_block(key: Tuple[Any, ...], build: Callable[[], str]) -> str:
+    cache = get_prompt_cache()
+    with cache["lock"]:
+        text = cache["blocks"].get(key)
+    if text is None:
+        text = build()
+        with cache["lock"]:
+            cache["blocks"][key] = text
+            while len(cache["blocks"]) > PROMPT_CACHE_MAX_ENTRIES:
+                cache["blocks"].pop(next(iter(cache["blocks"])))
+    return text
+
+
+def cached_system_prompt(name: str, inputs: Tuple[Any, ...], build: Callable[[], str]) -> str:
+    digest = hashlib.sha256(json.dumps(inputs, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+    return memoize_prompt_block(("system_prompt", name, digest), build)
+
+
+# ============================================
+# 共通プレフィックス（プロバイダ側プロンプトキャッシュ対策）
+# - 全タスクの system_prompt を「共通前提 → 出走馬情報 → WEB検索結果」の同一バイト列で始め、
+#   タスク固有の指示はその後ろに置く（先頭一致部分が API 側で自動キャッシュされる）
+# - サイン理論など検索結果を使わないタスクも、出走馬情報までは同じ先頭を共有する
+# ============================================
+SHARED_PROMPT_HEADER = """## 共通前提
+第70回有馬記念（2025年12月28日・中山芝2500m）の予想アプリで、全タスク共通に使う参照情報です。
+参照情報の後ろにある「## タスク」以降の指示に従って回答してください。
+"""
+
+
+def shared_prompt_prefix(search_results: str = None) -> str:
+    parts = [SHARED_PROMPT_HEADER, f"## 出走馬情報\n{HORSE_INFO_STR_2025}"]
+    if search_results is not None:
+        parts.append(f"## WEB検索結果\n{search_results}\n")
+    parts.append("## タスク")
+    return "\n".join(parts)
+
+
+def compose_system_prompt(name: str, search_results: str, task_prompt: str) -> str:
+    return cached_system_prompt(name, (search_results,), lambda: shared_prompt_prefix(search_results) + task_prompt)
+
+
+def estimate_tokens(text: str) -> int:
+    # 英数字は約4文字で1トークン、日本語などの非ASCII文字は約1文字1トークンとして概算する
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return int(ascii_chars / 4 + (len(text) - ascii_chars))
+
+
+def prompt_block_sizes(data: Dict[str, pd.DataFrame], search_results: str) -> pd.DataFrame:
+    blocks = {
+        "出走馬情報": HORSE_INFO_STR_2025,
+        "過去データ表": format_data_for_prompt(data),
+        "Web検索結果": search_results or "",
+        "2025年の出来事": EVENTS_2025_STR,
+    }
+    return pd.DataFrame(
+        [
+            {"ブロック": name, "bytes": len(text.encode("utf-8")), "推定トークン": estimate_tokens(text)}
+            for name, text in blocks.items()
+        ]
+    )
+
+
+# ============================================
+# API使用量の記録（cached_tokens でプロンプトキャッシュの効き具合を確認する）
+# - 呼び出しごとに input / cached / output トークン数と所要時間を直近 200 件まで保持
+# ============================================
+@st.cache_resource
+def get_usage_log() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "records": deque(maxlen=200)}
+
+
+def record_llm_usage(label: str, usage: Any, latency_sec: float) -> None:
+    details = getattr(usage, "input_tokens_details", None)
+    record = {
+        "時刻": datetime.now(JST).strftime("%H:%M:%S"),
+        "呼び出し": label,
+        "input_tokens": getattr(usage, "input_tokens", None),
+        "cached_tokens": getattr(details, "cached_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None),
+        "秒": round(latency_sec, 2),
+    }
+    log = get_usage_log()
+    with log["lock"]:
+        log["records"].append(record)
+
+
+def usage_summary() -> Tuple[pd.DataFrame, float]:
+    log = get_usage_log()
+    with log["lock"]:
+        records = list(log["records"])
+    df = pd.DataFrame(records, columns=["時刻", "呼び出し", "input_tokens", "cached_tokens", "output_tokens", "秒"])
+    total_in = pd.to_numeric(df["input_tokens"], errors="coerce").sum()
+    total_cached = pd.to_numeric(df["cached_tokens"], errors="coerce").sum()
+    return df.iloc[::-1], (total_cached / total_in if total_in else 0.0)
+
 # ============================================
 # GPT-5-mini 共通コール（Responses API）
 # - temperature等は使わない（GPT-5系でエラー要因になりやすい）
 # - max_output_tokens は必要に応じて指定
+# - 同一リクエストは LLM応答キャッシュ から返す（空応答・最後まで生成されなかった応答はキャッシュしない）
+# - stream_to を渡すとストリーミングで受信し、途中経過の全文をその都度コールバックする
+#   （response.failed / error で終わったら例外、response.completed が来なければキャッシュしない）
 # ============================================
-def _call_gpt5mini_text(client: OpenAI, system_prompt: str, user_prompt: str, max_output_tokens: int) -> str:
-    r = client.responses.create(
-        model="gpt-5-mini",
+def _is_json(text: str) -> bool:
+    try:
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+
+def _stream_failure(event: Any) -> str:
+    # response.failed は response.error に、error イベントは自身に message / code を持つ
+    error = getattr(getattr(event, "response", None), "error", None) or event
+    return getattr(error, "message", None) or getattr(error, "code", None) or event.type
+
+
+def _call_gpt5mini_text(
+    client: OpenAI,
+    system_prompt: str,
+    user_prompt: str,
+    max_output_tokens: int,
+    stream_to: Callable[[str], None] = None,
+    label: str = "gpt-5-mini",
+    text_format: Dict[str, Any] = None,
+    on_wait: Callable[[str], None] = None,
+) -> str:
+    """on_wait は順番待ちの表示先（省略時は stream_to）。ストリーミングしない呼び出しでも待ち順を出せる。"""
+    model = "gpt-5-mini"
+    on_wait = on_wait or stream_to
+    # text_format（JSON スキーマ指定）はある時だけキーに含め、既存のキャッシュキーを変えない
+    key = llm_cache_key(
+        model=model,
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        max_output_tokens=max_output_tokens,
+        **({"text_format": text_format} if text_format else {}),
+    )
+    cached = llm_cache_get(key)
+    if cached is not None:
+        if stream_to is not None:
+            stream_to(cached)
+        return cached
+
+    request = dict(
+        model=model,
         input=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ],
         max_output_tokens=max_output_tokens,
     )
-    return (r.output_text or "").strip()
+    if text_format:
+        request["text"] = {"format": text_format}
+    est_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + max_output_tokens
+    started = time.perf_counter()
+    failure = None
+    if stream_to is None:
+        r = openai_call(
+            lambda: client.responses.create(timeout=LLM_CALL_TIMEOUT_SEC, **request),
+            model=model,
+            est_tokens=est_tokens,
+            on_wait=on_wait,
+        )
+        text = (r.output_text or "").strip()
+        usage = getattr(r, "usage", None)
+        status = getattr(r, "status", None)
+    else:
+        chunks: List[str] = []
+        usage = status = None
+        # 再試行するのはストリーム開始まで（途中で切れた出力は繰り返さない）
+        stream = openai_call(
+            lambda: client.responses.create(stream=True, timeout=LLM_CALL_TIMEOUT_SEC, **request),
+            model=model,
+            est_tokens=est_tokens,
+            on_wait=on_wait,  # 順番待ちの間はプレースホルダーに待ち順を出す
+        )
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                chunks.append(event.delta)
+                stream_to("".join(chunks))
+            elif event.type in ("response.completed", "response.incomplete"):
+                usage = getattr(event.response, "usage", None)
+                status = event.type.split(".", 1)[1]
+            elif event.type in ("response.failed", "error"):
+                usage = getattr(getattr(event, "response", None), "usage", None)
+                failure = _stream_failure(event)
+        text = "".join(chunks).strip()
+    record_llm_usage(label, usage, time.perf_counter() - started)
+    rate_limit_settle(model, est_tokens, _usage_total_tokens(usage))
+    if failure is not None:
+        # 途中までの文章を完成した応答として返さない
+        raise UpstreamUnavailableError(f"OpenAI API の応答生成が途中で失敗しました（{failure}）")
+    # max_output_tokens で打ち切られた応答（status == "incomplete"）は全員に配らない
+    if text and status == "completed" and (not text_format or _is_json(text)):
+        llm_cache_put(key, text)
+    else:
+        mark_stage_uncacheable()  # 使い回せない応答から作ったステージ出力も保存しない
+    return text
+
+# ============================================
+# 並列実行ヘルパー
+# - 互いに独立したLLM呼び出しをスレッドで同時に投げる
+# - ワーカースレッドにもスクリプト実行コンテキストを引き継ぐ（session_state 参照のため）
+# - バックグラウンドジョブ内では、登録元セッション（レート制御の順番待ち単位）も引き継ぐ
+# - 完了した順に (名前, 結果) を返すので、呼び出し側で順次プレースホルダーを埋められる
+# ============================================
+def run_concurrently(tasks: Dict[str, Callable[[], Any]]) -> Iterator[Tuple[str, Any]]:
+    ctx = get_script_run_ctx()
+    owner = getattr(_job_local, "owner", None)
+
+    def _attach_ctx():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        _job_local.owner = owner
+
+    with ThreadPoolExecutor(max_workers=max(1, len(tasks)), initializer=_attach_ctx) as executor:
+        futures = {executor.submit(fn): name for name, fn in tasks.items()}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
 # ============================================
 # Web検索機能（Responses API + web_search）
 # - gpt-5-mini で web_search を実行
 # - output_text が空でも sources を拾って最低限返す（RuntimeError対策）
 # ============================================
-def gpt_web_search(client, prompt: str) -> str: 
-    response = client.responses.create( 
-        model="gpt-4.1", 
-        tools=[{"type": "web_search"}], 
-        input=prompt, # ← search_query をそのまま入れる 
-        max_output_tokens=3000, # 出力量制御 
-    ) 
+def gpt_web_search(client, prompt: str, max_output_tokens: int = 3000, on_wait: Callable[[str], None] = None) -> str:
+    est_tokens = estimate_tokens(prompt) + max_output_tokens
+    started = time.perf_counter()
+    response = openai_call(
+        lambda: client.responses.create( 
+            model="gpt-4.1", 
+            tools=[{"type": "web_search"}], 
+            input=prompt, # ← build_search_query の結果をそのまま入れる 
+            max_output_tokens=max_output_tokens, # 出力量制御 
+            timeout=SEARCH_CALL_TIMEOUT_SEC,
+        ),
+        model="gpt-4.1",
+        est_tokens=est_tokens,
+        on_wait=on_wait,
+    )
+    usage = getattr(response, "usage", None)
+    record_llm_usage("web_search", usage, time.perf_counter() - started)
+    rate_limit_settle("gpt-4.1", est_tokens, _usage_total_tokens(usage))
     return response.output_text
 
 # from typing import List, Dict, Any, Optional
@@ -497,37 +2528,351 @@ def gpt_web_search(client, prompt: str) -> str:
 
 #     return "（WEB検索結果なし）"
 
-def ensure_daily_gpt_search(client: OpenAI, query: str) -> str:
-    if client is None:
-        st.session_state["search_error"] = "client is None"
-        return None
+# ============================================
+# 当日検索の共有キャッシュ（プロセス全体・single-flight・stale-while-revalidate）
+# - キーは検索クエリのハッシュだけ（日付を含めない）。鮮度はトピックごとの ttl_sec で決まり、
+#   日付が変わっても ttl_sec 以内の結果はそのまま使う
+# - 同じキーへの同時要求は1本だけ検索を実行し、残りはその結果を待つ
+# - ttl_sec を過ぎても SEARCH_MAX_STALENESS_SEC 以内なら古い結果を即座に返し、
+#   裏でスレッドが再検索する（検索失敗時も直近の成功結果を使い続ける）
+# - 裏の再検索が失敗したらエラーと時刻をエントリに残してサイドバーに出し、次の再検索まで間隔を空ける
+#   （SEARCH_REFRESH_BACKOFF_SEC から失敗のたびに倍、最大 SEARCH_REFRESH_BACKOFF_MAX_SEC）
+# - 「今日の検索をリセット」で全セッション分をまとめて破棄する
+# ============================================
+SEARCH_MAX_STALENESS_SEC = int(os.environ.get("SEARCH_MAX_STALENESS_SEC", str(3 * 24 * 60 * 60)))
+SEARCH_DEFAULT_TTL_SEC = 24 * 60 * 60
+SEARCH_REFRESH_BACKOFF_SEC = 5 * 60
+SEARCH_REFRESH_BACKOFF_MAX_SEC = 60 * 60
+
+
+@st.cache_resource
+def get_search_cache() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "entries": {}, "inflight": {}}
 
-    today = datetime.now(JST).date().isoformat()
 
-    # すでに今日の分があれば再利用
-    if st.session_state.get("search_date_jst") == today and st.session_state.get("search_results"):
-        return st.session_state["search_results"]
+def search_cache_key(query: str) -> str:
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
 
+
+def _begin_search_flight(cache: Dict[str, Any], key: str) -> Tuple[Dict[str, Any], bool]:
+    # cache["lock"] を保持した状態で呼ぶこと
+    flight = cache["inflight"].get(key)
+    if flight is not None:
+        return flight, False
+    flight = {"event": threading.Event(), "entry": None, "error": None}
+    cache["inflight"][key] = flight
+    return flight, True
+
+
+def _search_result(entry: Dict[str, Any], stale: bool) -> Dict[str, Any]:
+    return {
+        "text": entry["text"],
+        "fetched_at": entry["fetched_at"],
+        "stale": stale,
+        "error": None,
+        "refresh_error": entry["refresh_error"],
+        "refresh_failed_at": entry["refresh_failed_at"],
+    }
+
+
+def _refresh_due(entry: Dict[str, Any], now: float) -> bool:
+    # 直近の再検索が失敗していたら、失敗回数に応じた間隔が空くまで再検索しない
+    if not entry["refresh_failures"]:
+        return True
+    backoff = min(SEARCH_REFRESH_BACKOFF_MAX_SEC, SEARCH_REFRESH_BACKOFF_SEC * 2 ** (entry["refresh_failures"] - 1))
+    return now - entry["refresh_failed_at"] >= backoff
+
+
+def _run_search_flight(
+    client: OpenAI,
+    query: str,
+    key: str,
+    flight: Dict[str, Any],
+    max_output_tokens: int,
+    on_wait: Callable[[str], None] = None,
+) -> None:
+    cache = get_search_cache()
     try:
-        text = gpt_web_search(client, query)  # str想定
+        text = gpt_web_search(client, query, max_output_tokens=max_output_tokens, on_wait=on_wait)  # str想定
         if not text or not str(text).strip():
             raise RuntimeError("web_search returned empty text")
-        st.session_state["search_results"] = str(text)
-        st.session_state["search_date_jst"] = today
-        st.session_state["search_error"] = None
-        return st.session_state["search_results"]
+        entry = {
+            "text": str(text),
+            "fetched_at": time.time(),
+            "refresh_error": None,
+            "refresh_failed_at": None,
+            "refresh_failures": 0,
+        }
+        with cache["lock"]:
+            cache["entries"][key] = entry
+        flight["entry"] = entry
     except Exception as e:
-        st.session_state["search_error"] = repr(e)
-        st.session_state["search_results"] = None
-        st.session_state["search_date_jst"] = None
+        flight["error"] = e
+        with cache["lock"]:
+            # 古い結果を返し続けている場合は、失敗を表示と再検索の間隔に使えるよう残す
+            stale = cache["entries"].get(key)
+            if stale is not None:
+                stale["refresh_error"] = f"{type(e).__name__}: {e}"
+                stale["refresh_failed_at"] = time.time()
+                stale["refresh_failures"] += 1
+    finally:
+        with cache["lock"]:
+            cache["inflight"].pop(key, None)
+        flight["event"].set()
+
+
+def shared_daily_search(
+    client: OpenAI,
+    query: str,
+    ttl_sec: int = SEARCH_DEFAULT_TTL_SEC,
+    max_output_tokens: int = 3000,
+    on_wait: Callable[[str], None] = None,
+) -> Dict[str, Any]:
+    """ttl_sec 以内の検索結果を返す。
+
+    戻り値は text / fetched_at / stale / error / refresh_error / refresh_failed_at を持つ dict。
+    refresh_error は古い結果を返している間に裏の再検索が失敗した時の内容。
+    """
+    cache = get_search_cache()
+    key = search_cache_key(query)
+
+    with cache["lock"]:
+        latest = cache["entries"].get(key)
+        now = time.time()
+        age = None if latest is None else now - latest["fetched_at"]
+        if age is not None and age <= ttl_sec:
+            return _search_result(latest, stale=False)
+        if age is not None and age > SEARCH_MAX_STALENESS_SEC:
+            latest = None
+        if latest is not None and not _refresh_due(latest, now):
+            return _search_result(latest, stale=True)
+        flight, is_leader = _begin_search_flight(cache, key)
+        stale_result = None if latest is None else _search_result(latest, stale=True)
+
+    # 古い結果が使えるなら即返し、再検索はバックグラウンドに回す
+    if stale_result is not None:
+        if is_leader:
+            threading.Thread(
+                target=_run_search_flight, args=(client, query, key, flight, max_output_tokens), daemon=True
+            ).start()
+        return stale_result
+
+    # 使える結果が無ければ、先行する検索の完了を待つ（自分が先頭なら自分で検索する）
+    if is_leader:
+        _run_search_flight(client, query, key, flight, max_output_tokens, on_wait)
+    else:
+        flight["event"].wait()
+    if flight["error"] is not None:
+        raise flight["error"]
+    return _search_result(flight["entry"], stale=False)
+
+
+def invalidate_shared_search() -> None:
+    cache = get_search_cache()
+    with cache["lock"]:
+        cache["entries"].clear()
+
+
+def collect_daily_search(
+    client: OpenAI, topics: List[Dict[str, Any]] = None, on_wait: Callable[[str], None] = None
+) -> Dict[str, Any]:
+    """当日の検索結果をトピック単位の共有キャッシュから組み立てる（session_state は使わない）。"""
+    if client is None:
+        return {"text": None, "date": None, "fetched_at": None, "stale": False, "error": "client is None", "topics": []}
+
+    topics = SEARCH_TOPICS if topics is None else topics
+
+    # トピックごとに共有キャッシュを引き、期限切れ・未取得のものだけ同時に検索する
+    results: Dict[str, Dict[str, Any]] = {}
+    errors: List[str] = []
+
+    def _search(topic):
+        try:
+            return shared_daily_search(
+                client,
+                build_search_query(topic),
+                ttl_sec=topic["ttl_sec"],
+                max_output_tokens=1200,
+                on_wait=on_wait,
+            )
+        except Exception as e:
+            return {"text": None, "fetched_at": None, "stale": False, "error": repr(e)}
+
+    for key, result in run_concurrently({t["key"]: (lambda t=t: _search(t)) for t in topics}):
+        results[key] = result
+
+    sections = []
+    topic_meta = []
+    for topic in topics:
+        result = results[topic["key"]]
+        if result["error"] is not None:
+            errors.append(f"{topic['key']}: {result['error']}")
+            continue
+        sections.append(f"【{topic['title']}】\n{result['text'].strip()}")
+        topic_meta.append(
+            {
+                "title": topic["title"],
+                "fetched_at": result["fetched_at"],
+                "stale": result["stale"],
+                "refresh_error": result.get("refresh_error"),
+                "refresh_failed_at": result.get("refresh_failed_at"),
+            }
+        )
+
+    # 1トピックでも取れていれば、取れた分だけで検索結果を構成する
+    if not sections:
+        error = " / ".join(errors) or "web_search returned no topics"
+        return {"text": None, "date": None, "fetched_at": None, "stale": False, "error": error, "topics": []}
+
+    oldest = min(m["fetched_at"] for m in topic_meta)
+    return {
+        "text": "\n\n".join(sections),
+        "date": datetime.fromtimestamp(oldest, JST).date().isoformat(),
+        "fetched_at": oldest,
+        "stale": any(m["stale"] for m in topic_meta),
+        "error": " / ".join(errors) or None,
+        "topics": topic_meta,
+    }
+
+
+def mirror_search_state(search: Dict[str, Any]) -> None:
+    # サイドバー表示用に session_state へ写す
+    st.session_state["search_results"] = search["text"]
+    st.session_state["search_date_jst"] = search["date"]
+    st.session_state["search_fetched_at"] = search["fetched_at"]
+    st.session_state["search_stale"] = search["stale"]
+    st.session_state["search_error"] = search["error"]
+    st.session_state["search_topics"] = search["topics"]
+
+
+# ============================================
+# 推奨馬の構造化出力（predict_horses）
+# - 全馬の A〜F 点数と印（◎○▲☆✕）を JSON スキーマで受け取り、文章はローカルで組み立てる
+# - E はローカルの期待値表スコアで上書きし、合計点もローカルで計算する
+# - 後段（買い目提案）には印と合計点だけの短い表を渡す
+# ============================================
+PREDICTION_MARKS = {"◎": "本命", "○": "対抗", "▲": "単穴", "☆": "穴馬", "✕": "危険馬"}
+
+PREDICTION_FORMAT = {
+    "type": "json_schema",
+    "name": "horse_prediction",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "horses": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "number": {"type": "integer", "description": "馬番"},
+                        **{c: {"type": "number", "description": "0〜5点"} for c in INDICATOR_COLUMNS},
+                        "risk": {"type": "string"},
+                    },
+                    "required": ["number", *INDICATOR_COLUMNS, "risk"],
+                    "additionalProperties": False,
+                },
+            },
+            "picks": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "mark": {"type": "string", "enum": list(PREDICTION_MARKS)},
+                        "number": {"type": "integer", "description": "馬番"},
+                        "reason": {"type": "string"},
+                        "concern": {"type": "string"},
+                    },
+                    "required": ["mark", "number", "reason", "concern"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["horses", "picks"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _score_value(value: Any) -> float:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
         return None
+    return None if np.isnan(value) else round(min(max(value, 0.0), 5.0), 1)
+
+
+def parse_prediction(text: str, local_scores: pd.DataFrame) -> Dict[str, Any]:
+    try:
+        raw = json.loads(text)
+        horses = {int(h["number"]): h for h in raw["horses"]}
+        picks = raw["picks"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"推奨馬の構造化出力を解析できませんでした（{type(e).__name__}）") from e
+
+    scores = []
+    for number, info in HORSE_LIST_2025.items():
+        horse = horses.get(number, {})
+        row = {"馬番": number, "馬名": info["馬名"]}
+        for col in INDICATOR_COLUMNS:
+            row[col] = _score_value(horse.get(col))
+        local_e = _score_value(local_scores.at[number, "E"]) if number in local_scores.index else None
+        if local_e is not None:
+            row["E"] = local_e
+        row["合計"] = round(sum(row[c] or 0.0 for c in INDICATOR_COLUMNS), 1)
+        row["リスク"] = horse.get("risk", "")
+        scores.append(row)
+    scores.sort(key=lambda r: -r["合計"])
+
+    valid_picks = []
+    for pick in picks:
+        number = pick.get("number")
+        if pick.get("mark") in PREDICTION_MARKS and number in HORSE_LIST_2025:
+            valid_picks.append({
+                "印": pick["mark"],
+                "馬番": number,
+                "馬名": HORSE_LIST_2025[number]["馬名"],
+                "理由": pick.get("reason", ""),
+                "不安点": pick.get("concern", ""),
+            })
+    valid_picks.sort(key=lambda p: list(PREDICTION_MARKS).index(p["印"]))
+    return {"scores": scores, "picks": valid_picks}
+
+
+def render_prediction(prediction: Dict[str, Any]) -> str:
+    totals = {row["馬番"]: row["合計"] for row in prediction["scores"]}
+    parts = []
+    for pick in prediction["picks"]:
+        lines = [
+            f"{pick['印']}{PREDICTION_MARKS[pick['印']]} {pick['馬番']}番 {pick['馬名']}（合計 {totals[pick['馬番']]}点）",
+            pick["理由"],
+        ]
+        if pick["不安点"]:
+            lines.append(f"不安点：{pick['不安点']}")
+        parts.append("\n".join(lines))
+    return "\n\n".join(parts)
+
+
+def format_prediction_for_prompt(prediction: Dict[str, Any]) -> str:
+    marks = {pick["馬番"]: pick["印"] for pick in prediction["picks"]}
+    lines = ["印 馬番 馬名 合計 不安点"]
+    for pick in prediction["picks"]:
+        row = next(r for r in prediction["scores"] if r["馬番"] == pick["馬番"])
+        lines.append(f"{pick['印']} {pick['馬番']} {pick['馬名']} {row['合計']} {pick['不安点'] or '-'}")
+    others = [f"{r['馬番']}:{r['合計']}" for r in prediction["scores"] if r["馬番"] not in marks]
+    lines.append(f"無印（馬番:合計）: {' '.join(others)}")
+    return "\n".join(lines)
+
 
 # ============================================
 # 機能①: 総合予想（3段階）
 # ============================================
-def analyze_data_summary(client, data):
-    search_results = st.session_state.get("search_results") or "（WEB検索結果なし）"
-    system_prompt = f"""
+def analyze_data_summary(client, data, search_results=None, stream_to=None):
+    search_results = search_results or "（WEB検索結果なし）"
+    system_prompt = compose_system_prompt(
+        "analyze_data_summary",
+        search_results,
+        """
 ## 指示
 あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
 過去の有馬記念データとWEB一次情報をもとに傾向を分析してください。
@@ -590,24 +2935,25 @@ def analyze_data_summary(client, data):
 (内容を簡潔に記載)
 【不利になりやすいタイプ】
 (内容を簡潔に記載)
-
-## 出走馬情報
-{HORSE_INFO_STR_2025}
-
-## WEB検索結果
-{search_results}
-"""
+""",
+    )
     return _call_gpt5mini_text(
         client=client,
         system_prompt=system_prompt,
         user_prompt=f"データ分析:\n{format_data_for_prompt(data)}",
         max_output_tokens=8000,
+        stream_to=stream_to,
+        label="analyze_data_summary",
     )
 
 
-def predict_horses(client, data, analysis):
-    search_results = st.session_state.get("search_results") or "（WEB検索結果なし）"
-    system_prompt = f"""
+def predict_horses(client, data, analysis, search_results=None, on_wait=None) -> Dict[str, Any]:
+    """推奨馬を構造化して返す（{"scores": 各馬の A〜F・合計, "picks": 印ごとの馬と理由}）。"""
+    search_results = search_results or "（WEB検索結果なし）"
+    system_prompt = compose_system_prompt(
+        "predict_horses",
+        search_results,
+        """
 ## 指示
 あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
 コース傾向・過去の有馬記念データ・当日のWEB一次情報・展開分析を統合して、競馬初心者でも「なぜこの馬が本命／対抗／穴なのか」を納得しながら理解できる形で推奨馬を提示してください。
@@ -645,6 +2991,7 @@ E. 過去データ適合（統合評価）
 　・血統  
 　・騎手  
 ※出力時は「どの要素が一致したか」を必ず明示する
+※入力の「データ指標スコア」にEの計算値（E_年齢等の内訳付き）がある場合は、その値をそのまま採用する
 
 F. 当日要素  
 　馬体重増減・パドック・馬場状態  
@@ -665,39 +3012,40 @@ F. 当日要素
   3. 不安点がある場合は正直に明示
 
 ## 出力形式
-◎本命
-（最上位評価とした決定的理由や舞台・展開・当日条件との噛み合いを記載）
-（不安点があれば記載）
-○対抗（理由）
-（本命より評価を下げた理由や逆転があるとすればどの条件かを記載）
-▲単穴（理由）
-（能力は足りるが評価を抑えた理由や好走する場合の具体的シナリオを記載）
-☆穴馬（理由）
-（点数が低くても評価対象とした理由を記載）
-（好走条件が限定される場合は必ず明記）
-✕危険馬（理由）
-（評価を下げた理由や過信してはいけないポイントを記載）
+指定の JSON スキーマで出力すること。
+- horses：全出走馬について馬番と A〜F の点数（0〜5）、主なリスク要因（1文）
+- picks：◎本命・○対抗・▲単穴・☆穴馬・✕危険馬 を各1頭
+  - reason：◎は決定的理由と舞台・展開・当日条件との噛み合い、○は本命より評価を下げた理由と逆転の条件、
+    ▲は評価を抑えた理由と好走シナリオ、☆は評価対象とした理由と好走条件、✕は評価を下げた理由と過信してはいけない点
+  - concern：不安点（なければ空文字）
 
 ## 禁止事項
 ・人気順のみでの評価
-
-## 出走馬情報
-{HORSE_INFO_STR_2025}
-
-## WEB検索結果
-{search_results}
-"""
-    return _call_gpt5mini_text(
+""",
+    )
+    scores = compute_indicator_scores(data)
+    text = _call_gpt5mini_text(
         client=client,
         system_prompt=system_prompt,
-        user_prompt=f"【分析結果】\n{analysis}",
+        user_prompt=(
+            f"【分析結果】\n{analysis}\n\n"
+            f"【データ指標スコア（ローカル計算・0〜5点、-は未計算）】\n"
+            f"{format_scores_for_prompt(scores)}"
+        ),
         max_output_tokens=8000,
+        label="predict_horses",
+        text_format=PREDICTION_FORMAT,
+        on_wait=on_wait,
     )
+    return parse_prediction(text, scores)
 
 
-def suggest_betting(client, prediction):
-    search_results = st.session_state.get("search_results") or "（WEB検索結果なし）"
-    system_prompt = f"""
+def suggest_betting(client, prediction, tickets_text=None, allocation_text=None, stream_to=None):
+    # 印は構造化済みなので検索結果は渡さない（共通の先頭は出走馬情報まで共有する）
+    system_prompt = compose_system_prompt(
+        "suggest_betting",
+        None,
+        """
 ## 指示
 あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
 推奨馬の印をもとに、馬券の買い目を【リスク別】に整理して提示してください。
@@ -705,6 +3053,8 @@ def suggest_betting(client, prediction):
 
 ### 使用してよい情報源
 - 推奨馬印
+- 買い目エンジンの上位候補（全組合せから計算した的中確率・期待値）
+- 資金配分オプティマイザの配分案（的中確率・期待払戻・標準偏差つき）
 
 ## 出力ルール
 - 「買い目の提案」は必ず【タイプ別】に分類して出力すること
@@ -729,27 +3079,31 @@ def suggest_betting(client, prediction):
 
 【資金配分の目安】
 （上記のパターンそれぞれの資金配分を記載。予算を１万円として、安全型ならどういう配分か、バランス型ならどういう配分か、責型ならどういう配分かを記載。）
-
-
-## 出走馬情報
-{HORSE_INFO_STR_2025}
-
-## WEB検索結果
-{search_results}
-"""
+（資金配分オプティマイザの配分案がある場合はその金額を基本とし、的中確率・期待払戻も併記する。）
+""",
+    )
     return _call_gpt5mini_text(
         client=client,
         system_prompt=system_prompt,
-        user_prompt=f"予想:\n{prediction}",
+        user_prompt=(
+            f"予想:\n{format_prediction_for_prompt(prediction)}\n\n"
+            f"買い目エンジン上位候補:\n{tickets_text or '（なし）'}\n\n"
+            f"資金配分オプティマイザ:\n{allocation_text or '（なし）'}"
+        ),
         max_output_tokens=8000,
+        stream_to=stream_to,
+        label="suggest_betting",
     )
 
 # ============================================
 # 機能②: 単体評価（4段階）
 # ============================================
-def analyze_horse(client, horse_info, data):
-    search_results = st.session_state.get("search_results") or "（WEB検索結果なし）"
-    system_prompt = f"""
+def analyze_horse(client, horse_info, data, search_results=None, stream_to=None):
+    search_results = slice_search_for_horse(search_results, horse_info) or "（WEB検索結果なし）"
+    system_prompt = compose_system_prompt(
+        "analyze_horse",
+        search_results,
+        """
 ## 指示
 あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
 ユーザーが指定した「出走馬1頭」について、馬単体の能力を評価してください。
@@ -769,9 +3123,6 @@ def analyze_horse(client, horse_info, data):
 　- 前走レース別の有馬記念着順割合を参照
 　- 有馬記念に繋がりやすいローテ・成績かを評価
 
-## WEB検索結果
-{search_results}
-
 ## ★評価の内部目安（非出力）
 ★★★★★：有馬記念の負荷条件でも能力低下がほぼ見られない
 ★★★★☆：高負荷下でも一定水準を維持できる
@@ -788,19 +3139,24 @@ def analyze_horse(client, horse_info, data):
 ・血統評価：(1文で記載)
 ・年齢評価：(1文で記載)
 ・前走結果評価：(1文で記載)
-"""
+""",
+    )
+    context = build_horse_context(data, horse_info, ["血統", "年齢", "前走レース別", "前走クラス"])
     user_prompt = (
         f"馬名:{horse_info['馬名']} "
         f"枠番:{horse_info['枠番']} 馬番:{horse_info['馬番']} "
         f"性齢:{horse_info['性齢']} 血統:{horse_info['血統']} 前走:{horse_info['前走']}\n"
-        f"{format_data_for_prompt(data)}"
+        f"{context}"
     )
-    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000)
+    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000, stream_to=stream_to, label="analyze_horse")
 
 
-def analyze_jockey(client, horse_info, data):
-    search_results = st.session_state.get("search_results") or "（WEB検索結果なし）"
-    system_prompt = f"""
+def analyze_jockey(client, horse_info, data, search_results=None, stream_to=None):
+    search_results = slice_search_for_horse(search_results, horse_info) or "（WEB検索結果なし）"
+    system_prompt = compose_system_prompt(
+        "analyze_jockey",
+        search_results,
+        """
 ## 指示
 あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
 ユーザーが指定した「出走馬1頭」について、騎乗する騎手単体の評価を行ってください。
@@ -814,9 +3170,6 @@ def analyze_jockey(client, horse_info, data):
 ・平均的  
 ・不振傾向  
 
-## WEB検索結果
-{search_results}
-
 ## ★評価の内部目安（非出力）
 ★★★★★：好走傾向が非常に強く、凡走が少ない  
 ★★★★☆：好走傾向があり、安定感のある水準  
@@ -830,19 +3183,24 @@ def analyze_jockey(client, horse_info, data):
 (「★☆☆☆☆」の形式で記載）
 【コメント】
 (2-3文で記載)
-"""
+""",
+    )
+    context = build_horse_context(data, horse_info, ["騎手"])
     user_prompt = (
         f"騎手:{horse_info['騎手']} "
         f"騎乗馬:{horse_info['馬名']} "
         f"枠番:{horse_info['枠番']} 馬番:{horse_info['馬番']}\n"
-        f"{format_data_for_prompt(data)}"
+        f"{context}"
     )
-    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000)
+    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000, stream_to=stream_to, label="analyze_jockey")
 
 
-def analyze_course(client, horse_info, data):
-    search_results = st.session_state.get("search_results") or "（WEB検索結果なし）"
-    system_prompt = f"""
+def analyze_course(client, horse_info, data, search_results=None, stream_to=None):
+    search_results = slice_search_for_horse(search_results, horse_info) or "（WEB検索結果なし）"
+    system_prompt = compose_system_prompt(
+        "analyze_course",
+        search_results,
+        """
 ## 指示
 あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
 ユーザーが指定した「出走馬1頭」について、有馬記念のコース適性を評価してください。
@@ -873,9 +3231,6 @@ def analyze_course(client, horse_info, data):
 ・展開予想
 　- 想定ペース（S/M/H）を前提とし当該馬の脚質タイプが有馬記念で有利・不利になりやすいかを評価
 
-## WEB検索結果
-{search_results}
-
 ## ★評価の内部目安（非出力）
 ★★★★★：コース形態・距離・馬場傾向に非常に噛み合う  
 ★★★★☆：有馬記念の舞台条件に適性が高い  
@@ -892,19 +3247,24 @@ def analyze_course(client, horse_info, data):
 ・枠順：(1文で記載)
 ・距離適性：(1文で記載)
 ・展開予想：(1文で記載)
-"""
+""",
+    )
+    context = build_horse_context(data, horse_info, ["枠順", "前走レース別", "前走クラス"])
     user_prompt = (
         f"馬名:{horse_info['馬名']} "
         f"枠番:{horse_info['枠番']} 馬番:{horse_info['馬番']} "
         f"前走:{horse_info['前走']}\n"
-        f"{format_data_for_prompt(data)}"
+        f"{context}"
     )
-    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000)
+    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000, stream_to=stream_to, label="analyze_course")
 
 
-def analyze_total(client, horse_info, h_res, j_res, c_res):
-    search_results = st.session_state.get("search_results") or "（WEB検索結果なし）"
-    system_prompt = f"""
+def analyze_total(client, horse_info, h_res, j_res, c_res, search_results=None, stream_to=None):
+    search_results = search_results or "（WEB検索結果なし）"
+    system_prompt = compose_system_prompt(
+        "analyze_total",
+        search_results,
+        """
 ## 指示
 あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
 以下の3つの評価結果のみを入力情報として使用し、
@@ -923,9 +3283,6 @@ def analyze_total(client, horse_info, h_res, j_res, c_res):
 　・コース適性評価＝今年の条件との噛み合い  
 　・騎手評価＝取りこぼしリスク（減点要素）
 
-## WEB検索結果
-{search_results}
-
 ## ★評価の内部目安（非出力）
 ★★★★★：3評価すべてが高水準で、致命的リスクなし  
 ★★★★☆：高水準だが一部に明確な注意点あり  
@@ -947,25 +3304,146 @@ def analyze_total(client, horse_info, h_res, j_res, c_res):
 
 【一言】  
 (判断を象徴する短いフレーズを記載)
-"""
+""",
+    )
     user_prompt = (
         f"【枠{horse_info['枠番']}・馬{horse_info['馬番']} {horse_info['馬名']}】\n"
         f"馬分析:{h_res}\n"
         f"騎手分析:{j_res}\n"
         f"コース分析:{c_res}"
     )
-    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000)
+    return _call_gpt5mini_text(client, system_prompt, user_prompt, max_output_tokens=8000, stream_to=stream_to, label="analyze_total")
+
+# ============================================
+# 機能②': 単体評価の一括モード（構造化出力・1リクエスト）
+# - 馬・騎手・コース・総評を JSON スキーマで1回に出させ、共通の入力トークンを1度だけ払う
+# - 出力は各評価の通常モードと同じ見出し形式の文章にローカルで組み直して4つの箱に出す
+# ============================================
+def _rating_field() -> Dict[str, str]:
+    return {"type": "string", "description": "「★★★☆☆」のように★と☆を合わせて5文字"}
+
+
+def _section_schema(fields: Dict[str, str]) -> Dict[str, Any]:
+    properties = {"rating": _rating_field(), "comment": {"type": "string"}}
+    properties.update({key: {"type": "string", "description": desc} for key, desc in fields.items()})
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+# 評価ごとの (JSONキー, 追加項目 {キー: 見出し})
+EVALUATION_SECTIONS = {
+    "h": ("horse", {"bloodline": "血統評価", "age": "年齢評価", "prev_race": "前走結果評価"}),
+    "j": ("jockey", {}),
+    "c": ("course", {"draw": "枠順", "distance": "距離適性", "pace": "展開予想"}),
+    "t": ("total", {"value": "馬券的妙味", "phrase": "一言"}),
+}
+
+EVALUATION_FORMAT = {
+    "type": "json_schema",
+    "name": "horse_evaluation",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {name: _section_schema(fields) for name, fields in EVALUATION_SECTIONS.values()},
+        "required": [name for name, _ in EVALUATION_SECTIONS.values()],
+        "additionalProperties": False,
+    },
+}
+
+
+def _render_section(key: str, section: Dict[str, str]) -> str:
+    _, fields = EVALUATION_SECTIONS[key]
+    text = f"【評価】\n{section['rating']}\n【コメント】\n{section['comment']}"
+    if key == "t":
+        return text + "".join(f"\n\n【{title}】\n{section[field]}" for field, title in fields.items())
+    return text + "".join(f"\n・{title}：{section[field]}" for field, title in fields.items())
+
+
+def analyze_structured(
+    client, horse_info, data, search_results=None, stream_to=None, on_wait=None
+) -> Dict[str, str]:
+    """馬・騎手・コース・総評を1回の呼び出しで評価し、{"h","j","c","t": 表示用テキスト} を返す。"""
+    search_results = slice_search_for_horse(search_results, horse_info) or "（WEB検索結果なし）"
+    system_prompt = compose_system_prompt(
+        "analyze_structured",
+        search_results,
+        """
+## 指示
+あなたは有馬記念（中山芝2500m）を専門とする競馬予想AIエージェントです。
+ユーザーが指定した「出走馬1頭」について、馬単体・騎手・コース適性の3評価と、それらを掛け合わせた総評を
+指定の JSON スキーマで出力してください。各文章に「*」や「#」を含まないでください。
+
+## horse（馬単体評価）
+・血統評価：種牡馬の有馬記念着順割合から、有馬記念向き血統かを判断（bloodline に1文）
+・年齢評価：年齢別の着順割合の好走ゾーン・不振ゾーンとの一致度（age に1文）
+・前走結果評価：前走レース別の着順割合から、有馬記念に繋がりやすいローテ・成績か（prev_race に1文）
+・comment は2-3文
+
+## jockey（騎手評価）
+騎手別の有馬記念着順割合を参照し、好走傾向／平均的／不振傾向で内部判定する。comment は2-3文。
+
+## course（コース適性評価）
+・枠順：枠番別の着順割合から当該枠の有利・不利（draw に1文）
+・距離適性：前走ローテーションが中山芝2500mに繋がりやすい距離帯か（distance に1文）
+・展開予想：想定ペース（S/M/H）を前提に脚質が有利・不利か（pace に1文）
+・comment は2-3文の総評
+
+## total（総評）
+・3評価の「掛け合わせ」で判断し、いずれか1項目が低評価なら他が高評価でもリスクとして反映する
+・馬単体評価＝素材としての適性、コース適性評価＝今年の条件との噛み合い、騎手評価＝取りこぼしリスク（減点要素）
+・comment は3〜4文
+・value（馬券的妙味）は 軸向き／相手向き／ヒモ向き／見送り のいずれかを明示し、理由と用語の解説を添える
+・phrase（一言）は判断を象徴する短いフレーズ
+
+## ★評価の内部目安（非出力・各 rating 共通）
+★★★★★：条件に非常に噛み合い、致命的なリスクがない
+★★★★☆：高水準だが一部に注意点がある
+★★★☆☆：平均的で、強調材料に欠ける
+★★☆☆☆：不安要素が優勢で割引が必要
+★☆☆☆☆：条件的に明確に厳しい
+※この基準は内部判断用であり、説明文には直接書かないこと。
+""",
+    )
+    context = build_horse_context(data, horse_info, ["血統", "年齢", "騎手", "枠順", "前走レース別", "前走クラス"])
+    user_prompt = (
+        f"馬名:{horse_info['馬名']} "
+        f"枠番:{horse_info['枠番']} 馬番:{horse_info['馬番']} "
+        f"性齢:{horse_info['性齢']} 血統:{horse_info['血統']} 騎手:{horse_info['騎手']} 前走:{horse_info['前走']}\n"
+        f"{context}"
+    )
+    text = _call_gpt5mini_text(
+        client,
+        system_prompt,
+        user_prompt,
+        max_output_tokens=8000,
+        stream_to=stream_to,
+        label="analyze_structured",
+        text_format=EVALUATION_FORMAT,
+        on_wait=on_wait,
+    )
+    try:
+        result = json.loads(text)
+        return {key: _render_section(key, result[name]) for key, (name, _) in EVALUATION_SECTIONS.items()}
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"構造化出力を解析できませんでした（{type(e).__name__}）") from e
 
 # ============================================
 # 機能③: サイン理論（3段階）
 # ============================================
-def get_events_2025(client):
-    time.sleep(5)
+def get_events_2025(client=None):
     return EVENTS_2025_STR
 
 
-def extract_numbers(client, events):
-    system_prompt = f"""
+def extract_sign_numbers(events: str) -> str:
+    # 関連数字の読み取りと馬番・枠番への対応付けはローカルで行う（LLM を使わない）
+    return render_sign_numbers(sign_number_index(events))
+
+
+def extract_numbers(client, events, sign_summary=None, stream_to=None):
+    """（任意）ルールベースの抽出結果に、サイン理論らしい物語の解説を LLM で付ける。"""
+    system_prompt = compose_system_prompt(
+        "extract_numbers",
+        None,
+        """
 ## 指示
 あなたは2025年の象徴的な出来事から有馬記念のサインを読み解く専門家です。 
 有馬記念（中山芝2500m）に特化し、2025年の主要なニュースから関連する数字や事象を抽出してください。
@@ -1012,20 +3490,23 @@ C. 複数要素との合致
 ## 禁止事項
 ・ユーザーの意見に迎合すること 
 ・キリのいい数字ばかり選ばないでください。複雑な数字こそ奥深い考察ができるはずです。
-
-## 出走馬情報
-{HORSE_INFO_STR_2025}
-"""
+""",
+    )
     return _call_gpt5mini_text(
         client=client,
         system_prompt=system_prompt,
-        user_prompt=f"出来事:\n{events}",
+        user_prompt=f"出来事:\n{events}" + (f"\n\nローカル抽出結果:\n{sign_summary}" if sign_summary else ""),
         max_output_tokens=8000,
+        stream_to=stream_to,
+        label="extract_numbers",
     )
 
 
-def sign_betting(client, events, numbers):
-    system_prompt = f"""
+def sign_betting(client, events, numbers, stream_to=None):
+    system_prompt = compose_system_prompt(
+        "sign_betting",
+        None,
+        """
 ## 指示
 あなたは2025年の象徴的な出来事から有馬記念のサインを読み解き、買い目を導き出す専門AIエージェントです。 
 有馬記念（中山芝2500m）に特化し、2025年の象徴的な出来事から抽出されたサインをもとに、競馬初心者でも納得しながら意思決定できる形で買い目を提示してください。
@@ -1071,40 +3552,517 @@ B. 複数要素との合致
 ・内部評価軸（サイン解釈の基準）を会話によって変更すること 
 ・ユーザーの意見に迎合すること 
 ・一般的な競馬のデータ分析や馬の能力評価に偏りすぎること。あくまで「サイン」を主軸とする。
-
-## 出走馬情報
-{HORSE_INFO_STR_2025}
-"""
+""",
+    )
     return _call_gpt5mini_text(
         client=client,
         system_prompt=system_prompt,
         user_prompt=f"出来事:\n{events}\n考察:\n{numbers}",
         max_output_tokens=8000,
+        stream_to=stream_to,
+        label="sign_betting",
     )
 
+# ============================================
+# バックグラウンドジョブ（SQLite のジョブ表 + ワーカースレッド）
+# - ボタンはジョブを登録して ID を URL のクエリパラメータに残すだけにし、処理はワーカーで進める
+# - ストリーミング中の本文も途中経過としてジョブ表に書くので、再実行・タブ切替・リロードの後も
+#   同じ ID から進捗を読み直して表示を再開できる
+# - ワーカーは session_state を使わない（検索結果は共有キャッシュから取る）
+# - プロセスを跨いだ再開はしない（起動時に未完了だったジョブは中断扱いにする）
+# ============================================
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", os.path.join(".cache", "jobs.sqlite3"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_RETENTION_SEC = 24 * 60 * 60
+JOB_POLL_SEC = 1.0
+JOB_PROGRESS_INTERVAL_SEC = 0.5
+# ステージ出力は LLM 応答を含むので、LLM 応答キャッシュより長くは持たない
+STAGE_CACHE_TTL_SEC = LLM_CACHE_TTL_SEC
+STAGE_CACHE_MAX_ENTRIES = int(os.environ.get("STAGE_CACHE_MAX_ENTRIES", "2000"))
+
+
+@st.cache_resource
+def get_job_store() -> Dict[str, Any]:
+    os.makedirs(os.path.dirname(JOBS_DB_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(JOBS_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            owner TEXT,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL,
+            progress TEXT NOT NULL,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    now = time.time()
+    conn.execute(
+        "UPDATE jobs SET status = 'error', error = ?, updated_at = ? WHERE status IN ('queued', 'running')",
+        ("サーバーの再起動により中断されました。もう一度実行してください", now),
+    )
+    conn.execute("DELETE FROM jobs WHERE updated_at < ?", (now - JOB_RETENTION_SEC,))
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(stage_cache)")]
+    if columns and "last_access" not in columns:
+        conn.execute("DROP TABLE stage_cache")  # 旧形式のキャッシュは作り直す
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stage_cache (
+            key TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            output TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stage_cache_last_access ON stage_cache(last_access)")
+    conn.execute("DELETE FROM stage_cache WHERE created_at < ?", (now - STAGE_CACHE_TTL_SEC,))
+    executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+    return {"conn": conn, "lock": threading.Lock(), "executor": executor, "hits": 0, "misses": 0}
+
+
+def _update_job(job_id: str, **fields: Any) -> None:
+    store = get_job_store()
+    fields["updated_at"] = time.time()
+    values = [json.dumps(v, ensure_ascii=False) if k in ("params", "progress") else v for k, v in fields.items()]
+    assignments = ", ".join(f"{k} = ?" for k in fields)
+    with store["lock"]:
+        store["conn"].execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*values, job_id))
+
+
+def get_job(job_id: str) -> Dict[str, Any]:
+    if not job_id:
+        return None
+    store = get_job_store()
+    with store["lock"]:
+        row = store["conn"].execute(
+            "SELECT id, kind, owner, status, params, progress, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+    if row is None:
+        return None
+    keys = ["id", "kind", "owner", "status", "params", "progress", "error", "created_at", "updated_at"]
+    job = dict(zip(keys, row))
+    job["params"] = json.loads(job["params"])
+    job["progress"] = json.loads(job["progress"])
+    return job
+
+
+def job_is_active(job: Dict[str, Any]) -> bool:
+    return job is not None and job["status"] in ("queued", "running")
+
+
+def _run_job(job_id: str, owner: str, pipeline: Callable[[Callable[..., None]], None]) -> None:
+    _job_local.owner = owner
+    progress = {"steps": {}, "started": [], "finished": []}
+    lock = threading.Lock()
+    last_write = [0.0]
+
+    def report(step: str, value: Any = None, final: bool = False) -> None:
+        # 途中経過はメモリ上で更新し、ジョブ表への書き込みは間引く（確定時は必ず書く）
+        with lock:
+            if step not in progress["started"]:
+                progress["started"].append(step)
+            if value is not None:
+                progress["steps"][step] = value
+            if final and step not in progress["finished"]:
+                progress["finished"].append(step)
+            now = time.monotonic()
+            if final or now - last_write[0] >= JOB_PROGRESS_INTERVAL_SEC:
+                last_write[0] = now
+                _update_job(job_id, progress=progress)
+
+    try:
+        _update_job(job_id, status="running")
+        pipeline(report)
+        with lock:
+            _update_job(job_id, status="done", progress=progress)
+    except Exception as e:
+        message = str(e) if isinstance(e, UpstreamUnavailableError) else f"{type(e).__name__}: {e}"
+        with lock:
+            _update_job(job_id, status="error", progress=progress, error=message)
+    finally:
+        _job_local.owner = None
+
+
+def submit_job(kind: str, params: Dict[str, Any], pipeline: Callable[[Callable[..., None]], None]) -> str:
+    """ジョブを登録してワーカーに渡し、ジョブ ID を返す。params は表示・記録用（JSON で保存）。"""
+    store = get_job_store()
+    job_id = uuid.uuid4().hex[:12]
+    owner = _current_session_id()
+    now = time.time()
+    with store["lock"]:
+        store["conn"].execute(
+            "INSERT INTO jobs (id, kind, owner, status, params, progress, error, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'queued', ?, ?, NULL, ?, ?)",
+            (job_id, kind, owner, json.dumps(params, ensure_ascii=False), json.dumps({"steps": {}, "started": [], "finished": []}), now, now),
+        )
+    store["executor"].submit(_run_job, job_id, owner, pipeline)
+    return job_id
+
+
+def render_job_steps(job: Dict[str, Any], boxes: Dict[str, Tuple[Any, str, str, str]]) -> None:
+    # boxes: step -> (placeholder, タイトル, box_class, 処理中の表示)
+    progress = job["progress"]
+    active = job_is_active(job)
+    for step, (ph, title, box_class, waiting) in boxes.items():
+        text = progress["steps"].get(step)
+        running = active and step in progress["started"] and step not in progress["finished"]
+        if text:
+            ph.markdown(render_box(title, text + (" ▌" if running else ""), box_class), unsafe_allow_html=True)
+        elif running or (job["status"] == "queued" and step == next(iter(boxes))):
+            ph.info(waiting)
+    if job["status"] == "error":
+        st.error(f"⚠️ {job['error']}")
+
+
+# ============================================
+# ステージ DAG（入力の指紋による部分再計算）
+# - パイプラインを「ステージ名 → {deps, inputs, version, run, publish, cache, valid}」の dict で書く
+#   ・deps:    上流ステージ名（run には上流の出力がキーワード引数で渡る）
+#   ・inputs:  ワークブック指紋・馬番など、上流以外でこのステージの出力を決める値
+#   ・version: プロンプトの版（PROMPT_VERSIONS。プロンプトを直したら上げる）
+#   ・publish: 出力 → [(表示ステップ, 値)]（省略時はステージ名でそのまま報告）
+#   ・cache:   False なら毎回実行（当日検索のように自前のキャッシュを持つもの・ローカル計算）
+#   ・valid:   出力 → 保存してよいか（省略時は空でないこと）
+# - 空の出力、valid を満たさない出力、run の中で mark_stage_uncacheable() された出力
+#   （LLM 応答キャッシュに入れなかった打ち切り・空の応答を含む）はステージキャッシュに保存しない
+# - 指紋 = ステージ名 + version + inputs + 上流の出力ハッシュ。同じ指紋の出力がジョブ表の DB に
+#   あれば実行せずに使う（同じ条件での2回目のクリックは LLM を呼ばずに終わる）
+# - 上流が再実行されても出力が同じなら、下流はキャッシュに当たる
+# - 依存が揃ったステージから同時に実行する（run_concurrently と同じく ctx と owner を引き継ぐ）
+# ============================================
+PROMPT_VERSIONS = {
+    "analyze_data_summary": "1",
+    "predict_horses": "1",
+    "suggest_betting": "1",
+    "analyze_horse": "1",
+    "analyze_jockey": "1",
+    "analyze_course": "1",
+    "analyze_total": "1",
+    "analyze_structured": "1",
+    "extract_numbers": "1",
+    "sign_betting": "1",
+}
+
+
+def _output_hash(value: Any) -> str:
+    payload = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def stage_fingerprint(name: str, stage: Dict[str, Any], upstream_hashes: Dict[str, str]) -> str:
+    return _output_hash(
+        {
+            "stage": name,
+            "version": stage.get("version"),
+            "inputs": stage.get("inputs", {}),
+            "upstream": upstream_hashes,
+        }
+    )
+
+
+def stage_cache_get(key: str):
+    store = get_job_store()
+    with store["lock"]:
+        row = store["conn"].execute(
+            "SELECT output, created_at FROM stage_cache WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > STAGE_CACHE_TTL_SEC:
+            if row is not None:
+                store["conn"].execute("DELETE FROM stage_cache WHERE key = ?", (key,))
+            store["misses"] += 1
+            return None
+        store["conn"].execute("UPDATE stage_cache SET last_access = ? WHERE key = ?", (now, key))
+        store["hits"] += 1
+    return json.loads(row[0])
+
+
+def stage_cache_put(key: str, stage: str, output: Any) -> None:
+    store = get_job_store()
+    now = time.time()
+    with store["lock"]:
+        conn = store["conn"]
+        conn.execute(
+            "INSERT OR REPLACE INTO stage_cache (key, stage, output, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, stage, json.dumps(output, ensure_ascii=False), now, now),
+        )
+        conn.execute("DELETE FROM stage_cache WHERE created_at < ?", (now - STAGE_CACHE_TTL_SEC,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM stage_cache").fetchone()
+        if count > STAGE_CACHE_MAX_ENTRIES:
+            conn.execute(
+                "DELETE FROM stage_cache WHERE key IN "
+                "(SELECT key FROM stage_cache ORDER BY last_access ASC LIMIT ?)",
+                (count - STAGE_CACHE_MAX_ENTRIES,),
+            )
+
+
+def stage_cache_stats() -> Dict[str, int]:
+    store = get_job_store()
+    with store["lock"]:
+        (count,) = store["conn"].execute("SELECT COUNT(*) FROM stage_cache").fetchone()
+        return {"hits": store["hits"], "misses": store["misses"], "entries": count}
+
+
+_stage_local = threading.local()  # 実行中のステージ（ステージごとに別スレッド）の保存可否
+
+
+def mark_stage_uncacheable() -> None:
+    """実行中のステージの出力をステージキャッシュに保存しないようにする（ステージ外では何もしない）。"""
+    _stage_local.uncacheable = True
+
+
+def _run_stage(
+    name: str, stage: Dict[str, Any], upstream: Dict[str, Any], upstream_hashes: Dict[str, str], report
+) -> Tuple[Any, str]:
+    report(name)
+    cacheable = stage.get("cache", True)
+    key = stage_fingerprint(name, stage, upstream_hashes)
+    output = stage_cache_get(key) if cacheable else None
+    if output is None:
+        _stage_local.uncacheable = False
+        output = stage["run"](**upstream)
+        if cacheable and not _stage_local.uncacheable and stage.get("valid", bool)(output):
+            stage_cache_put(key, name, output)
+    publish = stage.get("publish", lambda out: [(name, out)])
+    for step, value in publish(output):
+        report(step, value, final=True)
+    return output, _output_hash(output)
+
+
+def run_stages(stages: Dict[str, Dict[str, Any]], report: Callable[..., None]) -> Dict[str, Any]:
+    """依存が揃ったステージから並列に実行し、ステージ名 → 出力を返す。"""
+    ctx = get_script_run_ctx()
+    owner = getattr(_job_local, "owner", None)
+
+    def _attach_ctx():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        _job_local.owner = owner
+
+    outputs: Dict[str, Any] = {}
+    hashes: Dict[str, str] = {}
+    pending = dict(stages)
+    with ThreadPoolExecutor(max_workers=max(1, len(stages)), initializer=_attach_ctx) as executor:
+        running = {}
+        while pending or running:
+            for name, stage in list(pending.items()):
+                deps = stage.get("deps", [])
+                if all(d in outputs for d in deps):
+                    del pending[name]
+                    future = executor.submit(
+                        _run_stage, name, stage, {d: outputs[d] for d in deps}, {d: hashes[d] for d in deps}, report
+                    )
+                    running[future] = name
+            if not running:
+                raise ValueError(f"依存関係を解決できないステージがあります: {sorted(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                outputs[name], hashes[name] = future.result()
+    return outputs
+
+
+def _search_stage(client, report: Callable[..., None], on_wait: Callable[[str], None] = None) -> Dict[str, Any]:
+    # 当日検索は collect_daily_search 側の共有キャッシュに任せる。ステージの出力は本文だけにして、
+    # 取得時刻・stale などのメタデータは下流の指紋に入れず、表示用に DAG の外で報告する
+    def run():
+        search = collect_daily_search(client, on_wait=on_wait)
+        report("search", search, final=True)
+        return search["text"]
+
+    return {"run": run, "cache": False, "publish": lambda text: []}
+
+
+def comprehensive_pipeline(client, data, tickets_text: str, allocation_text: str) -> Callable[[Callable[..., None]], None]:
+    workbook = workbook_fingerprint(data) if data is not None else None
+
+    def run(report):
+        report("step1")
+        run_stages({
+            "search": _search_stage(client, report, on_wait=lambda m: report("step1", m)),
+            "step1": {
+                "deps": ["search"],
+                "inputs": {"workbook": workbook},
+                "version": PROMPT_VERSIONS["analyze_data_summary"],
+                "run": lambda search: analyze_data_summary(
+                    client, data, search, stream_to=lambda t: report("step1", t)
+                ),
+            },
+            "step2": {
+                "deps": ["search", "step1"],
+                "inputs": {"workbook": workbook},
+                "version": PROMPT_VERSIONS["predict_horses"],
+                "run": lambda search, step1: predict_horses(
+                    client, data, step1, search, on_wait=lambda m: report("step2", m)
+                ),
+                "publish": lambda prediction: [("step2_data", prediction), ("step2", render_prediction(prediction))],
+                "valid": lambda prediction: bool(prediction["picks"]),
+            },
+            "step3": {
+                "deps": ["step2"],
+                "inputs": {"tickets": tickets_text, "allocation": allocation_text},
+                "version": PROMPT_VERSIONS["suggest_betting"],
+                "run": lambda step2: suggest_betting(
+                    client, step2, tickets_text, allocation_text, stream_to=lambda t: report("step3", t)
+                ),
+            },
+        }, report)
+
+    return run
+
+
+def evaluation_pipeline(
+    client, data, horse_info: Dict[str, Any], structured: bool = False
+) -> Callable[[Callable[..., None]], None]:
+    inputs = {"workbook": workbook_fingerprint(data) if data is not None else None, "horse": horse_info}
+
+    def run(report):
+        for step in ("h", "j", "c") + (("t",) if structured else ()):
+            report(step)
+        stages = {"search": _search_stage(client, report, on_wait=lambda m: report("h", m))}
+        if structured:
+            # 4評価を1リクエストで取得する（途中経過は出さず、完成後にまとめて表示）
+            stages["structured"] = {
+                "deps": ["search"],
+                "inputs": inputs,
+                "version": PROMPT_VERSIONS["analyze_structured"],
+                "run": lambda search: analyze_structured(
+                    client, horse_info, data, search, on_wait=lambda m: report("h", m)
+                ),
+                "publish": lambda result: list(result.items()),
+            }
+            run_stages(stages, report)
+            return
+        # 馬・騎手・コースは互いに独立なので同時に実行され、統合評価は3つが揃ってから走る
+        for key, fn in {"h": analyze_horse, "j": analyze_jockey, "c": analyze_course}.items():
+            stages[key] = {
+                "deps": ["search"],
+                "inputs": inputs,
+                "version": PROMPT_VERSIONS[fn.__name__],
+                "run": lambda search, key=key, fn=fn: fn(
+                    client, horse_info, data, search, stream_to=lambda t: report(key, t)
+                ),
+            }
+        stages["t"] = {
+            "deps": ["search", "h", "j", "c"],
+            "inputs": inputs,
+            "version": PROMPT_VERSIONS["analyze_total"],
+            "run": lambda search, h, j, c: analyze_total(
+                client, horse_info, h, j, c, search, stream_to=lambda t: report("t", t)
+            ),
+        }
+        run_stages(stages, report)
+
+    return run
+
+
+def _with_story(numbers: str, story: str) -> str:
+    return f"{numbers}\n\n【AIの解説】\n{story}"
+
+
+def sign_pipeline(client, narrative: bool = False) -> Callable[[Callable[..., None]], None]:
+    def run(report):
+        stages = {
+            "events": {"run": lambda: get_events_2025(client), "cache": False},
+            "numbers": {"deps": ["events"], "run": lambda events: extract_sign_numbers(events), "cache": False},
+            "bet": {
+                "deps": ["events", "numbers"],
+                "version": PROMPT_VERSIONS["sign_betting"],
+                "run": lambda events, numbers: sign_betting(
+                    client, events, numbers, stream_to=lambda t: report("bet", t)
+                ),
+            },
+        }
+        if narrative:
+            # 物語の解説は任意。買い目はルールベースの抽出結果から導くので、解説と買い目は同時に走る
+            stages["story"] = {
+                "deps": ["events", "numbers"],
+                "version": PROMPT_VERSIONS["extract_numbers"],
+                "run": lambda events, numbers: _with_story(
+                    numbers,
+                    extract_numbers(
+                        client, events, numbers, stream_to=lambda t: report("numbers", _with_story(numbers, t))
+                    ),
+                ),
+                "publish": lambda text: [("numbers", text)],
+            }
+        run_stages(stages, report)
+
+    return run
+
+
+def attached_job(param: str) -> Dict[str, Any]:
+    # URL のクエリパラメータに残したジョブ ID から再接続する（リロード後も同じジョブを表示）
+    job = get_job(st.query_params.get(param))
+    if job is None and param in st.query_params:
+        del st.query_params[param]
+    return job
+
+
 # ============================================
 # メインUI
 # ============================================
 def main():
+    import_sec = time.perf_counter() - _SCRIPT_STARTED
     st.markdown('<h1 class="main-title">🏇 有馬記念予想 2025</h1>', unsafe_allow_html=True)
     st.markdown('<p class="sub-title">第70回 AI × データ分析 × サイン理論</p>', unsafe_allow_html=True)
 
-    client = get_openai_client()
-    data = load_race_data()
+    start_prewarm()  # クライアント生成はプリウォーム側で進め、先にデータ読み込みと描画を行う
+    with st.sidebar:
+        uploaded_file = st.file_uploader("📂 データファイル（xlsx）", type=["xlsx"], help="未指定なら arima_data.xlsx を使います")
+    data, load_errors = load_race_data(uploaded_file)
 
     if data is None:
-        st.error("❌ arima_data.xlsx の読み込みに失敗しました")
+        st.error(f"❌ データの読み込みに失敗しました: {load_errors.get('ワークブック', '')}")
         st.stop()
+    if load_errors:
+        st.warning(
+            "⚠️ 一部のシートを読み込めませんでした（該当シートを除いて続行します）\n\n"
+            + "\n".join(f"- {sheet}: {msg}" for sheet, msg in load_errors.items())
+        )
 
     # サイドバー
     with st.sidebar:
         st.markdown("### ⚙️ 設定")
 
         if st.button("🔄 今日の検索をリセット", use_container_width=True):
+            invalidate_shared_search()
             st.session_state["search_date_jst"] = None
             st.session_state["search_results"] = None
             st.session_state["search_error"] = None
-            st.success("検索キャッシュをリセットしました（次回は再検索します）")
+            st.session_state["search_fetched_at"] = None
+            st.session_state["search_stale"] = False
+            st.session_state["search_topics"] = []
+            st.success("検索キャッシュをリセットしました（全ユーザー共通・次回は再検索します）")
+
+        stats = llm_cache_stats()
+        st.caption(f"LLM応答キャッシュ: hit={stats['hits']} / miss={stats['misses']} / 件数={stats['entries']}")
+        stats = stage_cache_stats()
+        st.caption(f"ステージキャッシュ: hit={stats['hits']} / miss={stats['misses']} / 件数={stats['entries']}")
+        st.caption(f"OpenAI API 状態: {breaker_status()}")
+        st.caption(f"レート制御: {rate_limit_status()}")
+
+        with st.expander("📈 プロンプトキャッシュ（cached_tokens）"):
+            usage_df, cached_ratio = usage_summary()
+            st.caption(f"直近の入力トークンのうちキャッシュ済み: {cached_ratio:.1%}")
+            st.dataframe(usage_df, use_container_width=True, hide_index=True)
+
+        with st.expander("📏 プロンプトブロックサイズ"):
+            st.dataframe(
+                prompt_block_sizes(data, st.session_state.get("search_results")),
+                use_container_width=True,
+                hide_index=True,
+            )
+
+        startup_slot = st.empty()
 
         st.markdown("---")
         st.markdown("### 🔎 Web検索結果（当日キャッシュ）")
@@ -1112,8 +4070,9 @@ def main():
         sb_debug = st.empty()
         sb_body = st.empty()
 
+    client = get_openai_client()
     tab1, tab2, tab3 = st.tabs(["🎯 総合予想", "🔍 単体評価", "🔮 サイン理論"])
-    render_sidebar_search(sb_debug, sb_body)
+    polling = False  # 実行中のジョブがあれば最後に少し待って再描画する
 
     # =========================
     # タブ1: 総合予想（再実行時に前回結果を全消し）
@@ -1127,52 +4086,126 @@ def main():
             unsafe_allow_html=True,
         )
 
+        comp_job = attached_job("comp_job")
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
-            start_btn = st.button("🚀 予想スタート", key="comp_btn", use_container_width=True)
+            start_btn = st.button(
+                "🚀 予想スタート", key="comp_btn", use_container_width=True, disabled=job_is_active(comp_job)
+            )
 
         comp = st.session_state["comp_results"]
+        workbook_key = workbook_fingerprint(data)
+        indicators = indicator_view(workbook_key, data)
+        win_probs = indicators["win_probs"]
+
+        with st.expander("📐 データ指標スコア（ローカル計算）"):
+            st.caption("E: 過去データ適合（年齢・枠順・騎手・血統・前走）を期待値表から算出。A〜D・F はAIが評価します。")
+            st.dataframe(indicators["scores"], use_container_width=True)
+
+        with st.expander("🎫 買い目エンジン（全組合せの的中確率・期待値）"):
+            prob_model = st.radio(
+                "着順確率モデル", ["harville", "henery"], horizontal=True, key="prob_model"
+            )
+            win_odds_text = st.text_input(
+                "単勝オッズ（任意・全馬分）", placeholder="1:12.5, 2:30.1, 3:8.4, ...", key="win_odds"
+            )
+            bets = ticket_view(workbook_key, prob_model, win_odds_text, win_probs)
+            if win_odds_text and bets["market_probs"] is None:
+                st.warning("単勝オッズは全馬分を「馬番:オッズ」で入力してください（期待値は計算しません）")
+            tickets = bets["tickets"]
+            for bet_type in BET_TYPES:
+                st.caption(bet_type)
+                st.dataframe(
+                    tickets[tickets["券種"] == bet_type].drop(columns=["馬番"]).head(10),
+                    use_container_width=True,
+                    hide_index=True,
+                )
+
+        with st.expander("💴 資金配分（最適化）"):
+            budget = int(st.number_input("予算（円）", min_value=100, value=10000, step=100, key="budget"))
+            allocation = allocation_view(workbook_key, prob_model, win_odds_text, budget, win_probs)
+            for name, res in allocation.items():
+                st.caption(
+                    f"{name}: 的中確率 {res['hit_prob']:.1%} / 期待払戻 {res['expected_return']:,.0f}円 / "
+                    f"標準偏差 {res['std']:,.0f}円"
+                )
+                st.dataframe(res["tickets"], use_container_width=True, hide_index=True)
+
+        with st.expander("🎲 レースシミュレーション（モンテカルロ）"):
+            sim_cols = st.columns(3)
+            sim_model = sim_cols[0].selectbox("モデル", SIM_MODELS, key="sim_model")
+            sim_races = sim_cols[1].selectbox(
+                "試行回数", [100_000, 1_000_000, 5_000_000], index=1, format_func=lambda x: f"{x:,}回", key="sim_races"
+            )
+            sim_workers = sim_cols[2].number_input(
+                "プロセス数", min_value=1, max_value=os.cpu_count() or 1, value=1, key="sim_workers"
+            )
+            if st.button("🎲 シミュレーション実行", key="sim_btn"):
+                st.session_state["sim_result"] = simulate_race(
+                    win_probs, n_races=sim_races, model=sim_model, n_workers=int(sim_workers)
+                )
+            sim = st.session_state.get("sim_result")
+            if sim:
+                if sim.get("worker_error"):
+                    st.warning(f"並列実行に失敗したため1プロセスで計算しました（{sim['worker_error']}）")
+                st.caption(
+                    f"{sim['n_races']:,}レース / 計算 {sim['elapsed_sec']:.2f}秒 / "
+                    f"{sim['races_per_sec']:,.0f} races/sec（{sim['n_workers']}プロセス）"
+                    + (f" / プロセス起動など {sim['startup_sec']:.2f}秒" if sim["n_workers"] > 1 or sim.get("worker_error") else "")
+                )
+                st.dataframe(simulation_summary(sim).round(3), use_container_width=True)
 
         st.markdown('<div class="label label-step1">STEP1: データ傾向分析</div>', unsafe_allow_html=True)
         ph1 = st.empty()
         st.markdown('<div class="label label-step2">STEP2: 馬の選定</div>', unsafe_allow_html=True)
         ph2 = st.empty()
+        ph2_scores = st.empty()
         st.markdown('<div class="label label-step3">STEP3: 買い目提案</div>', unsafe_allow_html=True)
         ph3 = st.empty()
 
-        # 既存結果（再実行していないときは保持表示）
-        if comp["step1"]:
-            ph1.markdown(render_box("📊 データ傾向", comp["step1"], "result-box"), unsafe_allow_html=True)
-        if comp["step2"]:
-            ph2.markdown(render_box("🏇 推奨馬", comp["step2"], "result-box"), unsafe_allow_html=True)
-        if comp["step3"]:
-            ph3.markdown(render_box("💰 買い目", comp["step3"], "result-box"), unsafe_allow_html=True)
-
         if start_btn:
             if client is None:
                 st.error("APIキーを設定してください")
             else:
-                comp["step1"] = None
-                comp["step2"] = None
-                comp["step3"] = None
-                ph1.empty()
-                ph2.empty()
-                ph3.empty()
-
-                ph1.info("📊 分析中...")
-                ensure_daily_gpt_search(client, search_query)
-                render_sidebar_search(sb_debug, sb_body)
-                comp["step1"] = analyze_data_summary(client, data)
+                params = {"prob_model": prob_model, "budget": budget}
+                pipeline = comprehensive_pipeline(
+                    client, data, format_tickets_for_prompt(tickets), format_allocation_for_prompt(allocation, budget)
+                )
+                st.query_params["comp_job"] = submit_job("comprehensive", params, pipeline)
+                comp_job = attached_job("comp_job")
+
+        if comp_job is not None:
+            # 実行中・完了済みのジョブから表示を組み立てる（リロード後もここで再接続する）
+            render_job_steps(comp_job, {
+                "step1": (ph1, "📊 データ傾向", "result-box", "📊 分析中..."),
+                "step2": (ph2, "🏇 推奨馬", "result-box", "🐴 評価中..."),
+                "step3": (ph3, "💰 買い目", "result-box", "💰 検討中..."),
+            })
+            for step in ("step1", "step2", "step2_data", "step3"):
+                if step in comp_job["progress"]["finished"]:
+                    comp[step] = comp_job["progress"]["steps"][step]
+            polling = polling or job_is_active(comp_job)
+        else:
+            # 既存結果（再実行していないときは保持表示）
+            if comp["step1"]:
                 ph1.markdown(render_box("📊 データ傾向", comp["step1"], "result-box"), unsafe_allow_html=True)
-
-                ph2.info("🐴 評価中...")
-                comp["step2"] = predict_horses(client, data, comp["step1"])
+            if comp["step2"]:
                 ph2.markdown(render_box("🏇 推奨馬", comp["step2"], "result-box"), unsafe_allow_html=True)
-
-                ph3.info("💰 検討中...")
-                comp["step3"] = suggest_betting(client, comp["step2"])
+            if comp["step3"]:
                 ph3.markdown(render_box("💰 買い目", comp["step3"], "result-box"), unsafe_allow_html=True)
 
+        p_outcome = bets["p_outcome"]
+        # 実行中のジョブがあるときは、前回の買い目ではなく今回の STEP3 が揃ってから評価する
+        step3_ready = comp_job is None or "step3" in comp_job["progress"]["finished"]
+        if comp["step3"] and step3_ready:
+            with st.expander("🧮 買い目カバレッジ（重複・カバー率・的中確率）"):
+                render_ticket_coverage(comp["step3"], p_outcome, allocation_tickets(allocation))
+
+        if comp.get("step2_data"):
+            with ph2_scores.container():
+                with st.expander("📋 全馬スコア（A〜F・合計、E はデータ指標で上書き）"):
+                    st.dataframe(pd.DataFrame(comp["step2_data"]["scores"]), use_container_width=True, hide_index=True)
+
     # =========================
     # タブ2: 単体評価
     # =========================
@@ -1211,7 +4244,15 @@ def main():
                 key="horse_select_v2",  # keyを変更してキャッシュを強制リフレッシュ
             )
             
-            eval_btn = st.button("🔍 評価スタート", key="eval_btn", use_container_width=True)
+            eval_job = attached_job("eval_job")
+            eval_btn = st.button(
+                "🔍 評価スタート", key="eval_btn", use_container_width=True, disabled=job_is_active(eval_job)
+            )
+            eval_structured = st.toggle(
+                "⚡ 一括評価モード（1回の呼び出しで4評価を構造化出力）",
+                key="eval_structured",
+                help="馬・騎手・コース・総評をまとめて1リクエストで評価します。途中経過のストリーミング表示はありません。",
+            )
 
         horse_info = HORSE_LIST_2025[horse_num]
         st.markdown(f"## [{horse_info['枠番']}枠] {horse_info['馬番']}番｜{horse_info['馬名']}（{horse_info['騎手']}）")        
@@ -1231,43 +4272,39 @@ def main():
         st.markdown('<div class="label label-total">📊 総合評価</div>', unsafe_allow_html=True)
         ph_t = st.empty()
 
-        saved = st.session_state["eval_results"].get(horse_num)
-
-        # 保存済みがあれば表示（押していない時だけ）
-        if saved and not eval_btn:
-            ph_h.markdown(render_box("", saved["h"], "analysis-box box-horse"), unsafe_allow_html=True)
-            ph_j.markdown(render_box("", saved["j"], "analysis-box box-jockey"), unsafe_allow_html=True)
-            ph_c.markdown(render_box("", saved["c"], "analysis-box box-course"), unsafe_allow_html=True)
-            ph_t.markdown(render_box("", saved["t"], "analysis-box box-total"), unsafe_allow_html=True)
+        with st.expander("📐 過去データ照合（期待値表との突き合わせ）"):
+            st.dataframe(get_horse_features(data).loc[[horse_num]].T, use_container_width=True)
 
         if eval_btn:
             if client is None:
                 st.error("APIキーを設定してください")
             else:
-                ph_h.empty()
-                ph_j.empty()
-                ph_c.empty()
-                ph_t.empty()
-
-                ph_h.info("分析中...")
-                ensure_daily_gpt_search(client, search_query)
-                render_sidebar_search(sb_debug, sb_body)
-                h_res = analyze_horse(client, horse_info, data)
-                ph_h.markdown(render_box("", h_res, "analysis-box box-horse"), unsafe_allow_html=True)
-
-                ph_j.info("分析中...")
-                j_res = analyze_jockey(client, horse_info, data)
-                ph_j.markdown(render_box("", j_res, "analysis-box box-jockey"), unsafe_allow_html=True)
-
-                ph_c.info("分析中...")
-                c_res = analyze_course(client, horse_info, data)
-                ph_c.markdown(render_box("", c_res, "analysis-box box-course"), unsafe_allow_html=True)
-
-                ph_t.info("統合中...")
-                t_res = analyze_total(client, horse_info, h_res, j_res, c_res)
-                ph_t.markdown(render_box("", t_res, "analysis-box box-total"), unsafe_allow_html=True)
-
-                st.session_state["eval_results"][horse_num] = {"h": h_res, "j": j_res, "c": c_res, "t": t_res}
+                st.query_params["eval_job"] = submit_job(
+                    "evaluation",
+                    {"horse_num": horse_num, "structured": eval_structured},
+                    evaluation_pipeline(client, data, horse_info, structured=eval_structured),
+                )
+                eval_job = attached_job("eval_job")
+
+        if eval_job is not None and eval_job["params"]["horse_num"] == horse_num:
+            render_job_steps(eval_job, {
+                "h": (ph_h, "", "analysis-box box-horse", "分析中..."),
+                "j": (ph_j, "", "analysis-box box-jockey", "分析中..."),
+                "c": (ph_c, "", "analysis-box box-course", "分析中..."),
+                "t": (ph_t, "", "analysis-box box-total", "統合中..."),
+            })
+            if eval_job["status"] == "done":
+                steps = eval_job["progress"]["steps"]
+                st.session_state["eval_results"][horse_num] = {k: steps[k] for k in ("h", "j", "c", "t")}
+        else:
+            # 保存済みがあれば表示
+            saved = st.session_state["eval_results"].get(horse_num)
+            if saved:
+                ph_h.markdown(render_box("", saved["h"], "analysis-box box-horse"), unsafe_allow_html=True)
+                ph_j.markdown(render_box("", saved["j"], "analysis-box box-jockey"), unsafe_allow_html=True)
+                ph_c.markdown(render_box("", saved["c"], "analysis-box box-course"), unsafe_allow_html=True)
+                ph_t.markdown(render_box("", saved["t"], "analysis-box box-total"), unsafe_allow_html=True)
+        polling = polling or job_is_active(eval_job)
 
     # =========================
     # タブ3: サイン理論（再実行時に前回結果を全消し）
@@ -1283,7 +4320,16 @@ def main():
 
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
-            sign_btn = st.button("🔮 サイン分析", key="sign_btn", use_container_width=True)
+            sign_job = attached_job("sign_job")
+            sign_btn = st.button(
+                "🔮 サイン分析", key="sign_btn", use_container_width=True, disabled=job_is_active(sign_job)
+            )
+            sign_narrative = st.toggle("📖 サイン抽出にAIの解説を付ける", key="sign_narrative")
+
+        with st.expander("🔢 サイン数字の索引（ルールベース・馬番ごとのスコア）"):
+            st.dataframe(
+                pd.DataFrame(sign_number_index(get_events_2025())["scores"]), use_container_width=True, hide_index=True
+            )
 
         col_e, col_n = st.columns(2)
         with col_e:
@@ -1299,41 +4345,38 @@ def main():
 
         sign = st.session_state["sign_results"]
 
-        # 既存結果（再実行していないときは保持表示）
-        if sign["events"]:
-            ph_e.markdown(render_box("", sign["events"], "analysis-box box-events"), unsafe_allow_html=True)
-        if sign["numbers"]:
-            ph_n.markdown(render_box("", sign["numbers"], "analysis-box box-numbers"), unsafe_allow_html=True)
-        if sign["bet"]:
-            ph_b.markdown(render_box("", sign["bet"], "analysis-box box-buy"), unsafe_allow_html=True)
-
         if sign_btn:
             if client is None:
                 st.error("APIキーを設定してください")
             else:
-                sign["events"] = None
-                sign["numbers"] = None
-                sign["bet"] = None
-                ph_e.empty()
-                ph_n.empty()
-                ph_b.empty()
-
-                ph_e.info("収集中...")
-                ensure_daily_gpt_search(client, search_query)
-                render_sidebar_search(sb_debug, sb_body)
-                e_res = get_events_2025(client)
-                sign["events"] = e_res
-                ph_e.markdown(render_box("", e_res, "analysis-box box-events"), unsafe_allow_html=True)
-
-                ph_n.info("抽出中...")
-                n_res = extract_numbers(client, e_res)
-                sign["numbers"] = n_res
-                ph_n.markdown(render_box("", n_res, "analysis-box box-numbers"), unsafe_allow_html=True)
-
-                ph_b.info("導出中...")
-                b_res = sign_betting(client, e_res, n_res)
-                sign["bet"] = b_res
-                ph_b.markdown(render_box("", b_res, "analysis-box box-buy"), unsafe_allow_html=True)
+                st.query_params["sign_job"] = submit_job(
+                    "sign", {"narrative": sign_narrative}, sign_pipeline(client, narrative=sign_narrative)
+                )
+                sign_job = attached_job("sign_job")
+
+        if sign_job is not None:
+            render_job_steps(sign_job, {
+                "events": (ph_e, "", "analysis-box box-events", "収集中..."),
+                "numbers": (ph_n, "", "analysis-box box-numbers", "抽出中..."),
+                "bet": (ph_b, "", "analysis-box box-buy", "導出中..."),
+            })
+            for step in ("events", "numbers", "bet"):
+                if step in sign_job["progress"]["finished"]:
+                    sign[step] = sign_job["progress"]["steps"][step]
+            polling = polling or job_is_active(sign_job)
+        else:
+            # 既存結果（再実行していないときは保持表示）
+            if sign["events"]:
+                ph_e.markdown(render_box("", sign["events"], "analysis-box box-events"), unsafe_allow_html=True)
+            if sign["numbers"]:
+                ph_n.markdown(render_box("", sign["numbers"], "analysis-box box-numbers"), unsafe_allow_html=True)
+            if sign["bet"]:
+                ph_b.markdown(render_box("", sign["bet"], "analysis-box box-buy"), unsafe_allow_html=True)
+
+        bet_ready = sign_job is None or "bet" in sign_job["progress"]["finished"]
+        if sign["bet"] and bet_ready:
+            with st.expander("🧮 買い目カバレッジ（データ指標の着順確率で評価）"):
+                render_ticket_coverage(sign["bet"], p_outcome)
 
     st.markdown("---")
     st.markdown(
@@ -1343,5 +4386,20 @@ def main():
         unsafe_allow_html=True,
     )
 
+    # ジョブが取得した検索結果をサイドバーに写す（一番新しく登録されたジョブを優先）
+    jobs = [j for j in (comp_job, eval_job, sign_job) if j is not None and "search" in j["progress"]["steps"]]
+    if jobs:
+        mirror_search_state(max(jobs, key=lambda j: j["created_at"])["progress"]["steps"]["search"])
+    render_sidebar_search(sb_debug, sb_body)
+
+    record_run_timing(import_sec, time.perf_counter() - _SCRIPT_STARTED)
+    with startup_slot.container():
+        with st.expander("⏱️ 起動時間"):
+            st.dataframe(startup_report_frame(), use_container_width=True, hide_index=True)
+
+    if polling:
+        time.sleep(JOB_POLL_SEC)
+        st.rerun()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,140 @@
+import io
+import os
+import sys
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeClock:
+    """time.time の代わり。advance() した分だけ進む。"""
+
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, sec: float) -> None:
+        self.now += sec
+
+
+class FakeOpenAI:
+    """client.responses.create だけを持つ偽クライアント。返す値（または stream=True 時のイベント列）を順に使う。"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+        self.responses = SimpleNamespace(create=self._create)
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        result = self.results.pop(0)
+        return iter(result) if kwargs.get("stream") else result
+
+
+def response(text: str, status: str = "completed") -> SimpleNamespace:
+    return SimpleNamespace(output_text=text, status=status, usage=None)
+
+
+def event(type_: str, **fields) -> SimpleNamespace:
+    return SimpleNamespace(type=type_, **fields)
+
+
+@pytest.fixture
+def fake_openai():
+    return SimpleNamespace(client=FakeOpenAI, response=response, event=event)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(app.time, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    app.get_circuit_breaker.clear()
+    monkeypatch.setattr(app, "BREAKER_FAILURE_THRESHOLD", 2)
+    yield app.get_circuit_breaker()
+    app.get_circuit_breaker.clear()
+
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "LLM_CACHE_PATH", str(tmp_path / "llm_cache.sqlite3"))
+    app.get_llm_cache.clear()
+    cache = app.get_llm_cache()
+    yield cache
+    cache["conn"].close()
+    app.get_llm_cache.clear()
+
+
+@pytest.fixture
+def job_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "JOBS_DB_PATH", str(tmp_path / "jobs.sqlite3"))
+    app.get_job_store.clear()
+    yield app.get_job_store
+    store = app.get_job_store()
+    store["executor"].shutdown(wait=True)
+    store["conn"].close()
+    app.get_job_store.clear()
+
+
+@pytest.fixture(scope="session")
+def workbook(tmp_path_factory):
+    """同梱の arima_data.xlsx（スナップショットは一時ディレクトリに書く）。"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, "arima_data.xlsx"), "rb") as f:
+        raw = io.BytesIO(f.read())
+    snapshot_dir = app.SNAPSHOT_DIR
+    app.SNAPSHOT_DIR = str(tmp_path_factory.mktemp("snapshots"))
+    try:
+        data, errors = app.load_race_data(raw)
+    finally:
+        app.SNAPSHOT_DIR = snapshot_dir
+    assert data is not None and not errors
+    return data
+
+
+STAT_HEADER = ["区分", "出走数(2015-2024)"] + app.STAT_SHEET_COLUMNS
+
+
+def stat_sheet(*rows) -> pd.DataFrame:
+    """(区分, 出走数, 1着, 2着, 3着, 期待値ポイント) の行から期待値シートを作る。"""
+    records = []
+    for label, runs, first, second, third, ev in rows:
+        rate = lambda n: n / runs if runs else float("nan")  # noqa: E731
+        records.append(
+            [label, runs, first, second, third, runs - first - second - third,
+             rate(first), rate(first + second), rate(first + second + third), ev]
+        )
+    return pd.DataFrame(records, columns=STAT_HEADER)
+
+
+@pytest.fixture
+def horses():
+    return {
+        1: {"枠番": 1, "馬番": 1, "馬名": "アルファ", "性齢": "牡3歳", "騎手": "騎手 甲", "血統": "父A", "前走": "菊花賞1着"},
+        2: {"枠番": 2, "馬番": 2, "馬名": "ベータ", "性齢": "牝7歳", "騎手": "騎手乙", "血統": "父B", "前走": "ジャパンC8着"},
+    }
+
+
+@pytest.fixture
+def stat_data():
+    """horses の1番は期待値100、2番は50の行に当たる（全体平均は75）。前走クラスはどちらも G1（80）。"""
+    return {
+        "年齢": stat_sheet(("3歳", 10, 2, 1, 1, 100), ("7歳以上", 10, 0, 1, 1, 50)),
+        "枠順": stat_sheet(("1枠", 10, 2, 1, 1, 100), ("2枠", 10, 0, 1, 1, 50)),
+        "騎手": stat_sheet(("騎手甲", 10, 2, 1, 1, 100), ("騎手乙", 10, 0, 1, 1, 50)),
+        "血統": stat_sheet(("父A", 10, 2, 1, 1, 100), ("その他", 10, 0, 1, 1, 50)),
+        "前走クラス": stat_sheet(("G1", 20, 2, 2, 2, 80), ("G2", 0, 0, 0, 0, 999)),
+        "前走レース別": stat_sheet(("菊花賞", 10, 2, 1, 1, 100), ("ジャパンカップ", 10, 0, 1, 1, 50)),
+        "馬体重増減": stat_sheet(("+10kg以上", 10, 2, 1, 1, 100), ("+-2kg", 10, 0, 1, 1, 50)),
+    }
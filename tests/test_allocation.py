@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.fixture(scope="module")
+def win_probs(workbook):
+    return app.win_probabilities_from_scores(app.compute_indicator_scores(workbook))
+
+
+def assert_risk_order(results):
+    hit = [results[name]["hit_prob"] for name in app.RISK_PROFILES]
+    std = [results[name]["std"] for name in app.RISK_PROFILES]
+    assert list(app.RISK_PROFILES) == ["安全型", "バランス型", "攻め型"]
+    assert hit[0] > hit[1] > hit[2]
+    assert std[0] < std[1] < std[2]
+
+
+def test_profiles_order_hit_rate_and_variance(win_probs):
+    assert_risk_order(app.optimize_budget(win_probs))
+
+
+@pytest.mark.parametrize("gamma", [0.6, 1.4])
+def test_profiles_keep_order_with_market_odds(win_probs, gamma):
+    market = win_probs**gamma / (win_probs**gamma).sum()
+    assert_risk_order(app.optimize_budget(win_probs, market_probs=market))
+
+
+def test_allocation_spends_budget_within_ticket_limits(win_probs):
+    results = app.optimize_budget(win_probs, budget=10000)
+    for name, res in results.items():
+        profile = app.RISK_PROFILES[name]
+        tickets = res["tickets"]
+        assert tickets["金額"].sum() == 10000
+        assert (tickets["金額"] % 100 == 0).all()
+        assert len(tickets) <= profile["max_tickets"]
+        assert set(tickets["券種"]) <= set(profile["bet_types"])
+        assert 0.0 < res["hit_prob"] <= 1.0 and np.isfinite(res["std"])
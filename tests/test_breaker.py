@@ -0,0 +1,103 @@
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+import app
+
+
+def connection_error():
+    return openai.APIConnectionError(request=None)
+
+
+def trip(breaker):
+    for _ in range(app.BREAKER_FAILURE_THRESHOLD):
+        app._breaker_acquire()
+        app._breaker_record(False)
+    assert breaker["state"] == "open"
+
+
+def test_opens_after_threshold(breaker, clock):
+    app._breaker_acquire()
+    app._breaker_record(False)
+    assert breaker["state"] == "closed"
+    app._breaker_acquire()
+    app._breaker_record(False)
+    assert breaker["state"] == "open"
+    with pytest.raises(app.UpstreamUnavailableError):
+        app._breaker_acquire()
+
+
+def test_half_open_allows_one_probe_then_closes(breaker, clock):
+    trip(breaker)
+    clock.advance(app.BREAKER_COOLDOWN_SEC + 1)
+    app._breaker_acquire()
+    assert breaker["state"] == "half_open" and breaker["probing"]
+    # 試験呼び出しの結果が出るまで他は通さない
+    with pytest.raises(app.UpstreamUnavailableError):
+        app._breaker_acquire()
+    app._breaker_record(True)
+    assert breaker["state"] == "closed"
+    assert breaker["failures"] == 0 and not breaker["probing"]
+
+
+def test_failed_probe_reopens(breaker, clock):
+    trip(breaker)
+    clock.advance(app.BREAKER_COOLDOWN_SEC + 1)
+    app._breaker_acquire()
+    app._breaker_record(False)
+    assert breaker["state"] == "open"
+    assert breaker["opened_at"] == clock.now
+    with pytest.raises(app.UpstreamUnavailableError):
+        app._breaker_acquire()
+
+
+def test_openai_call_retries_then_gives_up(breaker, clock, monkeypatch):
+    monkeypatch.setattr(app, "_retry_delay", lambda attempt, error: 0.0)
+    monkeypatch.setattr(app, "BREAKER_FAILURE_THRESHOLD", 100)
+    calls = []
+
+    def create():
+        calls.append(1)
+        raise connection_error()
+
+    with pytest.raises(app.UpstreamUnavailableError):
+        app.openai_call(create)
+    assert len(calls) == app.RETRY_MAX_ATTEMPTS
+    assert breaker["failures"] == app.RETRY_MAX_ATTEMPTS
+
+
+def test_client_error_does_not_count_as_failure(breaker, clock):
+    def create():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        app.openai_call(create)
+    assert breaker["state"] == "closed" and breaker["failures"] == 0
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: str):
+        super().__init__("429")
+        self.response = SimpleNamespace(headers={"retry-after": retry_after})
+
+
+def test_retry_after_is_not_capped(monkeypatch):
+    monkeypatch.setattr(app.random, "uniform", lambda a, b: b)
+    assert app._retry_delay(0, RateLimited("60")) == 60.0
+    assert app._retry_delay(10, Exception()) == app.RETRY_MAX_DELAY_SEC
+
+
+def test_long_retry_after_fails_fast(breaker, clock, monkeypatch):
+    monkeypatch.setattr(app, "_is_retryable", lambda error: True)
+    slept = []
+    monkeypatch.setattr(app.time, "sleep", slept.append)
+    calls = []
+
+    def create():
+        calls.append(1)
+        raise RateLimited(str(int(app.RETRY_AFTER_MAX_SEC) + 60))
+
+    with pytest.raises(app.UpstreamUnavailableError):
+        app.openai_call(create)
+    assert len(calls) == 1 and slept == []
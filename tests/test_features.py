@@ -0,0 +1,35 @@
+import numpy as np
+
+import app
+
+
+def test_race_columns_are_parsed(stat_data, horses):
+    features = app.get_horse_features(stat_data, horses)
+    assert features.index.name == "馬番"
+    assert list(features["前走着順"]) == [1.0, 8.0]
+    assert list(features["前走距離"]) == [3000.0, 2400.0]  # ジャパンC は別名で引く
+    assert list(features["牝馬"]) == [0.0, 1.0]
+    assert list(features["年齢"]) == [3.0, 7.0]
+
+
+def test_sheet_rows_are_joined_with_other_fallback(stat_data, horses):
+    features = app.get_horse_features(stat_data, horses)
+    assert list(features["期待値_騎手"]) == [100, 50]  # 空白を除いて照合
+    assert list(features["期待値_血統"]) == [100, 50]  # 父B は「その他」行
+    assert list(features["出走数_前走クラス"]) == [20, 20]
+
+
+def test_unknown_race_and_zero_run_rows(stat_data, horses):
+    horses[2]["前走"] = "有馬記念"
+    stat_data["前走レース別"].loc[0, "出走数(2015-2024)"] = 0
+    features = app.get_horse_features(stat_data, horses)
+    # 出走数0の行は期待値を使わない／表に無く「その他」行も無ければ NaN
+    assert features["期待値_前走レース別"].isna().all()
+    assert np.isnan(features.loc[2, "前走着順"]) and np.isnan(features.loc[2, "前走距離"])
+
+
+def test_bundled_workbook_gives_numeric_matrix(workbook):
+    features = app.get_horse_features(workbook)
+    assert features.shape[0] == len(app.HORSE_LIST_2025)
+    assert all(np.issubdtype(dtype, np.number) for dtype in features.dtypes)
+    assert {f"期待値_{sheet}" for sheet in app.E_FACTOR_SHEETS} <= set(features.columns)
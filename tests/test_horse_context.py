@@ -0,0 +1,33 @@
+import app
+
+
+def test_only_matching_rows_and_baselines_are_included(stat_data, horses):
+    context = app.build_horse_context(stat_data, horses[1], ["年齢", "騎手"])
+    lines = context.splitlines()
+    assert lines[0] == "【年齢】"
+    assert lines[1].startswith("該当: 3歳 | 出走数10 | 1着2 2着1 3着1 | 勝率20.0% 連対率30.0% 複勝率40.0%")
+    assert lines[2] == "全体平均: 出走数20 | 勝率10.0% 連対率20.0% 複勝率30.0% | 期待値75.00"
+    assert "7歳以上" not in context and "騎手乙" not in context
+    assert lines[3] == "【騎手】" and lines[4].startswith("該当: 騎手甲 |")
+
+
+def test_unlisted_value_falls_back_to_other_row(stat_data, horses):
+    context = app.build_horse_context(stat_data, horses[2], ["血統"])
+    assert "該当: 父B→その他 | 出走数10" in context
+
+
+def test_weight_change_and_missing_sheets(stat_data, horses):
+    sheets = ["馬体重増減", "存在しないシート"]
+    assert "該当: （当日未発表）" in app.build_horse_context(stat_data, horses[1], sheets)
+    context = app.build_horse_context(stat_data, horses[1], sheets, weight_change=-1)
+    assert "該当: +-2kg | 出走数10" in context
+    assert "存在しないシート" not in context
+    assert app.build_horse_context(None, horses[1], sheets) == "データなし"
+
+
+def test_search_lines_about_other_runners_are_dropped():
+    horse = app.HORSE_LIST_2025[1]
+    other = app.HORSE_LIST_2025[2]["馬名"]
+    text = f"【ニュース】\n{horse['馬名']}は順調\n{other}が追い切り\n当日は良馬場\n{other}と{horse['馬名']}が併せ馬"
+    kept = app.slice_search_for_horse(text, horse).splitlines()
+    assert kept == ["【ニュース】", f"{horse['馬名']}は順調", "当日は良馬場", f"{other}と{horse['馬名']}が併せ馬"]
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import app
+
+
+def test_e_averages_factor_scores_against_sheet_baseline(stat_data, horses):
+    scores = app.compute_indicator_scores(stat_data, horses)
+    assert list(scores["馬名"]) == ["アルファ", "ベータ"]
+    # 期待値 / 出走数加重平均 × 2.5
+    assert list(scores["E_年齢"]) == [3.3, 1.7]
+    assert list(scores["E_血統"]) == [3.3, 1.7]  # 父B は「その他」行
+    assert list(scores["E_前走クラス"]) == [2.5, 2.5]  # 出走数0の行は基準値に含めない
+    assert scores.loc[1, "E"] == pytest.approx(round((5 * 100 / 75 * 2.5 + 2.5) / 6, 1))
+    assert scores.loc[2, "E"] == pytest.approx(round((5 * 50 / 75 * 2.5 + 2.5) / 6, 1))
+
+
+def test_llm_indicators_stay_nan(stat_data, horses):
+    scores = app.compute_indicator_scores(stat_data, horses)
+    assert scores[["A", "B", "C", "D", "F"]].isna().all().all()
+
+
+def test_f_scores_weight_change_bucket(stat_data, horses):
+    scores = app.compute_indicator_scores(stat_data, horses, weight_changes={1: 12, 2: 0})
+    assert list(scores["F"]) == [3.3, 1.7]
+    partial = app.compute_indicator_scores(stat_data, horses, weight_changes={1: 12})
+    assert partial.loc[1, "F"] == 3.3 and np.isnan(partial.loc[2, "F"])
+
+
+def test_missing_sheet_is_left_out_of_e(stat_data, horses):
+    del stat_data["前走クラス"]
+    scores = app.compute_indicator_scores(stat_data, horses)
+    assert "E_前走クラス" not in scores
+    assert list(scores["E"]) == [3.3, 1.7]
+
+
+def test_bundled_workbook_scores_every_runner(workbook):
+    scores = app.compute_indicator_scores(workbook)
+    assert list(scores.index) == sorted(app.HORSE_LIST_2025)
+    assert scores["E"].between(0, 5).all()
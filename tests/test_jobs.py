@@ -0,0 +1,72 @@
+import threading
+import time
+
+import app
+
+
+def wait_for(job_id):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        job = app.get_job(job_id)
+        if not app.job_is_active(job):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"ジョブが終わらない: {job_id}")
+
+
+def test_job_runs_in_background_and_keeps_progress(job_store):
+    owners = []
+
+    def pipeline(report):
+        owners.append(app._current_session_id())
+        report("step1", "途中")
+        report("step1", "完了", final=True)
+        report("step2", {"picks": [1, 2]}, final=True)
+
+    job_id = app.submit_job("predict", {"model": "harville"}, pipeline)
+    job = wait_for(job_id)
+    assert job["status"] == "done" and job["error"] is None
+    assert job["kind"] == "predict" and job["params"] == {"model": "harville"}
+    assert job["progress"]["steps"] == {"step1": "完了", "step2": {"picks": [1, 2]}}
+    assert job["progress"]["finished"] == ["step1", "step2"]
+    assert owners == [job["owner"]]  # 登録したセッションとしてレート制限を数える
+
+
+def test_failure_is_recorded_with_partial_progress(job_store):
+    def pipeline(report):
+        report("step1", "出力", final=True)
+        raise RuntimeError("途中で失敗")
+
+    job = wait_for(app.submit_job("predict", {}, pipeline))
+    assert job["status"] == "error"
+    assert job["error"] == "RuntimeError: 途中で失敗"
+    assert job["progress"]["steps"] == {"step1": "出力"}
+
+
+def test_upstream_outage_message_is_shown_as_is(job_store):
+    def pipeline(report):
+        raise app.UpstreamUnavailableError("しばらく待ってから再実行してください")
+
+    job = wait_for(app.submit_job("predict", {}, pipeline))
+    assert job["error"] == "しばらく待ってから再実行してください"
+
+
+def test_restart_marks_unfinished_jobs_interrupted(job_store):
+    release = threading.Event()
+    job_id = app.submit_job("predict", {}, lambda report: release.wait(5))
+    assert app.job_is_active(app.get_job(job_id))
+
+    store = job_store()
+    job_store.clear()  # 再起動相当：新しいストアが同じ DB を開く
+    try:
+        job = app.get_job(job_id)
+        assert job["status"] == "error" and "再起動" in job["error"]
+    finally:
+        release.set()
+        store["executor"].shutdown(wait=True)
+        store["conn"].close()
+
+
+def test_unknown_job_is_none(job_store):
+    assert app.get_job("") is None
+    assert app.get_job("missing") is None
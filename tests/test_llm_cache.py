@@ -0,0 +1,47 @@
+import app
+
+
+def test_llm_cache_roundtrip(llm_cache, clock):
+    assert app.llm_cache_get("a") is None
+    app.llm_cache_put("a", "応答")
+    assert app.llm_cache_get("a") == "応答"
+    assert app.llm_cache_stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+def test_llm_cache_ttl_expiry(llm_cache, clock):
+    app.llm_cache_put("a", "応答")
+    clock.advance(app.LLM_CACHE_TTL_SEC + 1)
+    assert app.llm_cache_get("a") is None
+    assert app.llm_cache_stats()["entries"] == 0
+
+
+def test_llm_cache_evicts_least_recently_used(llm_cache, clock, monkeypatch):
+    monkeypatch.setattr(app, "LLM_CACHE_MAX_ENTRIES", 2)
+    app.llm_cache_put("a", "A")
+    clock.advance(1)
+    app.llm_cache_put("b", "B")
+    clock.advance(1)
+    assert app.llm_cache_get("a") == "A"  # a を最近使った側にする
+    clock.advance(1)
+    app.llm_cache_put("c", "C")
+    assert app.llm_cache_get("b") is None
+    assert app.llm_cache_get("a") == "A"
+    assert app.llm_cache_get("c") == "C"
+
+
+def call(client, **kwargs):
+    return app._call_gpt5mini_text(client, "system", "user", 100, **kwargs)
+
+
+def test_completed_response_is_cached(llm_cache, fake_openai):
+    client = fake_openai.client(fake_openai.response("回答"))
+    assert call(client) == "回答"
+    assert call(client) == "回答"
+    assert len(client.calls) == 1
+
+
+def test_incomplete_response_is_not_cached(llm_cache, fake_openai):
+    client = fake_openai.client(fake_openai.response("途中で", "incomplete"), fake_openai.response("全文"))
+    assert call(client) == "途中で"
+    assert call(client) == "全文"
+    assert len(client.calls) == 2
@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.fixture
+def local_scores():
+    return pd.DataFrame({"E": [4.0, np.nan]}, index=[1, 2])
+
+
+def llm_output(horses, picks):
+    return json.dumps({"horses": horses, "picks": picks}, ensure_ascii=False)
+
+
+def test_scores_use_local_e_and_are_clamped(local_scores):
+    text = llm_output(
+        [
+            {"number": 1, "A": 3, "B": 2, "C": 1, "D": 1, "E": 0, "F": None, "risk": "外枠"},
+            {"number": 2, "A": 9, "B": -1, "C": "x", "D": 2.04, "E": 3, "F": 1},
+        ],
+        [],
+    )
+    prediction = app.parse_prediction(text, local_scores)
+    rows = {row["馬番"]: row for row in prediction["scores"]}
+    # 1番は E をローカル計算値で上書き、2番はローカル値が NaN なので LLM の値のまま
+    assert rows[1]["E"] == 4.0 and rows[1]["合計"] == 11.0 and rows[1]["リスク"] == "外枠"
+    assert (rows[2]["A"], rows[2]["B"], rows[2]["C"], rows[2]["D"]) == (5.0, 0.0, None, 2.0)
+    assert rows[2]["合計"] == 11.0
+    # 出力に無い馬も全頭ぶん並ぶ
+    assert len(rows) == len(app.HORSE_LIST_2025)
+    assert rows[3]["A"] is None and rows[3]["合計"] == 0.0
+    totals = [row["合計"] for row in prediction["scores"]]
+    assert totals == sorted(totals, reverse=True)
+
+
+def test_invalid_picks_are_dropped_and_ordered_by_mark(local_scores):
+    text = llm_output(
+        [],
+        [
+            {"mark": "▲", "number": 3, "reason": "末脚", "concern": ""},
+            {"mark": "◎", "number": 1, "reason": "実績", "concern": "距離"},
+            {"mark": "★", "number": 2, "reason": "印が違う"},
+            {"mark": "○", "number": 99, "reason": "出走していない"},
+        ],
+    )
+    picks = app.parse_prediction(text, local_scores)["picks"]
+    assert [(p["印"], p["馬番"]) for p in picks] == [("◎", 1), ("▲", 3)]
+    assert picks[0]["馬名"] == app.HORSE_LIST_2025[1]["馬名"] and picks[0]["不安点"] == "距離"
+
+
+@pytest.mark.parametrize("text", ["本命は1番", "{}", '{"horses": [{"name": "x"}], "picks": []}'])
+def test_malformed_output_raises(text, local_scores):
+    with pytest.raises(ValueError, match="構造化出力"):
+        app.parse_prediction(text, local_scores)
+
+
+def test_render_prediction_lists_picks_with_totals(local_scores):
+    text = llm_output(
+        [{"number": 1, "A": 3, "B": 2, "C": 1, "D": 1, "F": 0}],
+        [{"mark": "◎", "number": 1, "reason": "実績", "concern": "距離"}],
+    )
+    rendered = app.render_prediction(app.parse_prediction(text, local_scores))
+    name = app.HORSE_LIST_2025[1]["馬名"]
+    assert rendered == f"◎本命 1番 {name}（合計 11.0点）\n実績\n不安点：距離"
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.fixture
+def win_probs():
+    return np.random.default_rng(0).dirichlet(np.ones(16))
+
+
+@pytest.mark.parametrize("model", ["harville", "henery"])
+def test_finish_order_sums_to_one(win_probs, model):
+    p3 = app.finish_order_probabilities(win_probs, model)
+    assert p3.shape == (16, 16, 16)
+    assert p3.sum() == pytest.approx(1.0)
+    # 1着の周辺確率は単勝確率のまま
+    np.testing.assert_allclose(p3.sum(axis=(1, 2)), win_probs / win_probs.sum())
+
+
+def test_harville_by_hand():
+    p3 = app.finish_order_probabilities(np.array([0.5, 0.3, 0.2]))
+    assert p3[0, 1, 2] == pytest.approx(0.5 * 0.3 / 0.5)
+    assert p3[2, 1, 0] == pytest.approx(0.2 * 0.3 / 0.8)
+    assert p3[0, 0, 1] == 0.0
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        app.finish_order_probabilities(np.ones(3), "bad")
+
+
+@pytest.mark.parametrize("model", ["harville", "henery"])
+def test_bet_probabilities_sum(win_probs, model):
+    bets = app.bet_probabilities(app.finish_order_probabilities(win_probs, model))
+    assert bets["馬連"][1].sum() == pytest.approx(1.0)
+    assert bets["三連複"][1].sum() == pytest.approx(1.0)
+    assert bets["三連単"][1].sum() == pytest.approx(1.0)
+    # ワイドは3着以内の3組が同時に当たる
+    assert bets["ワイド"][1].sum() == pytest.approx(3.0)
+    assert len(bets["馬連"][0]) == 120
+    assert len(bets["三連複"][0]) == 560
+    assert len(bets["三連単"][0]) == 3360
+
+
+def test_outcome_probabilities_follow_outcome_space(win_probs):
+    p_outcome = app.outcome_probabilities(win_probs)
+    outcomes = app.outcome_space(16)
+    assert p_outcome.shape == (len(outcomes),)
+    assert p_outcome.sum() == pytest.approx(1.0)
+    p3 = app.finish_order_probabilities(win_probs)
+    i, j, k = outcomes[123]
+    assert p_outcome[123] == p3[i, j, k]
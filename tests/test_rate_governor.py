@@ -0,0 +1,90 @@
+from collections import deque
+
+import openai
+import pytest
+
+import app
+
+
+@pytest.fixture
+def governor(monkeypatch):
+    monkeypatch.setitem(app.RATE_LIMITS, "test-model", (2, 1000))
+    app.get_rate_governor.clear()
+    yield app.get_rate_governor()
+    app.get_rate_governor.clear()
+
+
+def test_acquire_spends_request_and_tokens(governor):
+    app.rate_limit_acquire("test-model", 300)
+    state = governor["models"]["test-model"]
+    assert state["requests"] == pytest.approx(1, abs=0.01)
+    assert state["tokens"] == pytest.approx(700, abs=1)
+    assert state["queues"] == {} and not state["ring"]
+
+
+def test_settle_refunds_unused_tokens(governor):
+    app.rate_limit_acquire("test-model", 600)
+    app.rate_limit_settle("test-model", 600, 100)
+    assert governor["models"]["test-model"]["tokens"] == pytest.approx(900, abs=1)
+
+
+def test_queue_times_out_when_bucket_is_empty(governor, monkeypatch):
+    monkeypatch.setattr(app, "RATE_QUEUE_TIMEOUT_SEC", 0.05)
+    app.rate_limit_acquire("test-model", 1000)
+    with pytest.raises(app.UpstreamUnavailableError):
+        app.rate_limit_acquire("test-model", 1000)
+    state = governor["models"]["test-model"]
+    assert state["queues"] == {} and not state["ring"]
+
+
+def test_queue_position_is_round_robin_across_sessions():
+    # A が3件、B が1件待っている。B の1件目は A の先頭1件の後に回ってくる
+    tickets = {"A": [{"tokens": 1.0} for _ in range(3)], "B": [{"tokens": 1.0}]}
+    state = {"queues": {sid: deque(t) for sid, t in tickets.items()}, "ring": deque(["A", "B"])}
+    assert app._queue_position(state, "B", tickets["B"][0]) == 1
+    assert app._queue_position(state, "A", tickets["A"][2]) == 3
+
+
+def test_rate_queue_timeout_does_not_hold_probe(breaker, clock, monkeypatch):
+    breaker.update(state="open", failures=app.BREAKER_FAILURE_THRESHOLD, opened_at=clock.now)
+    clock.advance(app.BREAKER_COOLDOWN_SEC + 1)
+
+    def timed_out(model, est_tokens, on_wait=None):
+        raise app.UpstreamUnavailableError("時間切れ")
+
+    monkeypatch.setattr(app, "rate_limit_acquire", timed_out)
+    with pytest.raises(app.UpstreamUnavailableError):
+        app.openai_call(lambda: "ok", model="gpt-5-mini", est_tokens=10)
+    assert not breaker["probing"]
+
+    monkeypatch.setattr(app, "rate_limit_acquire", lambda model, est_tokens, on_wait=None: None)
+    assert app.openai_call(lambda: "ok", model="gpt-5-mini", est_tokens=10) == "ok"
+    assert breaker["state"] == "closed"
+
+
+def test_breaker_fast_fail_refunds_tokens(governor, breaker, clock):
+    breaker.update(state="open", failures=app.BREAKER_FAILURE_THRESHOLD, opened_at=clock.now)
+    for _ in range(2):
+        with pytest.raises(app.UpstreamUnavailableError):
+            app.openai_call(lambda: "ok", model="test-model", est_tokens=600)
+    assert governor["models"]["test-model"]["tokens"] == pytest.approx(1000, abs=1)
+
+
+def test_failed_attempts_refund_tokens(governor, breaker, monkeypatch):
+    monkeypatch.setattr(app, "_retry_delay", lambda attempt, error: 0.0)
+    monkeypatch.setattr(app, "RETRY_MAX_ATTEMPTS", 2)
+
+    def failing():
+        raise openai.APIConnectionError(request=None)
+
+    with pytest.raises(app.UpstreamUnavailableError):
+        app.openai_call(failing, model="test-model", est_tokens=400)
+    assert governor["models"]["test-model"]["tokens"] == pytest.approx(1000, abs=1)
+
+
+def test_equal_tickets_are_told_apart(governor):
+    first, second = {"tokens": 1.0}, {"tokens": 1.0}
+    queue = deque([first, second])
+    assert app._ticket_index(queue, second) == 1
+    state = {"queues": {"A": queue}, "ring": deque(["A"])}
+    assert app._queue_position(state, "A", second) == 1
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    app.get_search_cache.clear()
+    calls = []
+    outcomes = []
+
+    def fake_search(client, query, max_output_tokens=3000, on_wait=None):
+        calls.append(query)
+        outcome = outcomes.pop(0) if outcomes else f"結果{len(calls)}"
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(app, "gpt_web_search", fake_search)
+    yield calls, outcomes
+    app.get_search_cache.clear()
+
+
+def settle():
+    # 裏の再検索スレッドが終わるのを待つ
+    cache = app.get_search_cache()
+    deadline = time.monotonic() + 5
+    while cache["inflight"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not cache["inflight"]
+
+
+def test_fresh_result_is_shared(searches, clock):
+    calls, _ = searches
+    first = app.shared_daily_search(None, "q", ttl_sec=60)
+    second = app.shared_daily_search(None, "q", ttl_sec=60)
+    assert first["text"] == second["text"] == "結果1"
+    assert not second["stale"] and len(calls) == 1
+
+
+def test_stale_result_is_served_while_refreshing(searches, clock):
+    calls, _ = searches
+    app.shared_daily_search(None, "q", ttl_sec=60)
+    clock.advance(61)
+    stale = app.shared_daily_search(None, "q", ttl_sec=60)
+    assert stale["text"] == "結果1" and stale["stale"]
+    settle()
+    assert app.shared_daily_search(None, "q", ttl_sec=60)["text"] == "結果2"
+
+
+def test_failed_refresh_is_recorded_and_backed_off(searches, clock):
+    calls, outcomes = searches
+    app.shared_daily_search(None, "q", ttl_sec=60)
+    clock.advance(61)
+    outcomes.append(RuntimeError("429"))
+    app.shared_daily_search(None, "q", ttl_sec=60)
+    settle()
+
+    result = app.shared_daily_search(None, "q", ttl_sec=60)
+    assert result["text"] == "結果1" and result["stale"]
+    assert result["refresh_error"] == "RuntimeError: 429"
+    assert result["refresh_failed_at"] == clock.now
+    assert len(calls) == 2  # 間隔が空くまでは再検索しない
+
+    clock.advance(app.SEARCH_REFRESH_BACKOFF_SEC)
+    app.shared_daily_search(None, "q", ttl_sec=60)
+    settle()
+    result = app.shared_daily_search(None, "q", ttl_sec=60)
+    assert len(calls) == 3
+    assert result["text"] == "結果3" and result["refresh_error"] is None
+
+
+def test_backoff_doubles_and_is_capped():
+    entry = {"refresh_failures": 3, "refresh_failed_at": 0.0}
+    assert not app._refresh_due(entry, 4 * app.SEARCH_REFRESH_BACKOFF_SEC - 1)
+    assert app._refresh_due(entry, 4 * app.SEARCH_REFRESH_BACKOFF_SEC)
+    entry["refresh_failures"] = 30
+    assert app._refresh_due(entry, app.SEARCH_REFRESH_BACKOFF_MAX_SEC)
+
+
+def test_too_old_result_is_refetched_synchronously(searches, clock):
+    calls, outcomes = searches
+    app.shared_daily_search(None, "q", ttl_sec=60)
+    clock.advance(app.SEARCH_MAX_STALENESS_SEC + 1)
+    outcomes.append(RuntimeError("down"))
+    with pytest.raises(RuntimeError):
+        app.shared_daily_search(None, "q", ttl_sec=60)
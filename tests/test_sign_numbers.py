@@ -0,0 +1,49 @@
+import pytest
+
+import app
+
+EVENTS = """■ スポーツ
+- 大会A
+   - 内容: 5回目の優勝
+   - 関連数字: 5 (5回目), 23 (23日)
+
+■ エンタメ
+- 作品B
+   - 内容: 第5作
+   - 関連数字: 5（第5作）
+"""
+
+
+@pytest.mark.parametrize(
+    "n, size, expected",
+    [
+        (5, 16, [(5, "直接")]),
+        (23, 16, [(2, "桁の分割"), (3, "桁の分割"), (5, "桁の和"), (7, "余り")]),
+        (112, 16, [(1, "桁の分割"), (2, "桁の分割"), (4, "桁の和"), (11, "桁の分割"), (12, "桁の分割"), (16, "余り")]),
+        (99, 16, [(3, "余り"), (9, "桁の和")]),  # 18 → 9 まで桁の和を繰り返す
+        (40, 8, [(4, "桁の和"), (8, "余り")]),  # 4 は桁の分割でもあるが重い規則を残す
+    ],
+)
+def test_number_targets(n, size, expected):
+    assert app.sign_number_targets(n, size) == expected
+
+
+def test_events_are_parsed_with_both_bracket_widths():
+    events = app.parse_sign_events(EVENTS)
+    assert [(e["分類"], e["出来事"], e["内容"]) for e in events] == [("スポーツ", "大会A", "5回目の優勝"), ("エンタメ", "作品B", "第5作")]
+    assert events[0]["数字"] == [(5, "5回目"), (23, "23日")]
+    assert events[1]["数字"] == [(5, "第5作")]
+
+
+def test_index_scores_each_event_once_per_horse():
+    index = app.sign_number_index(EVENTS)
+    top = index["scores"][0]
+    # 馬番5と枠番5の両方に当たっても、出来事ごとに最も強い規則1つだけ数える
+    assert (top["馬番"], top["サインスコア"], top["出来事数"], top["直接一致"]) == (5, 6, 2, 2)
+    assert {h["出来事"] for h in index["horses"][5]} == {"大会A", "作品B"}
+
+
+def test_extract_sign_numbers_renders_locally():
+    text = app.extract_sign_numbers(EVENTS)
+    assert "繰り返し現れる数字: 5（2件）" in text
+    assert "・5番: 大会Aの5（5回目）、作品Bの5（第5作）" in text
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.fixture
+def win_probs():
+    return np.random.default_rng(0).dirichlet(np.ones(16) * 2)
+
+
+def test_plackett_luce_matches_harville(win_probs):
+    result = app.simulate_race(win_probs, n_races=200_000, seed=1)
+    assert result["p3"].sum() == pytest.approx(1.0)
+    assert result["top3"].sum() == pytest.approx(3.0)
+    np.testing.assert_allclose(result["win"], win_probs, atol=0.01)
+    exact = app.finish_order_probabilities(win_probs).sum(axis=2)
+    np.testing.assert_allclose(result["p3"].sum(axis=2), exact, atol=0.01)
+
+
+def test_same_seed_reproduces(win_probs):
+    a = app.simulate_race(win_probs, n_races=10_000, model="thurstone", seed=7)
+    b = app.simulate_race(win_probs, n_races=10_000, model="thurstone", seed=7)
+    np.testing.assert_array_equal(a["p3"], b["p3"])
+
+
+def test_worker_failure_falls_back_in_process(win_probs, monkeypatch):
+    monkeypatch.setattr(app.os, "cpu_count", lambda: 4)
+
+    def broken(jobs, timeout):
+        raise TimeoutError("遅すぎる")
+
+    monkeypatch.setattr(app, "_simulate_in_processes", broken)
+    result = app.simulate_race(win_probs, n_races=20_000, n_workers=2, seed=3)
+    assert result["n_workers"] == 1
+    assert result["worker_error"] == "TimeoutError: 遅すぎる"
+    assert result["p3"].sum() == pytest.approx(1.0)
+
+
+def test_spawned_workers_match_in_process_fallback(win_probs, monkeypatch):
+    monkeypatch.setattr(app.os, "cpu_count", lambda: 2)
+    parallel = app.simulate_race(win_probs, n_races=20_000, n_workers=2, seed=5)
+    assert parallel["worker_error"] is None and parallel["n_workers"] == 2
+    # 子プロセスの起動時間は計算時間に含めない
+    assert parallel["startup_sec"] > 0
+    assert parallel["races_per_sec"] == pytest.approx(20_000 / parallel["elapsed_sec"])
+
+    # 分割した乱数列のまま1プロセスで計算するので、並列で成功した場合と同じ結果になる
+    monkeypatch.setattr(app, "_simulate_in_processes", lambda jobs, timeout: 1 / 0)
+    fallback = app.simulate_race(win_probs, n_races=20_000, n_workers=2, seed=5)
+    assert fallback["worker_error"].startswith("ZeroDivisionError")
+    np.testing.assert_array_equal(parallel["p3"], fallback["p3"])
@@ -0,0 +1,66 @@
+import io
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SNAPSHOT_DIR", str(tmp_path))
+    app._cached_workbook.clear()
+    yield tmp_path
+    app._cached_workbook.clear()
+
+
+@pytest.fixture
+def bundled():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, "arima_data.xlsx"), "rb") as f:
+        raw = f.read()
+    return lambda: io.BytesIO(raw)
+
+
+def assert_same(loaded, data, errors):
+    loaded_data, loaded_errors = loaded
+    assert list(loaded_data) == list(data) and loaded_errors == errors
+    for sheet, df in data.items():
+        assert loaded_data[sheet].equals(df)
+
+
+def test_feather_round_trip(snapshot_dir, stat_data):
+    errors = {"メモ": "ValueError: 壊れている"}
+    app._save_snapshot("k", stat_data, errors)
+    assert os.path.exists(snapshot_dir / "k" / "manifest.json")
+    assert_same(app._load_snapshot("k"), stat_data, errors)
+
+
+def test_pickle_fallback_without_pyarrow(snapshot_dir, stat_data, monkeypatch):
+    monkeypatch.setattr(app, "_feather", lambda: None)
+    app._save_snapshot("k", stat_data, {})
+    assert os.path.exists(snapshot_dir / "k.pkl")
+    assert_same(app._load_snapshot("k"), stat_data, {})
+
+
+def test_unknown_key_has_no_snapshot(snapshot_dir):
+    assert app._load_snapshot("missing") is None
+
+
+def test_second_load_reads_the_snapshot(snapshot_dir, bundled, monkeypatch):
+    first, errors = app.load_race_data(bundled())
+    assert first is not None and not errors
+    app._cached_workbook.clear()
+    monkeypatch.setattr(app, "_parse_workbook", lambda raw: 1 / 0)
+    second, errors = app.load_race_data(bundled())
+    assert second.key == first.key and not errors
+    assert all(second[sheet].equals(df) for sheet, df in first.items())
+
+
+def test_corrupt_snapshot_falls_back_to_parsing(snapshot_dir, bundled):
+    data, _ = app.load_race_data(bundled())
+    (snapshot_dir / data.key / "manifest.json").write_text("{壊れた", encoding="utf-8")
+    app._cached_workbook.clear()
+    reparsed, errors = app.load_race_data(bundled())
+    assert reparsed is not None and not errors
+    assert list(reparsed) == list(data)
@@ -0,0 +1,86 @@
+import sqlite3
+
+import app
+
+
+def test_stage_cache_roundtrip_and_ttl(job_store, clock):
+    app.stage_cache_put("k", "predict", {"text": "予想"})
+    assert app.stage_cache_get("k") == {"text": "予想"}
+    clock.advance(app.STAGE_CACHE_TTL_SEC + 1)
+    assert app.stage_cache_get("k") is None
+    assert app.stage_cache_stats()["entries"] == 0
+
+
+def test_stage_cache_cap_evicts_least_recently_used(job_store, clock, monkeypatch):
+    monkeypatch.setattr(app, "STAGE_CACHE_MAX_ENTRIES", 2)
+    for key in ["a", "b"]:
+        app.stage_cache_put(key, "s", key)
+        clock.advance(1)
+    assert app.stage_cache_get("a") == "a"
+    clock.advance(1)
+    app.stage_cache_put("c", "s", "c")
+    assert app.stage_cache_stats()["entries"] == 2
+    assert app.stage_cache_get("b") is None
+    assert app.stage_cache_get("a") == "a"
+
+
+def test_stage_cache_table_without_last_access_is_rebuilt(job_store, clock):
+    conn = sqlite3.connect(app.JOBS_DB_PATH)
+    conn.execute("CREATE TABLE stage_cache (key TEXT PRIMARY KEY, stage TEXT, output TEXT, created_at REAL)")
+    conn.execute("INSERT INTO stage_cache VALUES ('old', 's', '1', ?)", (clock.now,))
+    conn.commit()
+    conn.close()
+    assert app.stage_cache_get("old") is None
+    app.stage_cache_put("new", "s", 1)
+    assert app.stage_cache_get("new") == 1
+
+
+def counting(result):
+    calls = []
+
+    def run():
+        calls.append(1)
+        return result() if callable(result) else result
+
+    return run, calls
+
+
+def run_twice(stage):
+    outputs = [app.run_stages({"s": stage}, lambda *args, **kwargs: None)["s"] for _ in range(2)]
+    return outputs
+
+
+def test_output_is_cached(job_store):
+    run, calls = counting("出力")
+    assert run_twice({"inputs": {"x": 1}, "version": "1", "run": run}) == ["出力", "出力"]
+    assert len(calls) == 1
+
+
+def test_empty_output_is_not_cached(job_store):
+    run, calls = counting("")
+    run_twice({"inputs": {"x": 1}, "version": "1", "run": run})
+    assert len(calls) == 2
+
+
+def test_invalid_output_is_not_cached(job_store):
+    run, calls = counting({"picks": []})
+    run_twice({"inputs": {"x": 1}, "version": "1", "run": run, "valid": lambda out: bool(out["picks"])})
+    assert len(calls) == 2
+
+
+def test_run_can_mark_output_uncacheable(job_store):
+    def output():
+        app.mark_stage_uncacheable()
+        return "打ち切り"
+
+    run, calls = counting(output)
+    run_twice({"inputs": {"x": 1}, "version": "1", "run": run})
+    assert len(calls) == 2
+
+
+def test_incomplete_llm_response_is_not_cached_as_stage(job_store, llm_cache, fake_openai):
+    client = fake_openai.client(fake_openai.response("途中", "incomplete"), fake_openai.response("全文"))
+    stage = {"inputs": {"x": 1}, "version": "1", "run": lambda: app._call_gpt5mini_text(client, "s", "u", 10)}
+    assert run_twice(stage) == ["途中", "全文"]
+    assert app.run_stages({"s": stage}, lambda *args, **kwargs: None)["s"] == "全文"
+    assert len(client.calls) == 2
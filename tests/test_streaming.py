@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+def stream_call(client, shown):
+    return app._call_gpt5mini_text(client, "system", "user", 100, stream_to=shown.append)
+
+
+def deltas(fake_openai, *parts):
+    return [fake_openai.event("response.output_text.delta", delta=p) for p in parts]
+
+
+def test_completed_stream_is_shown_and_cached(llm_cache, fake_openai):
+    done = fake_openai.event("response.completed", response=SimpleNamespace(usage=None))
+    client = fake_openai.client(deltas(fake_openai, "本", "命") + [done])
+    shown = []
+    assert stream_call(client, shown) == "本命"
+    assert shown == ["本", "本命"]
+    assert stream_call(client, []) == "本命"
+    assert len(client.calls) == 1
+
+
+@pytest.mark.parametrize(
+    "terminal",
+    [
+        [SimpleNamespace(type="response.incomplete", response=SimpleNamespace(usage=None))],
+        [],  # 終端イベントが来ないまま切れた
+    ],
+)
+def test_unfinished_stream_is_not_cached(llm_cache, fake_openai, terminal):
+    client = fake_openai.client(deltas(fake_openai, "途中") + terminal, deltas(fake_openai, "再生成"))
+    assert stream_call(client, []) == "途中"
+    assert stream_call(client, []) == "再生成"
+    assert len(client.calls) == 2
+
+
+@pytest.mark.parametrize(
+    "failure",
+    [
+        SimpleNamespace(type="response.failed", response=SimpleNamespace(usage=None, error=SimpleNamespace(message="server_error"))),
+        SimpleNamespace(type="error", message="overloaded", code="server_error"),
+    ],
+)
+def test_failed_stream_raises(llm_cache, fake_openai, failure):
+    client = fake_openai.client(deltas(fake_openai, "途中") + [failure])
+    with pytest.raises(app.UpstreamUnavailableError):
+        stream_call(client, [])
+    assert app.llm_cache_stats()["entries"] == 0
@@ -0,0 +1,68 @@
+import app
+
+
+def combos(text):
+    tickets, unparsed = app.parse_ticket_text(text)
+    return [(row["券種"], row["組合せ"]) for _, row in tickets.iterrows()], unparsed
+
+
+def test_single_ticket_and_full_width_text():
+    assert combos("馬連　５番－９番") == ([("馬連", "5-9")], [])
+
+
+def test_comma_separated_tickets():
+    assert combos("ワイド 5-9, 5-13") == ([("ワイド", "5-9"), ("ワイド", "5-13")], [])
+
+
+def test_box_expands_all_combinations():
+    tickets, unparsed = combos("三連複 1,2,3,4 BOX")
+    assert unparsed == []
+    assert sorted(c for _, c in tickets) == ["1-2-3", "1-2-4", "1-3-4", "2-3-4"]
+
+
+def test_axis_nagashi_unordered():
+    tickets, unparsed = combos("馬連 5-2,9,13")
+    assert unparsed == []
+    assert sorted(c for _, c in tickets) == ["2-5", "5-13", "5-9"]
+
+
+def test_axis_nagashi_ordered_keeps_axis_first():
+    tickets, unparsed = combos("三連単 5-2,9,13")
+    assert unparsed == []
+    assert len(tickets) == 6
+    assert all(c.startswith("5→") for _, c in tickets)
+
+
+def test_formation_drops_repeated_horses():
+    tickets, unparsed = combos("三連複 5-2,9-2,9,13")
+    assert unparsed == []
+    assert sorted(c for _, c in tickets) == ["2-5-13", "2-5-9", "5-9-13"]
+
+
+def test_labelled_formation():
+    tickets, unparsed = combos("三連単 1着:5 2着:2,9 3着:2,9,13")
+    assert unparsed == []
+    assert sorted(c for _, c in tickets) == ["5→2→13", "5→2→9", "5→9→13", "5→9→2"]
+
+
+def test_strategy_headings_group_tickets():
+    tickets, _ = app.parse_ticket_text("安全型\nワイド 3-7\n攻め型\n三連単 3→7→1")
+    assert list(zip(tickets["戦略"], tickets["組合せ"])) == [("安全型", "3-7"), ("攻め型", "3→7→1")]
+
+
+def test_unknown_horse_and_incomplete_run_are_reported():
+    tickets, unparsed = combos("馬連 5-17\n三連複 5")
+    assert tickets == []
+    assert unparsed == ["その他 馬連 5-17", "その他 三連複 5"]
+
+
+def test_partially_valid_run_keeps_valid_tickets():
+    tickets, unparsed = combos("馬連 5-2,17")
+    assert tickets == [("馬連", "2-5")]
+    assert unparsed == ["その他 馬連 5-2,17"]
+
+
+def test_bracket_quinella_is_reported_as_unparsed():
+    tickets, unparsed = combos("枠連 1-2\n馬連 3-7")
+    assert tickets == [("馬連", "3-7")]
+    assert unparsed == ["その他 枠連 1-2"]
@@ -0,0 +1,55 @@
+import io
+
+import numpy as np
+import openpyxl
+
+import app
+
+HEADER = ["区分", "出走数(2015-2024)"] + app.STAT_SHEET_COLUMNS
+
+
+def workbook_bytes(sheets):
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    for name, rows in sheets.items():
+        ws = wb.create_sheet(name)
+        for row in rows:
+            ws.append(row)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def stat_rows(label="3歳", runs=10):
+    return [HEADER, [label, runs, 1, 2, 3, 4, 0.1, 0.3, 0.6, "#DIV/0!"], [None] * len(HEADER), ["その他", 5, 0, 0, 1, 4, 0, 0, 0.2, 50]]
+
+
+def test_errors_are_reported_per_sheet():
+    raw = workbook_bytes({"年齢": stat_rows(), "枠順": [["区分", "出走数", "1着数"], ["1枠", 3, 1]], "メモ": [["自由記述"]]})
+    data, errors = app._parse_workbook(raw)
+    assert list(data) == ["年齢", "メモ"]
+    assert errors["枠順"].startswith("ValueError: 必須列がありません")
+    assert {sheet for sheet, msg in errors.items() if msg == "シートがありません"} == set(app.STAT_SHEETS) - {"年齢", "枠順"}
+
+
+def test_rows_are_streamed_with_blank_rows_and_error_codes_dropped():
+    data, _ = app._parse_workbook(workbook_bytes({"年齢": stat_rows()}))
+    df = data["年齢"]
+    assert list(df.columns) == HEADER
+    assert list(df["区分"]) == ["3歳", "その他"]
+    assert np.isnan(df.loc[0, "期待値ポイント"]) and df.loc[1, "期待値ポイント"] == 50
+
+
+def test_chunked_read_matches_single_chunk(monkeypatch):
+    rows = [HEADER] + [[f"騎手{i}", i, 0, 0, 0, i, 0, 0, 0, i] for i in range(1, 26)]
+    raw = workbook_bytes({"騎手": rows})
+    whole, _ = app._parse_workbook(raw)
+    monkeypatch.setattr(app, "INGEST_CHUNK_ROWS", 4)
+    chunked, _ = app._parse_workbook(raw)
+    assert chunked["騎手"].equals(whole["騎手"])
+
+
+def test_broken_workbook_is_reported():
+    data, errors = app.load_race_data(io.BytesIO(b"not a workbook"))
+    assert data is None
+    assert "ワークブック" in errors